@@ -1,8 +1,9 @@
 import configparser
 import datetime as dt
 import os
+import tempfile
 import timeit
-from collections import defaultdict
+from contextlib import nullcontext
 from io import StringIO
 from pathlib import Path
 
@@ -26,6 +27,7 @@ def init_logger():
     logging.FILE_FORMAT = "[%(asctime)s] [%(levelname)-8s] - %(message)s"
     logging.DATE_FORMAT = "%Y-%m-%d %H:%M:%S"
     logging.init(logfile, to_console=False)
+    utils.cleanup_tmp_files(ROOT_DIR)
 
     return logfile
 
@@ -61,14 +63,18 @@ def progress(max_run, my_bar):
 
 def update_session_state():
     st.session_state.num_items = st.session_state.zot.count_items()
+    st.session_state.analysed = set()
     st.session_state.multpdf_items = []
-    st.session_state.init_multpdf_items = False
-    st.session_state.pdfs = defaultdict(list)
+    st.session_state.pdfs = {}
+    st.session_state.pdf_md5_groups = {}
+    st.session_state.local_md5 = {}
     st.session_state.nopdf_items = []
     st.session_state.suspecious_items = []
+    st.session_state.id_groups = {}
     st.session_state.doi_dupl_items = []
-    st.session_state.init_doi_dupl_items = False
     st.session_state.no_doi_isbn_items = []
+    st.session_state.reports = {}
+    st.session_state.exports = {}
 
 
 if __name__ == "__main__":
@@ -99,6 +105,27 @@ if __name__ == "__main__":
     if "zot_items" not in st.session_state:
         st.session_state.zot_items = []
 
+    if "items_by_key" not in st.session_state:
+        st.session_state.items_by_key = {}
+
+    if "scoped" not in st.session_state:
+        st.session_state.scoped = False
+
+    if "cache_key" not in st.session_state:
+        st.session_state.cache_key = None
+
+    if "whole_library" not in st.session_state:
+        st.session_state.whole_library = False
+
+    if "analysed" not in st.session_state:
+        st.session_state.analysed = set()
+
+    if "frame" not in st.session_state:
+        st.session_state.frame = None
+
+    if "tag_index" not in st.session_state:
+        st.session_state.tag_index = {}
+
     if "suspecious_items" not in st.session_state:
         st.session_state.suspecious_items = []
 
@@ -108,27 +135,51 @@ if __name__ == "__main__":
     if "multpdf_items" not in st.session_state:
         st.session_state.multpdf_items = []
 
-    if "init_multpdf_items" not in st.session_state:
-        st.session_state.init_multpdf_items = False
-
     if "pdfs" not in st.session_state:
-        st.session_state.pdfs = defaultdict(list)
+        st.session_state.pdfs = {}
+
+    if "pdf_md5_groups" not in st.session_state:
+        st.session_state.pdf_md5_groups = {}
+
+    if "local_md5" not in st.session_state:
+        st.session_state.local_md5 = {}
 
     if "doi_dupl_items" not in st.session_state:
         st.session_state.doi_dupl_items = []
 
-    if "init_doi_dupl_items" not in st.session_state:
-        st.session_state.init_doi_dupl_items = []
+    if "id_groups" not in st.session_state:
+        st.session_state.id_groups = {}
 
     if "no_doi_isbn_items" not in st.session_state:
         st.session_state.no_doi_isbn_items = []
 
+    if "reports" not in st.session_state:
+        st.session_state.reports = {}
+
+    if "exports" not in st.session_state:
+        st.session_state.exports = {}
+
+    if "partial_load" not in st.session_state:
+        st.session_state.partial_load = None
+
+    if "profiles" not in st.session_state:
+        st.session_state.profiles = {}
+
     if not st.session_state.init_logger:
         logfile = init_logger()
         st.session_state.logfile = logfile
+        st.session_state.tmp_dir = tempfile.mkdtemp(prefix="tmp_", dir=ROOT_DIR)
         st.session_state.init_logger = True
 
     logfile = st.session_state.logfile
+    # keep the exports of this session from the cleanup of other sessions
+    os.makedirs(st.session_state.tmp_dir, exist_ok=True)
+    os.utime(st.session_state.tmp_dir)
+    # a run stopped early (st.stop()) leaves its profiler enabled
+    if st.session_state.get("run_profiler") is not None:
+        st.session_state.run_profiler.disable()
+
+    st.session_state.run_profiler = utils.start_profile("run")
 
     #  UI --------------------------------
     st.sidebar.image("logo.png", use_column_width=True)
@@ -163,6 +214,20 @@ if __name__ == "__main__":
     placeholder = st.sidebar.empty()
     st.sidebar.markdown("-------")
     msg_status = st.sidebar.empty()
+    with st.sidebar.expander("Profiling", expanded=False):
+        st.selectbox(
+            "Profile",
+            [""] + utils.PROFILE_PHASES,
+            key="profile",
+            help="""Profile the next run or one of its phases.
+            Overrides ZOTEROTIDY_PROFILE""",
+        )
+        for name, path in st.session_state.profiles.items():
+            if path.exists():
+                with open(path, "rb") as f:
+                    st.download_button(
+                        f"Download {name} profile", f, file_name=path.name
+                    )
     if config_file:
         configFilePath = os.path.join(ROOT_DIR, config_file.name)
         confParser = configparser.RawConfigParser()
@@ -215,6 +280,56 @@ if __name__ == "__main__":
             )
             update_session_state()
 
+        if st.session_state.cache_key is not None:
+            latest, _ = utils.LIBRARY_CACHE.latest(st.session_state.cache_key[:2])
+            if latest is not None and latest[2] > st.session_state.zot_version:
+                st.sidebar.info(
+                    f":bell: Library changed (version {latest[2]}). Delta sync to update."
+                )
+
+        if st.session_state.lib_loaded and st.sidebar.button(
+            "🔂 Delta sync",
+            help="Fetch only the items changed since loading and update the reports",
+        ):
+            with st.spinner("Syncing ..."):
+                utils.sync_library_delta(st.session_state.zot, msg_status)
+
+        journal = utils.load_journal(st.session_state.zot, "plan")
+        if journal is not None:
+            pending = len(utils.pending_batches(journal))
+            st.sidebar.warning(
+                f":repeat: Unfinished write operations ({pending} batches left) from {journal['created']}"
+            )
+            jc1, jc2 = st.sidebar.columns((1, 1))
+            if jc1.button("Resume", key="resume_plan"):
+                with st.spinner("processing ..."):
+                    if utils.run_writes(msg_status):
+                        msg_status.warning(
+                            """:warning: Library updated.
+                            You may want to sync!"""
+                        )
+
+            if jc2.button("Discard", key="discard_plan"):
+                utils.discard_journal(journal)
+                msg_status.info("Discarded unfinished write operations")
+
+        if st.session_state.lib_loaded and st.sidebar.button("Memory usage"):
+            footprint = utils.session_footprint()
+            own = sum(r["bytes"] for r in footprint if not r["shared"])
+            shared = sum(r["bytes"] for r in footprint if r["shared"])
+            st.sidebar.info(
+                f"Session: {utils.get_size(own)}, shared library: {utils.get_size(shared)}"
+            )
+            st.sidebar.dataframe(footprint)
+
+        if st.session_state.frame is not None and st.sidebar.button("Save as Parquet"):
+            parquet = Path(st.session_state.tmp_dir) / "library.parquet"
+            if utils.save_frame(st.session_state.frame, parquet):
+                with open(parquet, "rb") as f:
+                    st.sidebar.download_button(
+                        "Download Parquet", f, file_name=parquet.name
+                    )
+
         lf = st.form("load_form")
         max_items = lf.slider(
             "Select items to retrieve from library",
@@ -225,33 +340,204 @@ if __name__ == "__main__":
             help="""Number of the most recently modified library items
             to retrieve (the more the slower!)""",
         )
+        lc1, lc2 = lf.columns((1, 2))
+        scope = lc1.selectbox(
+            "Scope",
+            utils.SCOPES,
+            help="""Load only the items of a collection,
+            a tag or an item type and their children""",
+        )
+        scope_value = lc2.text_input(
+            "Collection, tag or item type",
+            placeholder="e.g. My collection, nopdf, journalArticle",
+        )
+        subcollections = lf.checkbox("Include subcollections", value=True)
+        # the database path is configured, never typed by a visitor
+        local_db = ""
+        if utils.ZOTERO_SQLITE and lf.checkbox(
+            "Local zotero.sqlite",
+            help="""Read the library from the database of the
+            Zotero desktop client set by ZOTEROTIDY_SQLITE (no
+            network). Close Zotero or use a copy. Writes use the
+            Web API""",
+        ):
+            local_db = utils.ZOTERO_SQLITE
+        columnar = lf.checkbox(
+            "Columnar analysis",
+            help="""Convert the library to a table and compute
+            the reports on its columns (fast for big libraries)""",
+        )
+        streaming = lf.checkbox(
+            "Streaming analysis",
+            help="""Compute the reports while loading
+            without keeping the items (low memory)""",
+        )
+        sampled = lf.checkbox(
+            "Sampled health estimate",
+            help="""Estimate the reports from random pages
+            of the library (seconds instead of a full load)""",
+        )
+        sample_pages = lf.number_input(
+            "Sample pages", min_value=1, value=utils.SAMPLE_PAGES, help="100 items each"
+        )
         load_library = lf.form_submit_button(label="➡️ Load library")
         if load_library:
             logging.info(f"Touch {logfile}")
             open(logfile, "w").close()
             # update num of items when load
             update_session_state()
+            st.session_state.frame = None
             msg_status.info(f"Retrieving {max_items} items from library ...")
             time_start = timeit.default_timer()
             st.session_state.zot_version = st.session_state.zot.last_modified_version()
+            cache_key = (library_id, library_type, st.session_state.zot_version)
+            scoped = scope != "Library"
+            st.session_state.scoped = scoped
+            st.session_state.whole_library = False
+            st.session_state.cache_key = None
+            if scoped and not scope_value:
+                msg_status.error(f"Enter a {scope.lower()} to load.")
+                st.stop()
 
-            st.session_state.zot_items = utils.retrieve_data(
-                st.session_state.zot, max_items
-            )
+            if streaming:
+                if scoped:
+                    msg_status.error("Streaming analysis loads the whole library.")
+                    st.stop()
 
-            msg_status.info(f"Initialize children of {max_items} items ...")
-            with st.spinner("Initializing ..."):
-                st.session_state.children = utils.get_children()
+                st.session_state.lib_loaded = False
+                st.session_state.zot_items = []
+                st.session_state.items_by_key = {}
+                st.session_state.children = {}
+                with utils.profile_phase("load"):
+                    reports = utils.stream_analysis(
+                        st.session_state.zot, max_items, st.empty()
+                    )
 
-            logging.info(
-                f"num_items {st.session_state.zot.num_items()}, Num children: {len(st.session_state.children)}"
-            )
-            time_end = timeit.default_timer()
+                for name, rows in reports.items():
+                    utils.add_report(name, rows)
+
+                msg_time = utils.get_time(timeit.default_timer() - time_start)
+                msg_status.success(f":clock8: Finished in {msg_time}")
+            elif sampled:
+                if scoped:
+                    msg_status.error("The health estimate samples the whole library.")
+                    st.stop()
+
+                st.session_state.lib_loaded = False
+                st.session_state.zot_items = []
+                st.session_state.items_by_key = {}
+                st.session_state.children = {}
+                with utils.profile_phase("load"):
+                    rows = utils.estimate_health(
+                        st.session_state.zot, sample_pages, st.empty()
+                    )
+
+                utils.add_report("Health estimate", rows)
+                msg_time = utils.get_time(timeit.default_timer() - time_start)
+                msg_status.success(f":clock8: Finished in {msg_time}")
+            else:
+                # only complete libraries are shared
+                if local_db and scoped:
+                    msg_status.error("The local database loads the whole library.")
+                    st.stop()
+
+                shared = (
+                    not scoped
+                    and not local_db
+                    and max_items >= st.session_state.num_items
+                )
+                if shared:
+                    st.session_state.cache_key = cache_key
+
+                st.session_state.whole_library = not scoped and (
+                    bool(local_db) or max_items >= st.session_state.num_items
+                )
+
+                # only loads of the shared entry wait for each other
+                lock = (
+                    utils.LIBRARY_CACHE.loading(cache_key) if shared else nullcontext()
+                )
+                with lock, utils.profile_phase("load"):
+                    entry = utils.LIBRARY_CACHE.get(cache_key) if shared else None
+                    if entry is not None:
+                        logging.info(f"Library {cache_key} from shared cache")
+                        st.session_state.zot_items = entry["items"]
+                        st.session_state.children = entry["children"]
+                        st.session_state.items_by_key = entry["by_key"]
+                    elif local_db:
+                        msg_status.info("Reading the local database ...")
+                        try:
+                            (
+                                st.session_state.zot_items,
+                                st.session_state.children,
+                                st.session_state.zot_version,
+                            ) = utils.read_zotero_sqlite(
+                                os.path.expanduser(local_db), library_type, library_id
+                            )
+                        except Exception as e:
+                            logging.error(
+                                f"Can not read {local_db} with error {str(e)}"
+                            )
+                            msg_status.error("Can not read the local database")
+                            st.stop()
+                    elif scoped:
+                        msg_status.info(
+                            f"Retrieving items of {scope} {scope_value} ..."
+                        )
+                        st.session_state.zot_items = utils.retrieve_scoped_data(
+                            st.session_state.zot, scope, scope_value, subcollections
+                        )
+                    else:
+                        st.session_state.zot_items = utils.retrieve_data(
+                            st.session_state.zot, max_items
+                        )
 
-            st.session_state.lib_loaded = True
+                    if entry is None:
+                        if not local_db:
+                            msg_status.info("Initialize children of items ...")
+                            with st.spinner("Initializing ..."), utils.profile_phase(
+                                "children"
+                            ):
+                                st.session_state.children = utils.get_children()
 
-            msg_time = utils.get_time(time_end - time_start)
-            msg_status.success(f":clock8: Finished in {msg_time}")
+                        st.session_state.items_by_key = utils.index_items(
+                            st.session_state.zot_items
+                        )
+                        if shared:
+                            entry = utils.LIBRARY_CACHE.put(
+                                cache_key,
+                                st.session_state.zot_items,
+                                st.session_state.children,
+                            )
+                            st.session_state.items_by_key = entry["by_key"]
+                            logging.info(
+                                f"Shared cache: {len(utils.LIBRARY_CACHE)} libraries, {utils.LIBRARY_CACHE.nbytes} bytes"
+                            )
+
+                if shared and utils.STREAM_ENABLED:
+                    listener = utils.library_listener()
+                    if listener is not None:
+                        listener.subscribe(st.session_state.zot, cache_key[:2])
+
+                if columnar:
+                    st.session_state.frame = utils.items_frame(
+                        st.session_state.zot_items
+                    )
+
+                st.session_state.tag_index = utils.build_tag_index(
+                    st.session_state.zot_items,
+                    utils.get_tag_colors(st.session_state.zot),
+                )
+
+                logging.info(
+                    f"num_items {st.session_state.zot.num_items()}, Num children: {len(st.session_state.children)}"
+                )
+                time_end = timeit.default_timer()
+
+                st.session_state.lib_loaded = True
+
+                msg_time = utils.get_time(time_end - time_start)
+                msg_status.success(f":clock8: Finished in {msg_time}")
 
         if st.session_state.lib_loaded:
             config = st.form("config_form")
@@ -291,6 +577,15 @@ if __name__ == "__main__":
                     placeholder="mail@box.com",
                     help="""An email that is necessary for using the Unpaywall API service.""",
                 )
+                # the snapshot path is configured, never typed by a visitor
+                snapshot = ""
+                if utils.UNPAYWALL_SNAPSHOT and c1.checkbox(
+                    "Unpaywall snapshot",
+                    help="""Use the downloaded Unpaywall snapshot set by
+                    ZOTEROTIDY_UNPAYWALL. Replaces the API (no email
+                    needed)""",
+                ):
+                    snapshot = utils.UNPAYWALL_SNAPSHOT
                 delete_duplicates = c2.checkbox(
                     "Merge Duplicate Items",
                     help="""Duplicate items based on
@@ -301,6 +596,16 @@ if __name__ == "__main__":
                     help="""Items having more than
                     one pdf file (first run is slow!)""",
                 )
+                by_md5 = c1.checkbox(
+                    "Compare PDF by content",
+                    help="""Duplicate pdf files have the same md5,
+                    whatever their names are (no download)""",
+                )
+                hash_local = c1.checkbox(
+                    "Hash local pdf files",
+                    help="""Compare the files of the storage and
+                    base directories below by content""",
+                )
                 report_without_pdf = c1.checkbox(
                     "Items without PDF",
                     help="""Items having no pdf files""",
@@ -317,9 +622,84 @@ if __name__ == "__main__":
                     the same name, then keep only
                     one pdf.""",
                 )
+                reclaim_storage = c2.checkbox(
+                    "Reclaim storage",
+                    help="""Delete the largest duplicate
+                    and/or standalone files""",
+                )
+                reclaim_kinds = c2.multiselect(
+                    "Files to reclaim",
+                    ["within", "across", "orphan"],
+                    default=["within"],
+                    help="""within: copies of a file of the same item,
+                    across: copies of a file of another item,
+                    orphan: standalone files in no collection
+                    and without tags""",
+                )
+                reclaim_max = c2.number_input(
+                    "Max. files to reclaim", min_value=1, value=100
+                )
+                edit_tags = c2.checkbox(
+                    "Rename, merge and prune tags",
+                    help="""Apply the tag changes below""",
+                )
+                tag_mapping = c2.text_area(
+                    "Rename or merge tags",
+                    placeholder="old -> new\nnopdf, no_pdf -> nopdf",
+                    help="""One rename or merge per line""",
+                )
+                tag_min_count = c2.number_input(
+                    "Prune tags used by less items than",
+                    min_value=0,
+                    value=0,
+                    help="""0: don't prune. Colored tags are kept""",
+                )
+                report_tags = c1.checkbox("Tags", help="""Tags by number of items""")
+                report_storage = c1.checkbox(
+                    "Storage usage",
+                    help="""Duplicate and standalone files
+                    ranked by reclaimable bytes""",
+                )
+                report_scan = c1.checkbox(
+                    "Missing & orphaned files",
+                    help="""Scan the local storage directory for
+                    missing files and files of no attachment""",
+                )
+                # server paths are configured, never typed by a visitor
+                storage_dir = utils.ZOTERO_STORAGE
+                base_dir = utils.ZOTERO_BASE_DIR
+                c1.text_input(
+                    "Zotero storage directory",
+                    value=storage_dir,
+                    disabled=True,
+                    help="""Set by ZOTEROTIDY_STORAGE""",
+                )
+                c1.text_input(
+                    "Linked files base directory",
+                    value=base_dir,
+                    disabled=True,
+                    help="""Base directory of relative linked files
+                    (Zotero settings, Files and Folders), set by
+                    ZOTEROTIDY_BASE_DIR""",
+                )
+                report_fulltext = c1.checkbox(
+                    "Full-text duplicates",
+                    help="""Items whose attachments share most of their
+                    text (first run is slow!)""",
+                )
                 report_no_doi_isbn = c1.checkbox(
                     "DOI & ISBN", help="Articles with no doi and Books with no isbn"
                 )
+                report_backfill = c1.checkbox(
+                    "DOI candidates",
+                    help="""Best Crossref matches of articles
+                    with no doi (uses the email above)""",
+                )
+                backfill = c2.checkbox(
+                    "Backfill DOIs",
+                    help="""Write the accepted Crossref matches
+                    to articles with no doi""",
+                )
 
                 suspecious = c1.checkbox(
                     "Suspecious items",
@@ -328,6 +708,16 @@ if __name__ == "__main__":
                 trash = c1.checkbox(
                     "Trash status", help="""Does not require reloading library"""
                 )
+                report_trash = c1.checkbox(
+                    "Trash summary", help="""Trashed items by type"""
+                )
+                empty_trash = c2.checkbox(
+                    "Empty trash", help="""Delete trashed items for good"""
+                )
+                log_items = c1.checkbox(
+                    "Log items",
+                    help="""Write all items of the reports in the log (slow)""",
+                )
                 start = config.form_submit_button(label="🚦Start")
                 pl2 = st.empty()
                 if start:
@@ -340,186 +730,418 @@ if __name__ == "__main__":
                         or update_tags_o
                     )
 
-                    if update_tags + delete_duplicates + delete_duplicate_pdf > 1:
-                        st.error("Can not have more than one write-opration")
-                        st.stop()
-
                     if not utils.uptodate():
                         msg_status.error(":fire: Library is out of sync.")
 
-                    if head:
-                        num_head = 10
-                        st.info(f"Top {num_head} items")
-                        logging.info(f"Top {num_head} items")
-                        count = 0
-                        for item in st.session_state.zot_items:
-                            if utils.is_standalone(item) or utils.is_file(item):
-                                continue
-
-                            utils.log_title(item)
-                            count += 1
-                            if count >= num_head:
-                                break
-
-                    if trash:
-                        trash_empty = utils.trash_is_empty(st.session_state.zot)
-                        if trash_empty:
-                            st.info(":heavy_check_mark: Trash is empty!")
-                        else:
-                            st.warning(":x: Trash is not empty!")
+                    st.session_state.reports = {}
+                    st.session_state.exports = {}
+                    with utils.profile_phase("reports"):
+                        if head:
+                            num_head = 10
+                            logging.info(f"Top {num_head} items")
+                            rows = []
+                            for item in st.session_state.zot_items:
+                                if utils.is_standalone(item) or utils.is_file(item):
+                                    continue
+
+                                rows.append(utils.item_row(item))
+                                if len(rows) >= num_head:
+                                    break
+
+                            utils.add_report(f"Top {num_head} items", rows, log_items)
+
+                        if trash:
+                            num_trash = utils.trash_count(st.session_state.zot)
+                            if not num_trash:
+                                st.info(":heavy_check_mark: Trash is empty!")
+                            else:
+                                st.warning(
+                                    f":x: Trash is not empty! ({num_trash} items)"
+                                )
 
-                    if OA:
-                        utils.unpywall_credits(mail)
-                        time_start = timeit.default_timer()
-                        items_by_doi = utils.get_items_by_doi(
-                            st.session_state.zot_items
-                        )
-                        with st.spinner("Initializing ..."):
-                            OA_items, CA_items = utils.get_oa_ca(items_by_doi, pl2)
-
-                        time_end = timeit.default_timer()
-                        msg_time = utils.get_time(time_end - time_start)
-                        msg_status.success(f":clock8: Finished in {msg_time}")
-                        total = len(items_by_doi)
-                        st.info(
-                            f":heavy_check_mark: found {len(OA_items)} / {total} open-access articles"
-                        )
-                        if CA_items:
-                            st.warning(
-                                f":x: found {len(CA_items)} / {total} close-access articles"
+                        if report_trash:
+                            rows = utils.trash_summary(
+                                utils.get_trash(st.session_state.zot)
                             )
+                            utils.add_report("Trash", rows, log_items)
 
-                        logging.info(f"Open-Access dois ({len(OA_items)} / {total})\n")
-                        for i in OA_items:
-                            logging.info(f"doi: {i}")
+                        if OA:
+                            if not snapshot:
+                                utils.unpywall_credits(mail)
 
-                        logging.info(
-                            f"Not Open-Access dois {len(CA_items)} / {total}\n"
-                        )
-                        for i in CA_items:
-                            logging.info(f"doi: {i}")
+                            time_start = timeit.default_timer()
+                            items_by_doi = utils.get_items_by_doi(
+                                st.session_state.zot_items
+                            )
+                            with st.spinner("Initializing ..."):
+                                OA_items, CA_items = utils.get_oa_ca(
+                                    items_by_doi, pl2, snapshot
+                                )
 
-                        if total - len(OA_items) - len(CA_items):
-                            st.warning(
-                                f":x: {total - len(OA_items) - len(CA_items)} DOIs could not be found by Unpaywall."
+                            time_end = timeit.default_timer()
+                            msg_time = utils.get_time(time_end - time_start)
+                            msg_status.success(f":clock8: Finished in {msg_time}")
+                            total = len(items_by_doi)
+                            st.info(
+                                f":heavy_check_mark: found {len(OA_items)} / {total} open-access articles"
                             )
-                            logging.warning(
-                                f"{total - len(OA_items) - len(CA_items)} DOIs could not be found by Unpaywall.\n"
+                            if CA_items:
+                                st.warning(
+                                    f":x: found {len(CA_items)} / {total} close-access articles"
+                                )
+
+                            logging.info(
+                                f"Open-Access dois ({len(OA_items)} / {total})\n"
                             )
-                            for doi, item in items_by_doi.items():
-                                doi = doi.lower()
-                                if doi not in OA_items and doi not in CA_items:
-                                    logging.info(f"doi: <{doi}>")
-
-                    if report_no_doi_isbn:
-                        st.session_state.no_doi_isbn_items = (
-                            utils.get_items_with_empty_doi_or_isbn(
-                                st.session_state.zot_items
+                            for i in OA_items:
+                                logging.info(f"doi: {i}")
+
+                            logging.info(
+                                f"Not Open-Access dois {len(CA_items)} / {total}\n"
                             )
-                        )
+                            for i in CA_items:
+                                logging.info(f"doi: {i}")
 
-                        if st.session_state.no_doi_isbn_items:
-                            st.warning(
-                                f""":x: Items with no doi / isbn:
-                                {len(st.session_state.no_doi_isbn_items)}"""
+                            if total - len(OA_items) - len(CA_items):
+                                st.warning(
+                                    f":x: {total - len(OA_items) - len(CA_items)} DOIs could not be found by Unpaywall."
+                                )
+                                logging.warning(
+                                    f"{total - len(OA_items) - len(CA_items)} DOIs could not be found by Unpaywall.\n"
+                                )
+                                for doi, item in items_by_doi.items():
+                                    doi = doi.lower()
+                                    if doi not in OA_items and doi not in CA_items:
+                                        logging.info(f"doi: <{doi}>")
+
+                        if report_no_doi_isbn:
+                            utils.update_no_doi_isbn_state()
+
+                            if st.session_state.no_doi_isbn_items:
+                                st.warning(
+                                    f""":x: Items with no doi / isbn:
+                                    {len(st.session_state.no_doi_isbn_items)}"""
+                                )
+                            else:
+                                st.info(
+                                    """:heavy_check_mark: No items without
+                                doi / isbn"""
+                                )
+
+                            utils.add_report(
+                                "Items with no doi / isbn",
+                                [
+                                    utils.item_row(d)
+                                    for d in utils.items_of(
+                                        st.session_state.no_doi_isbn_items
+                                    )
+                                ],
+                                log_items,
                             )
-                        else:
+
+                        backfill_rows = []
+                        if report_backfill or backfill:
+                            utils.update_no_doi_isbn_state()
+                            with st.spinner("Querying Crossref ..."):
+                                backfill_rows = utils.backfill_dois(
+                                    utils.items_of(st.session_state.no_doi_isbn_items),
+                                    pl2,
+                                    mail,
+                                )
+
+                            accepted = sum(row["accepted"] for row in backfill_rows)
                             st.info(
-                                """:heavy_check_mark: No items without
-                            doi / isbn"""
+                                f":mag: DOI found for {accepted} / {len(backfill_rows)} matched articles"
                             )
+                            utils.add_report("DOI candidates", backfill_rows, log_items)
 
-                        logging.info("Items with no doi or no isbn: \n")
-                        for d in st.session_state.no_doi_isbn_items:
-                            utils.log_title(d)
+                        if report_duplicates:
+                            utils.update_duplicate_items_state()
+                            duplicates = utils.items_of(st.session_state.doi_dupl_items)
+                            if duplicates:
+                                st.warning(f":x: Duplicate items ({len(duplicates)}):")
+                            else:
+                                st.info(":heavy_check_mark: No duplicate items found.")
 
-                    if report_duplicates:
-                        utils.update_duplicate_items_state()
-                        duplicates = st.session_state.doi_dupl_items
-                        if duplicates:
-                            st.warning(f":x: Duplicate items ({len(duplicates)}):")
-                        else:
-                            st.info(":heavy_check_mark: No duplicate items found.")
+                            utils.add_report(
+                                "Duplicate items",
+                                [utils.item_row(d) for d in duplicates],
+                                log_items,
+                            )
 
-                        logging.info(f"Duplicate items: {len(duplicates)}\n")
-                        for d in duplicates:
-                            utils.log_title(d)
+                        # Functionalities
+                        if report_standalone:
+                            standalones = utils.items_of(utils.standalone_keys())
 
-                    # Functionalities
-                    if report_standalone:
-                        standalones = utils.get_standalone_items(
-                            st.session_state.zot_items
-                        )
+                            if not standalones:
+                                st.info(":heavy_check_mark: No standalone items")
+                            else:
+                                st.warning(
+                                    f"""
+                                :x: Standalone item(s): {len(standalones)}"""
+                                )
 
-                        if not standalones:
-                            st.info(":heavy_check_mark: No standalone items")
-                        else:
-                            st.warning(
-                                f"""
-                            :x: Standalone item(s): {len(standalones)}"""
+                            utils.add_report(
+                                "Standalone items",
+                                [utils.item_row(d) for d in standalones],
+                                log_items,
+                            )
+
+                        if hash_local:
+                            if not storage_dir and not base_dir:
+                                st.error(
+                                    "Set ZOTEROTIDY_STORAGE or ZOTEROTIDY_BASE_DIR"
+                                )
+                                st.stop()
+
+                            with st.spinner("Hashing local files ..."):
+                                try:
+                                    st.session_state.local_md5, paths = utils.local_md5(
+                                        st.session_state.zot_items,
+                                        storage_dir,
+                                        base_dir,
+                                    )
+                                except ValueError as e:
+                                    st.error(str(e))
+                                    st.stop()
+
+                                st.session_state.analysed.discard("md5")
+
+                            rows = utils.local_md5_rows(
+                                st.session_state.local_md5, paths
+                            )
+                            st.info(
+                                f":1234: {len(rows)} groups of identical local pdf files"
                             )
+                            utils.add_report("Identical local files", rows, log_items)
+
+                        if report_duplicate_pdf and by_md5:
+                            groups = utils.md5_groups()
+                            within = utils.md5_duplicates_within_items(groups)
+                            across = utils.md5_duplicates_across_items(groups)
+                            if within:
+                                st.warning(
+                                    f":x: Items with identical pdf files found: {len(within)}"
+                                )
+                            else:
+                                st.info(
+                                    """:heavy_check_mark: No items with identical pdf
+                                    attachments found"""
+                                )
+
+                            rows = []
+                            for key, attachments in within.items():
+                                item = st.session_state.items_by_key.get(key)
+                                if item is None:  # parent not loaded
+                                    continue
 
-                        logging.info(f"Standalone items ({len(standalones)}):\n")
-                        for d in standalones:
-                            utils.log_title(d)
+                                files = [
+                                    [a["data"].get("filename") for a in g]
+                                    for g in attachments
+                                ]
+                                rows.append(utils.item_row(item, pdfs=str(files)))
 
-                    if report_duplicate_pdf:
-                        utils.update_duplicate_attach_state()
-                        num_duplicates = len(st.session_state.multpdf_items)
-                        if num_duplicates:
-                            st.warning(
-                                f":x: Items with duplicate pdf files found: {num_duplicates}"
+                            utils.add_report(
+                                "Items with identical pdf files", rows, log_items
                             )
-                            logging.info(
-                                f"Items with duplicate pdf files ({num_duplicates}):\n"
+
+                            if across:
+                                st.warning(
+                                    f":x: Identical pdf files shared by different items: {len(across)}"
+                                )
+
+                            rows = [
+                                {
+                                    "md5": md5,
+                                    "files": str(
+                                        [a["data"].get("filename") for a in attachments]
+                                    ),
+                                    "keys": str([a["key"] for a in attachments]),
+                                }
+                                for md5, attachments in across.items()
+                            ]
+                            utils.add_report(
+                                "Identical pdf files shared by different items",
+                                rows,
+                                log_items,
                             )
-                            for item in st.session_state.multpdf_items:
-                                item_key = item["key"]
-                                utils.log_title(item)
-                                st.code(f"> {st.session_state.pdfs[item_key]}")
-                        else:
-                            st.info(
-                                """ :heavy_check_mark: No items with duplicate pdf attachments
-                                found"""
+
+                        if report_duplicate_pdf and not by_md5:
+                            utils.update_duplicate_attach_state()
+                            num_duplicates = len(st.session_state.multpdf_items)
+                            if num_duplicates:
+                                st.warning(
+                                    f":x: Items with duplicate pdf files found: {num_duplicates}"
+                                )
+                            else:
+                                st.info(
+                                    """ :heavy_check_mark: No items with duplicate pdf attachments
+                                    found"""
+                                )
+
+                            utils.add_report(
+                                "Items with duplicate pdf files",
+                                [
+                                    utils.item_row(
+                                        item, pdfs=str(utils.pdf_filenames(item["key"]))
+                                    )
+                                    for item in utils.items_of(
+                                        st.session_state.multpdf_items
+                                    )
+                                ],
+                                log_items,
+                            )
+
+                        if report_tags:
+                            index = st.session_state.tag_index
+                            st.info(f":label: {len(index)} tags")
+                            utils.add_report("Tags", utils.tag_rows(index), log_items)
+
+                        if report_storage or reclaim_storage:
+                            storage_index = utils.get_storage_index(
+                                st.session_state.zot_items
                             )
+                            candidates = utils.get_storage_candidates(storage_index)
 
-                    if report_without_pdf:
-                        utils.update_without_pdf_state()
-                        num_duplicates = len(st.session_state.nopdf_items)
-                        if num_duplicates:
-                            st.warning(
-                                f":x: Items with no pdf attachments: {num_duplicates}"
+                        if report_storage:
+                            total = sum(e["size"] for e in storage_index)
+                            st.info(
+                                f":floppy_disk: {len(storage_index)} stored files: {utils.get_size(total)}"
                             )
                             logging.info(
-                                f"Items with not pdf attachments ({num_duplicates}):\n"
+                                f"Stored files {len(storage_index)}: {total} bytes"
                             )
-                            for item in st.session_state.nopdf_items:
-                                utils.log_title(item)
-                        else:
-                            st.info(
-                                """:heavy_check_mark: Items without pdf
-                                attachments not found"""
+                            for kind in ["within", "across", "orphan"]:
+                                selected = [c for c in candidates if c["kind"] == kind]
+                                if selected:
+                                    reclaimable = sum(c["size"] for c in selected)
+                                    st.warning(
+                                        f":x: {len(selected)} {kind} files: {utils.get_size(reclaimable)} reclaimable"
+                                    )
+
+                            rows = [
+                                {
+                                    "size": c["size"],
+                                    "kind": c["kind"],
+                                    "filename": c["filename"],
+                                    "key": c["key"],
+                                    "parent": c["parent"],
+                                    "keep": c["keep"],
+                                }
+                                for c in candidates
+                            ]
+                            utils.add_report("Reclaimable files", rows, log_items)
+
+                        if report_scan:
+                            if not storage_dir and not base_dir:
+                                st.error(
+                                    "Set ZOTEROTIDY_STORAGE or ZOTEROTIDY_BASE_DIR"
+                                )
+                                st.stop()
+
+                            with st.spinner("Scanning local files ..."):
+                                try:
+                                    rows, scanned = utils.scan_storage(
+                                        st.session_state.zot_items,
+                                        storage_dir,
+                                        base_dir,
+                                        orphans=st.session_state.whole_library,
+                                    )
+                                except ValueError as e:
+                                    st.error(str(e))
+                                    st.stop()
+
+                            st.info(f":file_folder: {scanned} local files scanned")
+                            logging.info(f"Scanned {scanned} local files")
+                            for kind in ["missing", "orphan", "stale"]:
+                                selected = [r for r in rows if r["kind"] == kind]
+                                if selected:
+                                    size = sum(r["size"] for r in selected)
+                                    st.warning(
+                                        f":x: {len(selected)} {kind} files ({utils.get_size(size)})"
+                                    )
+
+                            if not st.session_state.whole_library:
+                                st.warning(
+                                    "Partial library: orphaned files not reported"
+                                )
+
+                            utils.add_report(
+                                "Missing & orphaned files", rows, log_items
                             )
 
-                    if suspecious:
-                        utils.update_suspecious_state()
-                        num_suspecious = len(st.session_state.suspecious_items)
+                        if report_fulltext:
+                            with st.spinner("Updating full-text fingerprints ..."):
+                                index = utils.update_fulltext_index(
+                                    st.session_state.zot, pl2
+                                )
 
-                        if num_suspecious:
-                            st.warning(f":x: Suspecious items: {num_suspecious}")
-                        else:
-                            st.info(":heavy_check_mark: No suspecious items found")
+                            rows = utils.fulltext_duplicates(index)
+                            if rows:
+                                st.warning(
+                                    f":x: Items sharing their full-text: {len(rows)}"
+                                )
+                            else:
+                                st.info(
+                                    ":heavy_check_mark: No items sharing their full-text"
+                                )
+
+                            utils.add_report(
+                                "Items sharing their full-text", rows, log_items
+                            )
+
+                        if report_without_pdf:
+                            utils.update_without_pdf_state()
+                            num_duplicates = len(st.session_state.nopdf_items)
+                            if num_duplicates:
+                                st.warning(
+                                    f":x: Items with no pdf attachments: {num_duplicates}"
+                                )
+                            else:
+                                st.info(
+                                    """:heavy_check_mark: Items without pdf
+                                    attachments not found"""
+                                )
 
-                        logging.info(f"Suspecious items ({num_suspecious}):\n")
-                        for item in st.session_state.suspecious_items:
-                            utils.log_title(item)
+                            utils.add_report(
+                                "Items with no pdf attachments",
+                                [
+                                    utils.item_row(item)
+                                    for item in utils.items_of(
+                                        st.session_state.nopdf_items
+                                    )
+                                ],
+                                log_items,
+                            )
+
+                        if suspecious:
+                            utils.update_suspecious_state()
+                            num_suspecious = len(st.session_state.suspecious_items)
+
+                            if num_suspecious:
+                                st.warning(f":x: Suspecious items: {num_suspecious}")
+                            else:
+                                st.info(":heavy_check_mark: No suspecious items found")
+
+                            utils.add_report(
+                                "Suspecious items",
+                                [
+                                    utils.item_row(i)
+                                    for i in utils.items_of(
+                                        st.session_state.suspecious_items
+                                    )
+                                ],
+                                log_items,
+                            )
 
                     if (
-                        update_tags_z
-                        or update_tags_n
-                        or update_tags_m
-                        or update_tags_d
-                        or update_tags_o
+                        update_tags
+                        or delete_duplicates
+                        or delete_duplicate_pdf
+                        or reclaim_storage
+                        or edit_tags
+                        or empty_trash
+                        or backfill
                     ):
                         if not utils.uptodate():
                             st.error(
@@ -527,46 +1149,54 @@ if __name__ == "__main__":
                             up-to-date."""
                             )
                         else:
-                            utils.update_tags(
-                                pl2,
-                                update_tags_z,
-                                update_tags_n,
-                                update_tags_m,
-                                update_tags_d,
-                                update_tags_o,
-                                mail,
-                            )
-
-                    if delete_duplicates:
-                        if not utils.uptodate():
-                            st.error(
-                                """:skull_and_crossbones: Library is
-                            not up-to-date."""
-                            )
-                        else:
-                            with st.spinner("processing ..."):
-                                res = utils.delete_duplicate_items(pl2)
+                            new_tags = {}
+                            if update_tags:
+                                new_tags = utils.set_new_tag(
+                                    update_tags_z,
+                                    update_tags_n,
+                                    update_tags_m,
+                                    update_tags_d,
+                                    update_tags_o,
+                                    mail,
+                                    snapshot,
+                                )
 
-                            if res:
-                                pl2.warning(
-                                    """:warning: Library updated.
-                                    You may want to sync!"""
+                            plan = None
+                            if reclaim_storage:
+                                plan, reclaimed = utils.plan_storage_reclaim(
+                                    candidates, reclaim_kinds, reclaim_max
                                 )
-                            else:
                                 st.info(
-                                    """:heavy_check_mark: No duplicates to
-                                delete!"""
+                                    f"Reclaim {utils.get_size(reclaimed)} from {len(plan)} files ..."
                                 )
 
-                    if delete_duplicate_pdf:
-                        if not utils.uptodate():
-                            st.error(
-                                """:skull_and_crossbones:
-                            Library is not up-to-date."""
-                            )
-                        else:
-                            with st.spinner("processing ..."):
-                                res = utils.delete_duplicate_pdf(pl2)
+                            dois = {
+                                row["key"]: row["DOI"]
+                                for row in backfill_rows
+                                if row["accepted"]
+                            }
+                            pdf_by = None
+                            if delete_duplicate_pdf:
+                                pdf_by = "md5" if by_md5 else "filename"
+
+                            with st.spinner("processing ..."), utils.profile_phase(
+                                "writes"
+                            ):
+                                res = utils.run_writes(
+                                    pl2,
+                                    new_tags=new_tags,
+                                    tag_mapping=(
+                                        utils.parse_tag_mapping(tag_mapping)
+                                        if edit_tags
+                                        else {}
+                                    ),
+                                    tag_min_count=tag_min_count if edit_tags else 0,
+                                    merge=delete_duplicates,
+                                    pdf_by=pdf_by,
+                                    pdf_plan=plan,
+                                    trash=empty_trash,
+                                    dois=dois,
+                                )
 
                             if res:
                                 pl2.warning(
@@ -576,7 +1206,7 @@ if __name__ == "__main__":
                             else:
                                 st.info(
                                     """:heavy_check_mark:
-                                Nothing to delete!"""
+                                Nothing to change!"""
                                 )
 
                     logging.info(f"logfile: {logfile}")
@@ -591,3 +1221,10 @@ if __name__ == "__main__":
                         download = st.sidebar.download_button(
                             "Download log", f, file_name=dlog_file
                         )
+
+        with utils.profile_phase("render"):
+            for name, rows in st.session_state.reports.items():
+                utils.show_report(name, rows)
+
+    utils.stop_profile("run", st.session_state.run_profiler)
+    st.session_state.run_profiler = None
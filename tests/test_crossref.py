@@ -0,0 +1,122 @@
+"""DOI backfill against a local Crossref stand-in"""
+
+import json
+import threading
+import urllib.parse
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+import utils
+
+WORKS = {
+    "deep learning for protein structure prediction": [
+        {
+            "DOI": "10.1000/protein",
+            "title": ["Deep learning for protein structure prediction"],
+            "author": [{"family": "Smith"}],
+            "issued": {"date-parts": [[2020]]},
+        },
+        {
+            "DOI": "10.1000/other",
+            "title": ["Protein folding"],
+            "author": [{"family": "Doe"}],
+            "issued": {"date-parts": [[2018]]},
+        },
+    ],
+    "editorial": [
+        {
+            "DOI": "10.1000/editorial",
+            "title": ["Editorial"],
+            "author": [{"family": "Smith"}],
+            "issued": {"date-parts": [[2020]]},
+        }
+    ],
+}
+
+
+class CrossrefHandler(BaseHTTPRequestHandler):
+    queries = []
+
+    def do_GET(self):
+        params = urllib.parse.parse_qs(urllib.parse.urlparse(self.path).query)
+        title = params["query.bibliographic"][0].lower()
+        self.queries.append(params)
+        body = json.dumps({"message": {"items": WORKS.get(title, [])}}).encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class Placeholder:
+    def info(self, *args):
+        pass
+
+
+@pytest.fixture
+def crossref(monkeypatch, tmp_path):
+    CrossrefHandler.queries = []
+    server = ThreadingHTTPServer(("127.0.0.1", 0), CrossrefHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    monkeypatch.setattr(utils, "CROSSREF_URL", f"http://127.0.0.1:{server.server_port}")
+    monkeypatch.setattr(utils, "CROSSREF_DIR", tmp_path / "crossref")
+    yield CrossrefHandler
+    server.shutdown()
+
+
+def article(key, title, date="", author=None):
+    creators = [{"creatorType": "author", "lastName": author}] if author else []
+    return {
+        "key": key,
+        "data": {
+            "key": key,
+            "itemType": "journalArticle",
+            "title": title,
+            "DOI": "",
+            "date": date,
+            "creators": creators,
+        },
+    }
+
+
+def test_score_without_year_and_author():
+    item = article("A", "Deep learning for protein structure predictions")
+    work = WORKS["deep learning for protein structure prediction"][0]
+    assert utils.score_match(item, work) < utils.DOI_MIN_SCORE
+
+
+def test_backfill(crossref):
+    items = [
+        article("A", "Deep learning for protein structure prediction", "2020", "Smith"),
+        article("B", "Editorial", "2020", "Smith"),
+        article("C", "Deep learning for protein structure prediction"),
+        article("D", "Unknown title"),
+    ]
+    rows = {row["key"]: row for row in utils.backfill_dois(items, Placeholder())}
+
+    assert rows["A"]["DOI"] == "10.1000/protein"
+    assert rows["A"]["accepted"]
+    # generic title
+    assert rows["B"]["DOI"] == "10.1000/editorial"
+    assert not rows["B"]["accepted"]
+    # title only
+    assert not rows["C"]["accepted"]
+    assert "D" not in rows
+    assert len(crossref.queries) == 4
+    assert crossref.queries[0]["rows"] == [str(utils.CROSSREF_ROWS)]
+
+
+def test_backfill_cache(crossref):
+    items = [
+        article("A", "Deep learning for protein structure prediction", "2020", "Smith")
+    ]
+    utils.backfill_dois(items, Placeholder())
+    rows = utils.backfill_dois(items, Placeholder())
+
+    assert rows[0]["accepted"]
+    assert len(crossref.queries) == 1
@@ -0,0 +1,127 @@
+"""Streaming API listener against a local websocket stand-in"""
+
+import json
+import threading
+import time
+
+import pytest
+
+import utils
+
+
+def item(key, parent=None):
+    data = {"key": key, "itemType": "journalArticle", "title": key, "tags": []}
+    if parent:
+        data.update(itemType="attachment", parentItem=parent)
+
+    return {
+        "key": key,
+        "version": 1,
+        "data": data,
+        "meta": {"numChildren": 0},
+        "links": {},
+    }
+
+
+class FakeZotero:
+    """Library at version 7: N added, c added to A, B deleted"""
+
+    library_type = "users"
+    library_id = "1"
+    api_key = "KEY"
+
+    def __init__(self):
+        self.requests = 0
+
+    def last_modified_version(self):
+        self.requests += 1
+        return 7
+
+    def item_versions(self, **kwargs):
+        return {"N": 7, "c": 7}
+
+    def deleted(self, **kwargs):
+        return {"items": ["B"]}
+
+    def items(self, itemKey, **kwargs):
+        return [item("N"), item("c", "A")]
+
+
+@pytest.fixture
+def cache():
+    cache = utils.LibraryCache()
+    cache.put(("1", "user", 5), [item("A"), item("B")], {"A": [], "B": []})
+    return cache
+
+
+@pytest.fixture
+def client(monkeypatch):
+    client = FakeZotero()
+    monkeypatch.setattr(utils, "new_client", lambda _zot: client)
+    return client
+
+
+def test_refresh_uses_own_client(cache, client):
+    session_zot = FakeZotero()
+    listener = utils.LibraryListener(cache=cache)
+    listener.subscribe(session_zot, ("1", "user"))
+
+    assert listener.refresh("/users/1", 7) == ("1", "user", 7)
+    assert client.requests == 1
+    assert session_zot.requests == 0
+
+    key, entry = cache.latest(("1", "user"))
+    assert key == ("1", "user", 7)
+    assert sorted(i["key"] for i in entry["items"]) == ["A", "N", "c"]
+    assert [c["key"] for c in entry["children"]["A"]] == ["c"]
+    assert len(cache) == 1
+    # already at this version
+    assert listener.refresh("/users/1", 7) is None
+
+
+def test_listener_with_websocket_server(cache, client):
+    websockets_sync = pytest.importorskip("websockets.sync.server")
+    pytest.importorskip("websocket")
+    received = []
+
+    def handler(connection):
+        connection.send(json.dumps({"event": "connected", "retry": 100}))
+        message = json.loads(connection.recv())
+        received.append(message)
+        topics = message["subscriptions"][0]["topics"]
+        connection.send(
+            json.dumps(
+                {"event": "subscriptionsCreated", "subscriptions": [], "errors": []}
+            )
+        )
+        for topic in topics:
+            connection.send(
+                json.dumps({"event": "topicUpdated", "topic": topic, "version": 7})
+            )
+
+        time.sleep(1)
+
+    with websockets_sync.serve(handler, "127.0.0.1", 0) as server:
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        port = server.socket.getsockname()[1]
+        listener = utils.LibraryListener(cache=cache, url=f"ws://127.0.0.1:{port}")
+        listener.subscribe(FakeZotero(), ("1", "user"))
+        listener.start()
+        deadline = time.monotonic() + 5
+        while time.monotonic() < deadline:
+            key, _ = cache.latest(("1", "user"))
+            if key[2] == 7:
+                break
+
+            time.sleep(0.05)
+
+        server.shutdown()
+
+    assert received == [
+        {
+            "action": "createSubscriptions",
+            "subscriptions": [{"apiKey": "KEY", "topics": ["/users/1"]}],
+        }
+    ]
+    assert cache.latest(("1", "user"))[0] == ("1", "user", 7)
+    assert listener.retry == 0.1
@@ -1,11 +1,43 @@
-from collections import defaultdict
+import cProfile
+import csv
+import difflib
+import gzip
+import hashlib
+import io
+import json
+import mmap
+import os
+import pstats
+import random
+import re
+import shutil
+import sqlite3
+import sys
+import threading
+import time
+import urllib.error
+import urllib.parse
+import urllib.request
+import zlib
+from collections import Counter, OrderedDict, defaultdict
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from contextlib import contextmanager
 from datetime import datetime
+from pathlib import Path
 
 import lovely_logger as logging  # type: ignore
+import numpy as np
+import pandas as pd
 import streamlit as st
+from pyzotero import zotero
 from unpywall import Unpywall  # type: ignore
 from unpywall.utils import UnpywallCredentials  # type: ignore
 
+try:
+    import websocket  # type: ignore
+except ImportError:
+    websocket = None
+
 
 def unpywall_credits(mail):
     """Setup credidentials for unpaywall
@@ -26,6 +58,14 @@ def unpywall_credits(mail):
 
 
 DATE_FMT = "%Y-%m-%dT%XZ"
+WRITE_BATCH = 50  # max objects per write request, determined by the API
+WRITE_WORKERS = 4  # concurrent update requests
+WRITE_RATE = 4  # write requests per second
+ZOTERO_API = "https://api.zotero.org"
+JOURNAL_DIR = Path(__file__).parent.absolute() / "journals"
+FULLTEXT_DIR = Path(__file__).parent.absolute() / "fulltext"
+TMP_MAX_AGE = 24 * 3600  # seconds before per-session temp files are removed
+CACHE_MAX_BYTES = int(os.environ.get("ZOTEROTIDY_CACHE_MB", 1024)) * 1024**2
 
 
 def yt_icon():
@@ -74,6 +114,198 @@ def manual():
 
         ---
 
+        **Reclaim storage**
+
+        Stored files are ranked by the bytes that can be reclaimed:
+          - copies of a file of the same item (*within*)
+          - copies of a file of another item (*across*)
+          - standalone files in no collection and without tags (*orphan*)
+        A standalone file counts as an item of its own.
+        Sizes and md5 come with the loaded items, no file is requested.
+        The selected files are deleted like duplicate pdf files.
+
+        ---
+
+        **Results**
+
+        The items of every report are shown in a table
+        that can be filtered, sorted and paged.
+        Check *Log items* to also write them in the log.
+
+        ---
+
+        Every table can be downloaded as JSONL or CSV.
+
+        ---
+
+        **Shared cache**
+
+        A fully loaded library is shared by all sessions of the app
+        as long as its version does not change.
+        The memory of the cache is bounded by `ZOTEROTIDY_CACHE_MB`
+        (default 1024). The least recently used libraries are evicted first.
+
+        ---
+
+        **Scoped loading**
+
+        Instead of the most recently modified items, load only
+        the items of a collection (by name or key, with its subcollections),
+        of a tag or of an item type, e.g. `journalArticle`.
+        The children of these items are always loaded.
+
+        ---
+
+        **Streaming analysis**
+
+        For big libraries, the reports can be computed while the pages
+        of the library are loaded. Only the rows of the reports are kept,
+        the items themselves are discarded. Write operations need a
+        loaded library.
+
+        ---
+
+        **Local database**
+
+        With the path of the `zotero.sqlite` of the desktop client
+        (or `ZOTEROTIDY_SQLITE`) the library is read from the local
+        database instead of the Web API: no network, seconds for
+        big libraries. It is opened read-only; the desktop client locks it
+        while running, so close Zotero or use a copy of the file.
+        Write operations still use the Web API and need the local library
+        to be synced.
+
+        ---
+
+        **Storage scan**
+
+        *Missing & orphaned files* lists the Zotero `storage` directory
+        (or `ZOTEROTIDY_STORAGE`) and the base directory of linked files
+        (or `ZOTEROTIDY_BASE_DIR`) in parallel and reports attachments
+        whose file is missing, files of unknown attachments (orphan) and
+        leftover files next to an imported file (stale). Orphans are only
+        reported for a whole library.
+
+        ---
+
+        **Local content hashes**
+
+        *Hash local pdf files* compares the local pdf files of all
+        attachments: files are bucketed by size, then by the md5 of their
+        first 64 KB, only the remaining candidates are hashed completely.
+        Digests are cached in `hashes/` by path, size and mtime.
+        *Compare PDF by content* uses them for linked files only; stored
+        files are compared by the md5 Zotero synced, so nothing is deleted
+        because of a stale local copy. Empty files are skipped.
+
+        ---
+
+        **Health estimate**
+
+        *Sampled health estimate* retrieves random pages of top-level items
+        (and the children of a few of them) instead of the whole library
+        and estimates the share of suspicious items, items without pdf,
+        without DOI/ISBN and with multiple pdf, with 95 % confidence intervals.
+
+        ---
+
+        **Full-text duplicates**
+
+        Items whose attachments share most of their text, e.g.
+        preprint and published version, are found by comparing
+        fingerprints of the text extracted by Zotero.
+        Only texts changed since the last run are downloaded.
+
+        ---
+
+        **Columnar analysis**
+
+        With *Columnar analysis* the loaded library is converted to a
+        table with one row per item. The reports are computed
+        on its columns, which is much faster for big libraries.
+        The table can be downloaded as Parquet file.
+
+        ---
+
+        **Tags**
+
+        Tags are indexed while loading (count, manual/automatic, colored).
+        - `old -> new` renames a tag
+        - `old1, old2 -> new` merges tags, e.g. `nopdf, no_pdf -> nopdf`
+        - tags used by less than *n* items can be pruned.
+          Colored tags are never pruned.
+
+        Items are updated in batches of 50, pruned tags are deleted
+        in one request per 50 tags.
+
+        ---
+
+        **Trash**
+
+        *Trash status* needs a single request.
+        *Trash summary* lists the trashed items by type and
+        *Empty trash* deletes them for good, 50 per request.
+
+        ---
+
+        **Write operations**
+
+        Several update options can be selected in one run.
+        Their writes are combined: an item gets its new parent and tags
+        in one update, items about to be deleted are not tagged,
+        and all deletions follow the updates in batches of 50.
+
+        ---
+
+        **Delta sync**
+
+        *Delta sync* downloads only the items changed since the library
+        was loaded and updates the reports for these items.
+        Merges and deletions made with ZoteroTidy are applied the same way.
+        With `ZOTEROTIDY_STREAM=1` (needs websocket-client) the app listens
+        to the Zotero streaming API and refreshes loaded libraries
+        in the background.
+
+        ---
+
+        **DOI backfill**
+
+        Articles without DOI are looked up in Crossref by title,
+        first author and year (4 requests at a time, answers are cached).
+        *DOI candidates* lists the best matches with their score,
+        *Backfill DOIs* writes the accepted ones: score ≥ 0.9, similar
+        titles of at least 3 words. Items without year or author need an
+        almost identical title to reach the score.
+
+        ---
+
+        **Offline open-access**
+
+        Enter the path of a downloaded Unpaywall snapshot (gzipped JSONL)
+        or set `ZOTEROTIDY_UNPAYWALL`. The first run reduces it to an index
+        in `unpaywall/`; then the open-access report needs
+        neither an email nor network.
+
+        ---
+
+        **Profiling**
+
+        Choose a phase under *Profiling* in the sidebar
+        or set `ZOTEROTIDY_PROFILE` (run, load, children, reports, writes
+        or render). The profile can be downloaded (open it e.g. with
+        snakeviz) and the slowest functions are written in the log.
+
+        ---
+
+        **Interrupted writes**
+
+        Merges and deletions are recorded in a journal before they are
+        executed. If a run dies halfway, e.g. because of a timeout,
+        it can be resumed from the sidebar or by starting the same
+        operation again.
+
+        ---
+
         **Remove duplicate pdf files**
 
         Some items have duplicate pdf files, e.g. `[file1.pdf, file1.pdf]`.
@@ -84,6 +316,13 @@ def manual():
             Nothing will be deleted if the pdf files have different names.  
         This might be the case of items, for example,
         supplementary materials nebst the actual pdf file.
+
+        With *Compare PDF by content* the files are compared by the md5
+        stored by Zotero instead of their names, e.g.
+        `[paper.pdf, paper (1).pdf]` with identical content.
+        The oldest file is kept. Nothing is downloaded.
+        With *Hash local pdf files* linked files are compared too
+        by the md5 of their local file (they have no md5 in Zotero).
         """
     )
 
@@ -162,6 +401,39 @@ def get_item(key, _items):
             return item
 
 
+def index_items(_items):
+    """Items by key
+
+    The index refers to the items, it does not copy them.
+
+    :param _items: Zotero items
+    :type _items: list of dicts
+    :returns: dict
+
+    """
+    return {item["key"]: item for item in _items}
+
+
+def items_of(keys):
+    """Items of the loaded library for a list of keys
+
+    Derived lists in the session state only hold keys.
+    Keys of items that are not loaded are skipped.
+
+    :param keys: keys of items
+    :type keys: list of str
+    :returns: list of dicts
+
+    """
+    by_key = st.session_state.items_by_key
+    return [by_key[key] for key in keys if key in by_key]
+
+
+def keys_of(_items):
+    """Keys of items"""
+    return [item["key"] for item in _items]
+
+
 def attachment_is_pdf(_child):
     """
     True if item is pdf
@@ -206,13 +478,13 @@ def get_suspecious_items(_items):
 
 
 def get_items_with_duplicate_pdf(_zot, _items):
-    """Items having several identical pdf files and their pdf files
+    """Items having several identical pdf files and the keys of their pdf files
 
     :param _zot: A Zotero instance
     :type _zot: pyzotero.zotero.Zotero
     :param _items: Zotero library items
     :type _items: list containing dicts
-    :returns: (list containing dicts, dict containing lists)
+    :returns: (list containing dicts, dict containing lists of keys)
 
     """
     _items_duplicate_attach = []
@@ -222,11 +494,11 @@ def get_items_with_duplicate_pdf(_zot, _items):
             continue
 
         key = _item["key"]
-        cs = st.session_state.children[key]
+        cs = st.session_state.children.get(key, [])
         for c in cs:
             if attachment_is_pdf(c):
                 if "filename" in c["data"]:
-                    _pdf_attachments[key].append(c["data"]["filename"])
+                    _pdf_attachments[key].append(c["key"])
                 else:
                     item_type = _item["data"]["itemType"]
                     cdata = c["data"]
@@ -238,911 +510,4735 @@ def get_items_with_duplicate_pdf(_zot, _items):
         if len(_pdf_attachments[key]) > 1:
             _items_duplicate_attach.append(_item)
 
-    return _items_duplicate_attach, _pdf_attachments
+    return _items_duplicate_attach, dict(_pdf_attachments)
 
 
-def get_items_with_no_pdf_attachments2(_items):
-    """Items with no pdf file
+def pdf_filenames(key):
+    """Filenames of the pdf files of an item with multiple pdf files
 
-    :type _items: list containing dicts
-    :returns: list containing dicts
+    :param key: key of item
+    :type key: str
+    :returns: list of str
 
     """
+    attachments = items_of(st.session_state.pdfs.get(key, []))
+    return [a["data"]["filename"] for a in attachments]
 
-    _items_without_attach = []
-    for item in _items:
-        if is_standalone(item) or is_file(item):
-            continue
 
-        if "attachment" in item["links"]:
-            attach_type = item["links"]["attachment"]["attachmentType"]
-            if attach_type != "application/pdf":
-                _items_without_attach.append(item)
+def attachment_md5(_child):
+    """md5 of the stored file of an attachment
 
-        else:
-            _items_without_attach.append(item)
+    Zotero keeps md5 and mtime of stored files in the attachment metadata.
+    Linked files have no md5.
 
-    return _items_without_attach
+    :param _child: Zotero attachment
+    :type _child: dict
+    :returns: str or None
 
+    """
+    return _child["data"].get("md5") or None
 
-# def get_items_with_no_pdf_attachments(_zot, _items):
-#     """Single Items with no attachments
 
-#     :param _zot: A Zotero instance
-#     :type _zot: pyzotero.zotero.Zotero
-#     :param _items: Zotero library items
-#     :type _items: list containing dicts
-#     :returns: list containing dicts
+def get_pdf_groups_by_md5(_items, digests=None):
+    """Pdf attachments grouped by the md5 of their files
 
-#     """
+    Children are part of the loaded items, therefore attachments of all
+    items and standalone attachments are compared. No file is downloaded.
 
-#     _items_without_attach = []
-#     for _item in _items:
-#         has_attach = False
-#         if is_standalone(_item):
-#             continue
+    :param _items: Zotero library items
+    :type _items: list containing dicts
+    :param digests: md5 of local files, used for files without stored md5
+        (linked files); the local copy of a stored file may be stale
+    :type digests: dict (key --> md5)
+    :returns: dict of lists (md5 --> attachments)
 
-#         key = _item["key"]
-#         cs = st.session_state.children[key]
-#         for c in cs:
-#             if attachment_is_pdf(c):
-#                 has_attach = True
-#                 break
+    """
+    digests = digests or {}
+    groups = defaultdict(list)
+    for _item in _items:
+        if not attachment_is_pdf(_item):
+            continue
 
-#         if not has_attach:
-#             _items_without_attach.append(_item)
+        md5 = attachment_md5(_item) or digests.get(_item["key"])
+        if md5:
+            groups[md5].append(_item)
 
-#     return _items_without_attach
+    return {md5: group for md5, group in groups.items() if len(group) > 1}
 
 
-def get_standalone_items(_items):
-    """Standalone items with no metadata (notes, pdfs, etc)
+def md5_duplicates_within_items(_groups):
+    """Identical pdf attachments of the same item
 
-    :param _items: Zotero library items
-    :type _items: list containing dicts
-    :returns: list of dicts
+    :param _groups: pdf attachments grouped by md5
+    :type _groups: dict of lists
+    :returns: dict of lists of lists (parent key --> groups of attachments)
 
     """
+    within = defaultdict(list)
+    for group in _groups.values():
+        by_parent = defaultdict(list)
+        for attachment in group:
+            parent = attachment["data"].get("parentItem")
+            if parent:
+                by_parent[parent].append(attachment)
 
-    standalone = []
-    for _item in _items:
-        if is_standalone(_item):
-            standalone.append(_item)
-
-    return standalone
+        for parent, attachments in by_parent.items():
+            if len(attachments) > 1:
+                within[parent].append(attachments)
 
+    return within
 
-def is_file(_item):
-    """Definition of a file item
 
-    :param _item: Zotero library item
-    :type _item: dict
-    :returns: True if file
+def md5_duplicates_across_items(_groups):
+    """Identical pdf attachments belonging to different items
 
-    """
-    return _item["data"]["itemType"] in ["note", "attachment", "annotation"]
+    Standalone attachments count as an item of their own.
 
+    :param _groups: pdf attachments grouped by md5
+    :type _groups: dict of lists
+    :returns: dict of lists (md5 --> attachments)
 
-# zot.item_types()
-def is_book(_item):
-    """item is book
+    """
+    across = {}
+    for md5, group in _groups.items():
+        parents = {a["data"].get("parentItem", a["key"]) for a in group}
+        if len(parents) > 1:
+            across[md5] = group
 
-    :param _item: Zotero library item
-    :type _item: dict
-    :returns: True of book or  bookSection
+    return across
 
-    """
-    return _item["data"]["itemType"] in ["book", "bookSection"]
 
+def attachment_size(_child):
+    """Size in bytes of the stored file of an attachment
 
-def is_misc(_item):
-    """item is report, thesis or document
+    Taken from the enclosure link returned with the item.
 
-    :param _item: Zotero library item
-    :type _item: dict
-    :returns: Bool
+    :param _child: Zotero attachment
+    :type _child: dict
+    :returns: int
 
     """
-    return _item["data"]["itemType"] in ["thesis", "report", "document"]
+    enclosure = _child.get("links", {}).get("enclosure", {})
+    return enclosure.get("length") or 0
 
 
-def is_article(_item):
-    """Item is an article
+def get_storage_index(_items):
+    """Stored attachment files of the library
 
-    :param _item: Zotero library item
-    :type _item: dict
-    :returns: True if conf, encyArt or journalArt
+    Only imported files count for the storage quota.
+    Linked files and links are ignored.
+
+    :param _items: Zotero library items
+    :type _items: list containing dicts
+    :returns: list of dicts
 
     """
-    return _item["data"]["itemType"] in [
-        "conferencePaper",
-        "encyclopediaArticle",
-        "journalArticle",
-    ]
+    index = []
+    for _item in _items:
+        data = _item["data"]
+        if data["itemType"] != "attachment":
+            continue
 
+        if data.get("linkMode") not in ["imported_file", "imported_url"]:
+            continue
 
-# TODO is_Standalone is often used with is_file.
-# probably replace is_standalone with is_file.
-def is_standalone(_item):
-    """Definition of a standalone item
+        index.append(
+            {
+                "key": _item["key"],
+                "parent": data.get("parentItem"),
+                "md5": attachment_md5(_item),
+                "linkMode": data["linkMode"],
+                "filename": data.get("filename", ""),
+                "size": attachment_size(_item),
+                "dateAdded": data["dateAdded"],
+                "filed": bool(data.get("collections") or data.get("tags")),
+            }
+        )
 
-    :param _item: Zotero library item
-    :type _item: dict
-    :returns: True if standalone
+    return index
 
-    """
-    # Zotero 6 write annotations in pdfs as a standalone item with parent being
-    # the pdf file!
 
-    return is_file(_item) and "parentItem" not in _item["data"]
+def get_storage_candidates(_index):
+    """Stored files that can be deleted, largest first
 
+    Files with the same md5 are duplicates: every item keeps its oldest
+    copy, the whole group keeps one copy, preferably one with a parent
+    item, then the oldest. A standalone file is an item of its own.
+    Standalone files which are not duplicates, in no collection and
+    without tags, are orphans.
 
-def retrieve_data(_zot, _num_items):
-    """Retrieve <num_items> top-level Zotero library items.
+    kind of candidate:
+    - within: other copy of a file of the same item
+    - across: copy kept by an item, the file is kept by another item
+    - orphan: unfiled standalone file
 
-    :param _zot: A Zotero instance
-    :type _zot: pyzotero.zotero.Zotero
-    :param _num_items: Number if items to retrieve
-    :type _num_items: int
+    :param _index: storage index from get_storage_index()
+    :type _index: list of dicts
     :returns: list of dicts
 
     """
-    msg = st.empty()
-    logging.info(f"retrieve_data. trying to get {_num_items} items")
-    limit = 100  # determined by the API
-    start = 0
-    lib_items = []
-    count = 1
-    step = int(limit * 100 / _num_items)
-    read_items = 0
-    my_bar = st.progress(0)
-    while read_items < _num_items:
-        progress_by = (count + 1) * step
-        count += 1
-        try:
-            lib_items.extend(_zot.items(limit=limit, start=start))
-        except Exception as e:
-            logging.error(f"Could not retrive data with error {str(e)}")
-            st.stop()
+    by_md5 = defaultdict(list)
+    for entry in _index:
+        if entry["md5"]:
+            by_md5[entry["md5"]].append(entry)
+
+    candidates = []
+    for group in by_md5.values():
+        if len(group) < 2:
+            continue
 
-        read_items += limit
-        start = start + limit
-        if _num_items - read_items < limit:
-            progress_by = 100
+        group = sorted(group, key=lambda e: (e["parent"] is None, e["dateAdded"]))
+        keep = group[0]
+        kept = {}  # item --> its kept copy
+        for entry in group:
+            owner = entry["parent"] or entry["key"]
+            if owner not in kept:
+                kept[owner] = entry
+                if entry is keep:
+                    continue
 
-        logging.info(f"read {len(lib_items)} / {_num_items} items")
-        msg.info(f"read {len(lib_items)} / {_num_items} items")
-        my_bar.progress(progress_by)
+                kind, kept_by = "across", keep
+            else:
+                kind, kept_by = "within", kept[owner]
 
-    return lib_items
+            candidates.append(dict(entry, kind=kind, keep=kept_by["key"]))
 
+    for entry in _index:
+        if entry["parent"] is None and not entry.get("filed"):
+            in_group = entry["md5"] and len(by_md5[entry["md5"]]) > 1
+            if not in_group:
+                candidates.append(dict(entry, kind="orphan", keep=None))
 
-def trash_is_empty(_zot):
-    """Is trash empty?
-    :todo: Maybe return len
-    :param _zot: A Zotero instance
-    :type _zot: pyzotero.zotero.Zotero
+    candidates.sort(key=lambda e: e["size"], reverse=True)
+    return candidates
 
-    :returns: True if empty
 
-    """
+def plan_storage_reclaim(_candidates, kinds, max_files):
+    """Attachments to delete to reclaim storage
 
-    return len(_zot.trash()) == 0
+    :param _candidates: candidates from get_storage_candidates()
+    :type _candidates: list of dicts
+    :param kinds: kinds of candidates to delete (within, across, orphan)
+    :type kinds: list of str
+    :param max_files: delete at most the <max_files> largest files
+    :type max_files: int
+    :returns: (list of dicts, int) attachments and reclaimed bytes
 
+    """
+    selected = [c for c in _candidates if c["kind"] in kinds][:max_files]
+    keys = {c["key"] for c in selected}
+    attachments = [i for i in st.session_state.zot_items if i["key"] in keys]
+    return attachments, sum(c["size"] for c in selected)
 
-def get_time(t):
-    """Time in min sec
 
-    :param t: Run time
-    :type t: float
+def get_size(num_bytes):
+    """Size in human readable units
+
+    :param num_bytes: size in bytes
+    :type num_bytes: int
     :returns: str
 
     """
+    size = float(num_bytes)
+    for unit in ["B", "KB", "MB", "GB"]:
+        if size < 1024:
+            return f"{size:.1f} {unit}"
 
-    minutes = t // 60
-    seconds = t % 60
-    return f"""{minutes:.0f} min:{seconds:.0f} sec"""
+        size /= 1024
 
+    return f"{size:.1f} TB"
 
-def duplicates_by_title(_items):
-    """Duplicate items by Title
 
-    Some items do not have DOI not ISBN.
-    This functions compares items by title
+# Local storage scan
+# Imported files live in <storage>/<attachment key>/<filename>, linked
+# files anywhere (relative to the base directory when their path starts
+# with "attachments:"). Directories are listed in batches by a thread pool,
+# one level of the tree at a time.
+ZOTERO_STORAGE = os.environ.get("ZOTEROTIDY_STORAGE", "")
+ZOTERO_BASE_DIR = os.environ.get("ZOTEROTIDY_BASE_DIR", "")
+SCAN_WORKERS = 8
+SCAN_BATCH = 256  # directories listed by a task
 
-    :todo: Similar to duplicates_by_doi.
-    :todo: Return items not titles
-    :param _items: Zotero library items
-    :type _items: list containing dicts
 
-    :returns: list of str (titles)
+def scan_directories(dirs):
+    """Files and subdirectories of some directories (not recursive)
+
+    Hidden entries (.zotero-ft-cache, ...) are skipped.
+
+    :param dirs: directories to list
+    :type dirs: list of str
+    :returns: (list of (path, size, mtime), list of subdirectories)
 
     """
-    duplicate_items_by_title = defaultdict(list)
-    duplicates = []
-    for item in _items:
-        if is_standalone(item) or is_file(item):
-            continue
+    files, subdirs = [], []
+    for directory in dirs:
+        try:
+            with os.scandir(directory) as entries:
+                for entry in entries:
+                    if entry.name.startswith("."):
+                        continue
 
-        iType = item["data"]["itemType"]
-        Title = item["data"]["title"]
-        duplicate_items_by_title[iType].append(Title.capitalize())
+                    if entry.is_dir(follow_symlinks=False):
+                        subdirs.append(entry.path)
+                    elif entry.is_file():
+                        stat = entry.stat()
+                        files.append((entry.path, stat.st_size, stat.st_mtime))
+        except OSError as e:
+            logging.warning(f"Can not list {directory}: {e}")
 
-    for _type, _titles in duplicate_items_by_title.items():
-        num_duplicates_items = len(_titles) - len(set(_titles))
-        if num_duplicates_items:
-            duplicates = {x for x in _titles if _titles.count(x) > 1}
+    return files, subdirs
 
-    return duplicates
 
+def scan_tree(roots, recursive=True, workers=SCAN_WORKERS, batch=SCAN_BATCH):
+    """Files below some directories, listed in parallel
 
-def duplicates_by_doi(_items):
-    """Duplicate items by DOI/ISBN
+    :param roots: directories to scan
+    :type roots: list of str
+    :param recursive: scan the subdirectories too
+    :type recursive: bool
+    :returns: dict path -> (size, mtime)
 
-    Items are sorted by DOI/ISBN and then duplicates
-    are returned.
+    """
+    found = {}
+    level = sorted(set(roots))
+    with ThreadPoolExecutor(workers) as pool:
+        while level:
+            subdirs = []
+            for files, dirs in pool.map(scan_directories, chunks(level, batch)):
+                found.update((path, (size, mtime)) for path, size, mtime in files)
+                subdirs.extend(dirs)
 
-    Similar to duplicates_by_title().
+            level = subdirs if recursive else []
 
-    :param _items: Zotero library items
-    :type _items: list containing dicts
-    :returns: list of dicts
+    return found
 
-    """
 
-    by_doi = get_items_by_doi_or_isbn(_items)
-    result = []
-    for _, items in by_doi.items():
-        if len(items) > 1:
-            for i in items:
-                result.append(i)
+def scan_local_files(roots, paths):
+    """Files below some directories and next to some paths
 
-    return result
+    Paths outside the scanned trees (e.g. linked files) only have their
+    directory listed.
 
+    :param roots: directories to scan recursively (empty ones are ignored)
+    :type roots: list of str
+    :param paths: files that should be found
+    :type paths: iterable of str
+    :returns: dict path -> (size, mtime)
 
-# @todo: separate doi from isbn
-# doi and issn for papers
-# isbn for books and book sections
+    """
+    roots = [d for d in roots if d and os.path.isdir(d)]
+    found = scan_tree(roots)
+    outside = {
+        os.path.dirname(path)
+        for path in paths
+        if not any(path.startswith(root + os.sep) for root in roots)
+    }
+    found.update(scan_tree(list(outside), recursive=False))
+    return found
 
 
-def _get_books_without_isbn(_items):
-    # item['data']['itemType']
-    # = book, bookSection
-    # item['data']['title']
-    return
+def attachment_path(_item, storage_dir="", base_dir=""):
+    """Local path of the file of an attachment, None if unknown
+
+    :param _item: attachment
+    :type _item: dict
+    :param storage_dir: Zotero storage directory
+    :type storage_dir: str
+    :param base_dir: base directory of relative linked files
+    :type base_dir: str
+    :returns: str or None
 
+    """
+    data = _item["data"]
+    mode = data.get("linkMode")
+    if mode in ["imported_file", "imported_url"]:
+        if not storage_dir or not data.get("filename"):
+            return None
 
-def get_items_by_isbn(_items):
-    return
+        return os.path.join(storage_dir, _item["key"], data["filename"])
 
+    if mode == "linked_file":
+        path = data.get("path", "")
+        if path.startswith("attachments:"):
+            if not base_dir:
+                return None
 
-def duplicates_by_isbn(_items):
-    return
+            path = os.path.join(base_dir, path[len("attachments:") :])
 
+        return os.path.normpath(path) if path else None
 
-def doi_to_item(dois):
-    """return items to a list of dois
+    return None
 
-    :param dois: DOI numbers
-    :type dois: list of str
-    :returns: items with DOIS
 
+def local_dir(directory):
+    """Normalized path of a given local directory, "" if not given
+
+    :raises ValueError: if the directory does not exist
     """
-    items = []
-    for doi in dois:
-        for _item in st.session_state.zot_items:
-            if is_standalone(_item) or is_file(_item):
-                continue
+    if not directory:
+        return ""
 
-            if "DOI" in _item["data"]:
-                doi_item = _item["data"]["DOI"]
-                if doi_item.lower() == doi.lower():
-                    items.append(_item)
-                    continue
+    directory = os.path.normpath(os.path.expanduser(directory))
+    if not os.path.isdir(directory):
+        raise ValueError(f"Directory {directory} does not exist")
 
-    return items
+    return directory
 
 
-def get_items_by_doi(_items):
-    """Items having a DOI
+def scan_storage(_items, storage_dir="", base_dir="", orphans=True):
+    """Attachments whose files are missing and files no attachment references
+
+    kind of row:
+    - missing: the file of the attachment is not on disk
+    - orphan: storage directory of an unknown attachment key,
+      or file of the base directory no linked file points to
+    - stale: other file in the directory of an imported file
+      (e.g. left by a rename)
+
+    Files of imported web pages (snapshots) are all referenced by
+    their attachment. Orphans only make sense for the whole library.
 
     :param _items: Zotero library items
-    :returns: dict of lists
+    :type _items: list containing dicts
+    :param storage_dir: Zotero storage directory
+    :type storage_dir: str
+    :param base_dir: base directory of relative linked files
+    :type base_dir: str
+    :param orphans: report unreferenced files too
+    :type orphans: bool
+    :returns: (list of row dicts, number of scanned files)
+    :raises ValueError: if a given directory does not exist
 
     """
+    storage_dir = local_dir(storage_dir)
+    base_dir = local_dir(base_dir)
 
-    _items_by_doi = defaultdict(list)
+    expected = {}
+    modes = {}
     for _item in _items:
-        if is_standalone(_item) or is_file(_item):
+        if _item["data"]["itemType"] != "attachment":
             continue
 
-        if "DOI" in _item["data"]:
-            doi = _item["data"]["DOI"]
-            if doi:
-                _items_by_doi[doi].append(_item)
+        modes[_item["key"]] = _item["data"].get("linkMode")
+        path = attachment_path(_item, storage_dir, base_dir)
+        if path:
+            expected[path] = _item
+
+    found = scan_local_files([storage_dir, base_dir], expected)
+
+    rows = []
+    for path, _item in expected.items():
+        if path not in found:
+            rows.append(
+                {
+                    "kind": "missing",
+                    "path": path,
+                    "size": attachment_size(_item),
+                    "key": _item["key"],
+                    "parent": _item["data"].get("parentItem"),
+                    "title": item_label(_item),
+                }
+            )
 
-    return _items_by_doi
+    if orphans:
+        for path, (size, _mtime) in found.items():
+            if path in expected:
+                continue
 
+            key = None
+            if storage_dir and path.startswith(storage_dir + os.sep):
+                key = os.path.relpath(path, storage_dir).split(os.sep)[0]
+                if modes.get(key) == "imported_url":
+                    continue
 
-def get_items_by_doi_or_isbn(_items):
-    """Items having a DOI and/or ISBN
+                kind = "stale" if key in modes else "orphan"
+            elif base_dir and path.startswith(base_dir + os.sep):
+                kind = "orphan"
+            else:
+                continue
 
-    :param _items: Zotero library items
-    :returns: dict of lists
+            rows.append(
+                {
+                    "kind": kind,
+                    "path": path,
+                    "size": size,
+                    "key": key,
+                    "parent": None,
+                    "title": "",
+                }
+            )
+
+    rows.sort(key=lambda r: (r["kind"], r["path"]))
+    return rows, len(found)
+
+
+# Local content hashes
+# Only files which may have a copy are hashed: same size, then same md5 of
+# the first HEAD_SIZE bytes, then same md5 of the whole file (memory mapped).
+# Digests are cached by path and checked against size and mtime.
+HASH_DIR = Path(__file__).parent.absolute() / "hashes"
+HASH_WORKERS = 4
+HEAD_SIZE = 64 * 1024
+
+
+def load_hash_cache():
+    """Cached digests (path --> [size, mtime, head md5, md5])"""
+    path = HASH_DIR / "digests.json"
+    if not path.exists():
+        return {}
+
+    try:
+        with open(path, encoding="utf-8") as f:
+            return json.load(f)
+    except (OSError, ValueError) as e:
+        logging.error(f"Can not read digest cache {path} with error {str(e)}")
+        return {}
+
+
+def save_hash_cache(cache):
+    """Write digests atomically"""
+    HASH_DIR.mkdir(exist_ok=True)
+    path = HASH_DIR / "digests.json"
+    tmp = path.with_suffix(".tmp")
+    with open(tmp, "w", encoding="utf-8") as f:
+        json.dump(cache, f)
+
+    tmp.replace(path)
+
+
+def head_md5(path):
+    """md5 of the first HEAD_SIZE bytes of a file"""
+    with open(path, "rb") as f:
+        return hashlib.md5(f.read(HEAD_SIZE)).hexdigest()
+
+
+def file_md5(path):
+    """md5 of a whole file, read through a memory map"""
+    with open(path, "rb") as f:
+        if os.fstat(f.fileno()).st_size == 0:
+            return hashlib.md5().hexdigest()
+
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as m:
+            return hashlib.md5(m).hexdigest()
+
+
+def cached_digests(files, cache, index, digest, workers=HASH_WORKERS):
+    """One digest of some files, from the cache or computed in parallel
+
+    :param files: path -> (size, mtime)
+    :type files: dict
+    :param cache: digest cache, updated
+    :type cache: dict
+    :param index: position of the digest in the cache entries (2: head, 3: full)
+    :type index: int
+    :param digest: function path -> digest
+    :type digest: function
+    :returns: dict path -> digest (unreadable files are left out)
 
     """
+    digests, todo = {}, []
+    for path, (size, mtime) in files.items():
+        entry = cache.get(path)
+        if entry is None or entry[0] != size or entry[1] != mtime:
+            entry = cache[path] = [size, mtime, None, None]
+
+        if entry[index]:
+            digests[path] = entry[index]
+        else:
+            todo.append(path)
 
-    _items_by_doi_isbn = defaultdict(list)
-    for _item in _items:
-        if is_standalone(_item) or is_file(_item):
-            continue
+    with ThreadPoolExecutor(workers) as pool:
+        futures = {pool.submit(digest, path): path for path in todo}
+        for future in as_completed(futures):
+            path = futures[future]
+            try:
+                digests[path] = cache[path][index] = future.result()
+            except OSError as e:
+                logging.warning(f"Can not hash {path}: {e}")
 
-        if "DOI" in _item["data"]:
-            doi = _item["data"]["DOI"]
-            if doi:
-                _items_by_doi_isbn[doi].append(_item)
+    return digests
 
-        elif "ISBN" in _item["data"]:
-            isbn = _item["data"]["ISBN"]
-            if isbn:
-                _items_by_doi_isbn[isbn].append(_item)
 
-    return _items_by_doi_isbn
+def candidate_groups(files, key):
+    """Files sharing a key with at least one other file"""
+    groups = defaultdict(list)
+    for path in files:
+        groups[key(path)].append(path)
 
+    return {
+        path: files[path]
+        for group in groups.values()
+        if len(group) > 1
+        for path in group
+    }
+
+
+def content_digests(files, workers=HASH_WORKERS):
+    """md5 of local files which may have identical copies
+
+    Files are bucketed by size, then by the md5 of their head, only
+    the remaining candidates are hashed completely. Files not larger
+    than the head are not read twice.
+
+    :param files: path -> (size, mtime)
+    :type files: dict
+    :returns: dict path -> md5
 
-def get_items_with_empty_doi_or_isbn(_items):
     """
-    Articles with no DOI. Books with no ISBN.
+    cache = load_hash_cache()
+    files = candidate_groups(files, lambda path: files[path][0])
+    heads = cached_digests(files, cache, 2, head_md5, workers)
+    files = candidate_groups(
+        {p: files[p] for p in heads}, lambda path: (files[path][0], heads[path])
+    )
+    small = {p: heads[p] for p in files if files[p][0] <= HEAD_SIZE}
+    large = {p: v for p, v in files.items() if p not in small}
+    digests = cached_digests(large, cache, 3, file_md5, workers)
+    digests.update(small)
+    save_hash_cache(cache)
+    logging.info(f"Hashed {len(heads)} heads, {len(large)} full files")
+    return digests
+
+
+def local_md5(_items, storage_dir="", base_dir=""):
+    """md5 of the local files of pdf attachments with identical copies
+
+    Imported and linked files are compared, whatever Zotero stored.
+    Empty files are skipped.
 
     :param _items: Zotero library items
     :type _items: list containing dicts
-    :return: list of dicts
-    """
+    :param storage_dir: Zotero storage directory
+    :type storage_dir: str
+    :param base_dir: base directory of relative linked files
+    :type base_dir: str
+    :returns: (dict key -> md5, dict key -> path)
+    :raises ValueError: if a given directory does not exist
 
-    empty_items = []
+    """
+    storage_dir = local_dir(storage_dir)
+    base_dir = local_dir(base_dir)
+    paths = {}
     for _item in _items:
-        if is_standalone(_item) or is_file(_item):
-            continue
+        if attachment_is_pdf(_item):
+            path = attachment_path(_item, storage_dir, base_dir)
+            if path:
+                paths[_item["key"]] = path
+
+    found = scan_local_files([storage_dir, base_dir], paths.values())
+    files = {
+        path: found[path]
+        for path in set(paths.values())
+        if path in found and found[path][0] > 0
+    }
+    digests = content_digests(files)
+    md5s = {key: digests[path] for key, path in paths.items() if path in digests}
+    counts = Counter(md5s.values())
+    md5s = {key: md5 for key, md5 in md5s.items() if counts[md5] > 1}
+    return md5s, {key: paths[key] for key in md5s}
+
+
+def local_md5_rows(md5s, paths):
+    """Report rows of the groups of identical local files, largest groups first
+
+    :param md5s: md5 of local files, see local_md5()
+    :type md5s: dict (key --> md5)
+    :param paths: local paths of the attachments
+    :type paths: dict (key --> path)
+    :returns: list of dicts
 
-        if is_article(_item):
-            _field = "DOI"
+    """
+    groups = defaultdict(list)
+    for key, md5 in md5s.items():
+        groups[md5].append(key)
+
+    rows = []
+    for md5, keys in groups.items():
+        attachments = items_of(keys)
+        rows.append(
+            {
+                "md5": md5,
+                "files": len(keys),
+                "items": len(
+                    {a["data"].get("parentItem", a["key"]) for a in attachments}
+                ),
+                "keys": str(keys),
+                "paths": str([paths[key] for key in keys]),
+            }
+        )
 
-        elif is_book(_item):
-            _field = "ISBN"
+    rows.sort(key=lambda r: r["files"], reverse=True)
+    return rows
 
-        elif is_misc(_item):
-            logging.warning(f"Misc {_item['data']['itemType']}")
+
+def get_items_with_no_pdf_attachments2(_items):
+    """Items with no pdf file
+
+    :type _items: list containing dicts
+    :returns: list containing dicts
+
+    """
+
+    _items_without_attach = []
+    for item in _items:
+        if is_standalone(item) or is_file(item):
             continue
+
+        if "attachment" in item["links"]:
+            attach_type = item["links"]["attachment"]["attachmentType"]
+            if attach_type != "application/pdf":
+                _items_without_attach.append(item)
+
         else:
-            logging.warning(f"Type of item not known {_item['data']['itemType']}")
-            st.warning(f"Type of item not known {_item['data']['itemType']}")
-            continue
+            _items_without_attach.append(item)
 
-        if _field in _item["data"]:
-            if not _item["data"][_field]:
-                empty_items.append(_item)
+    return _items_without_attach
 
-    return empty_items
 
+# def get_items_with_no_pdf_attachments(_zot, _items):
+#     """Single Items with no attachments
+
+#     :param _zot: A Zotero instance
+#     :type _zot: pyzotero.zotero.Zotero
+#     :param _items: Zotero library items
+#     :type _items: list containing dicts
+#     :returns: list containing dicts
+
+#     """
+
+#     _items_without_attach = []
+#     for _item in _items:
+#         has_attach = False
+#         if is_standalone(_item):
+#             continue
+
+#         key = _item["key"]
+#         cs = st.session_state.children[key]
+#         for c in cs:
+#             if attachment_is_pdf(c):
+#                 has_attach = True
+#                 break
+
+#         if not has_attach:
+#             _items_without_attach.append(_item)
+
+#     return _items_without_attach
 
-def get_items_with_empty_doi_and_isbn(_items, _fields):
-    """
-    Items with no DOI and no ISBN.
+
+def get_standalone_items(_items):
+    """Standalone items with no metadata (notes, pdfs, etc)
 
     :param _items: Zotero library items
     :type _items: list containing dicts
-    :param _fields: DOI and ISBN
-    :type _fields: list of str
-    :return: list of dict
+    :returns: list of dicts
 
     """
-    empty = []
+
+    standalone = []
     for _item in _items:
-        result = []
-        if is_standalone(_item) or is_file(_item):
-            continue
+        if is_standalone(_item):
+            standalone.append(_item)
 
-        for field in _fields:
-            if field in _item["data"]:
-                f = _item["data"][field]
-                if not f:
-                    result.append(False)
-                else:
-                    result.append(True)
+    return standalone
+
+
+def is_file(_item):
+    """Definition of a file item
+
+    :param _item: Zotero library item
+    :type _item: dict
+    :returns: True if file
+
+    """
+    return _item["data"]["itemType"] in ["note", "attachment", "annotation"]
+
+
+# zot.item_types()
+def is_book(_item):
+    """item is book
+
+    :param _item: Zotero library item
+    :type _item: dict
+    :returns: True of book or  bookSection
+
+    """
+    return _item["data"]["itemType"] in ["book", "bookSection"]
+
+
+def is_misc(_item):
+    """item is report, thesis or document
+
+    :param _item: Zotero library item
+    :type _item: dict
+    :returns: Bool
+
+    """
+    return _item["data"]["itemType"] in ["thesis", "report", "document"]
+
+
+def is_article(_item):
+    """Item is an article
+
+    :param _item: Zotero library item
+    :type _item: dict
+    :returns: True if conf, encyArt or journalArt
+
+    """
+    return _item["data"]["itemType"] in [
+        "conferencePaper",
+        "encyclopediaArticle",
+        "journalArticle",
+    ]
+
+
+# TODO is_Standalone is often used with is_file.
+# probably replace is_standalone with is_file.
+def is_standalone(_item):
+    """Definition of a standalone item
+
+    :param _item: Zotero library item
+    :type _item: dict
+    :returns: True if standalone
+
+    """
+    # Zotero 6 write annotations in pdfs as a standalone item with parent being
+    # the pdf file!
+
+    return is_file(_item) and "parentItem" not in _item["data"]
+
+
+PAGE_SIZE = 100  # determined by the API
+PAGE_RETRIES = 5
+BACKOFF_BASE = 1  # seconds
+BACKOFF_MAX = 60  # seconds
+
+
+def backoff_delay(attempt, base=BACKOFF_BASE, cap=BACKOFF_MAX):
+    """Exponential backoff with full jitter
+
+    :param attempt: number of failed attempts so far (0 for the first)
+    :type attempt: int
+    :returns: float (seconds)
+
+    """
+    return random.uniform(0, min(cap, base * 2**attempt))
+
+
+def fetch_page(_zot, start, limit=PAGE_SIZE, retries=PAGE_RETRIES, what="items"):
+    """One page of the most recently modified library items
+
+    Failed requests are retried with jittered exponential backoff.
+    The last error is raised.
+
+    :param _zot: A Zotero instance
+    :type _zot: pyzotero.zotero.Zotero
+    :param start: offset of the page
+    :type start: int
+    :param limit: items per page
+    :type limit: int
+    :param retries: retries after the first attempt
+    :type retries: int
+    :param what: "items" or "top" (top-level items)
+    :type what: str
+    :returns: list of dicts
+
+    """
+    for attempt in range(retries + 1):
+        try:
+            return getattr(_zot, what)(limit=limit, start=start)
+        except Exception as e:
+            if attempt == retries:
+                raise
+
+            delay = backoff_delay(attempt)
+            logging.warning(
+                f"Page at {start} failed ({str(e)}), retry {attempt + 1} / {retries} in {delay:.1f} s"
+            )
+            time.sleep(delay)
+
+
+def retrieve_data(_zot, _num_items):
+    """Retrieve <num_items> top-level Zotero library items.
+
+    Downloaded pages are kept in st.session_state.partial_load.
+    If pages fail after all retries, the missing pages are reported
+    and the next load of the same library version resumes from them.
+
+    :param _zot: A Zotero instance
+    :type _zot: pyzotero.zotero.Zotero
+    :param _num_items: Number if items to retrieve
+    :type _num_items: int
+    :returns: list of dicts
+
+    """
+    msg = st.empty()
+    logging.info(f"retrieve_data. trying to get {_num_items} items")
+    partial = st.session_state.partial_load
+    load_id = (st.session_state.zot_version, _num_items)
+    if partial is None or partial["id"] != load_id:
+        partial = {"id": load_id, "pages": {}}
+        st.session_state.partial_load = partial
+    else:
+        logging.info(f"Resume loading, {len(partial['pages'])} pages kept")
+
+    pages = partial["pages"]
+    missing = []
+    my_bar = st.progress(0)
+    for start in range(0, _num_items, PAGE_SIZE):
+        if start in pages:
+            continue
+
+        try:
+            page = fetch_page(_zot, start)
+        except Exception as e:
+            logging.error(f"Could not retrieve page at {start} with error {str(e)}")
+            missing.append(start)
+            continue
+
+        pages[start] = page
+        read = sum(len(p) for p in pages.values())
+        logging.info(f"read {read} / {_num_items} items")
+        msg.info(f"read {read} / {_num_items} items")
+        my_bar.progress(min(100, int(read * 100 / _num_items)))
+        if len(page) < PAGE_SIZE:
+            break
+
+    if missing:
+        ranges = ", ".join(f"{s + 1}-{min(s + PAGE_SIZE, _num_items)}" for s in missing)
+        logging.error(f"Missing pages (items {ranges})")
+        msg.error(
+            f""":fire: Could not retrieve {len(missing)} pages (items {ranges}).
+            Load again to retrieve only the missing pages."""
+        )
+        st.stop()
+
+    st.session_state.partial_load = None
+    my_bar.progress(100)
+    return [item for start in sorted(pages) for item in pages[start]]
+
+
+def iter_pages(_zot, _num_items):
+    """Pages of the <num_items> most recently modified library items
+
+    :param _zot: A Zotero instance
+    :type _zot: pyzotero.zotero.Zotero
+    :param _num_items: Number if items to retrieve
+    :type _num_items: int
+    :returns: generator of lists of dicts
+
+    """
+    start = 0
+    while start < _num_items:
+        page = fetch_page(_zot, start)
+        if not page:
+            return
+
+        yield page
+        start = start + PAGE_SIZE
+
+
+def collect_rows(select):
+    """Analyzer keeping the report rows of the items selected in each page
+
+    Analyzers are coroutines: send a page and get the results so far
+    and the running number of report rows.
+    Only rows are kept, the raw items are discarded.
+
+    :param select: function returning the items of a page to report
+    :type select: callable
+    :returns: generator
+
+    """
+    rows = {}
+    while True:
+        page = yield rows, len(rows)
+        for item in select(page):
+            rows[item["key"]] = item_row(item)
+
+
+def collect_identifiers():
+    """Analyzer keeping the rows of items by DOI/ISBN
+
+    :returns: generator
+
+    """
+    by_id = defaultdict(list)
+    num_rows = 0  # rows of identifiers with several items
+    while True:
+        page = yield by_id, num_rows
+        for identifier, items in get_items_by_doi_or_isbn(page).items():
+            rows = by_id[identifier]
+            before = len(rows) if len(rows) > 1 else 0
+            rows.extend(item_row(item) for item in items)
+            if len(rows) > 1:
+                num_rows += len(rows) - before
+
+
+def count_pdf_children():
+    """Analyzer counting pdf attachments per parent item
+
+    :returns: generator
+
+    """
+    counts = Counter()
+    num_rows = 0  # parents with several pdf
+    while True:
+        page = yield counts, num_rows
+        for item in page:
+            if attachment_is_pdf(item) and "parentItem" in item["data"]:
+                parent = item["data"]["parentItem"]
+                counts[parent] += 1
+                if counts[parent] == 2:
+                    num_rows += 1
+
+
+def streaming_analyzers():
+    """Primed analyzers of the streaming analysis"""
+    analyzers = {
+        "Suspecious items": collect_rows(get_suspecious_items),
+        "Standalone items": collect_rows(get_standalone_items),
+        "Items with no pdf attachments": collect_rows(
+            get_items_with_no_pdf_attachments2
+        ),
+        "Items with no doi / isbn": collect_rows(get_items_with_empty_doi_or_isbn),
+        "Duplicate items": collect_identifiers(),
+        "Items with multiple pdf files": count_pdf_children(),
+    }
+    for analyzer in analyzers.values():
+        next(analyzer)
+
+    return analyzers
+
+
+def streaming_reports(results):
+    """Report rows from the results of the analyzers
+
+    :param results: results of streaming_analyzers() by name
+    :type results: dict
+    :returns: dict of lists of dicts
+
+    """
+    reports = {}
+    for name, result in results.items():
+        if name == "Duplicate items":
+            reports[name] = [
+                dict(row, identifier=identifier)
+                for identifier, rows in result.items()
+                if len(rows) > 1
+                for row in rows
+            ]
+        elif name == "Items with multiple pdf files":
+            reports[name] = [
+                {"key": key, "pdfs": count}
+                for key, count in result.items()
+                if count > 1
+            ]
+        else:
+            reports[name] = list(result.values())
+
+    return reports
+
+
+def stream_analysis(_zot, _num_items, pl):
+    """Analyze the library page by page without keeping the items
+
+    Provisional counts are shown while pages are loaded.
+
+    :param _zot: A Zotero instance
+    :type _zot: pyzotero.zotero.Zotero
+    :param _num_items: Number if items to retrieve
+    :type _num_items: int
+    :param pl: placeholder to print provisional counts
+    :type pl: st.empty()
+    :returns: dict of lists of dicts (rows of reports)
+
+    """
+    logging.info(f"stream_analysis of {_num_items} items")
+    analyzers = streaming_analyzers()
+    results = {}
+    read_items = 0
+    my_bar = st.progress(0)
+    try:
+        for page in iter_pages(_zot, _num_items):
+            counts = {}
+            for name, analyzer in analyzers.items():
+                results[name], counts[name] = analyzer.send(page)
+
+            read_items += len(page)
+            summary = "\n".join(f"- {name}: {n}" for name, n in counts.items())
+            pl.info(f"read {read_items} / {_num_items} items\n{summary}")
+            my_bar.progress(min(100, int(read_items * 100 / _num_items)))
+    except Exception as e:
+        logging.error(f"Could not retrive data with error {str(e)}")
+        st.stop()
+
+    my_bar.progress(100)
+    return streaming_reports(results)
+
+
+# Sampled health estimate
+# Random pages of top-level items are clusters of a one-stage cluster sample.
+# Rates are ratio estimates with a normal confidence interval
+# (Wilson's interval if there are too few pages).
+SAMPLE_PAGES = 20
+CHILDREN_SAMPLE = 30  # items whose children are retrieved for multiple pdfs
+CONFIDENCE_Z = 1.96  # 95 %
+
+
+def wilson_interval(hits, n, z=CONFIDENCE_Z):
+    """Wilson score interval of a proportion
+
+    :returns: (low, high)
+
+    """
+    if not n:
+        return 0.0, 1.0
+
+    p = hits / n
+    denominator = 1 + z**2 / n
+    center = (p + z**2 / (2 * n)) / denominator
+    margin = z * (p * (1 - p) / n + z**2 / (4 * n**2)) ** 0.5 / denominator
+    return max(0.0, center - margin), min(1.0, center + margin)
+
+
+def ratio_estimate(hits, sizes, num_clusters, z=CONFIDENCE_Z):
+    """Rate and confidence interval from a cluster sample
+
+    :param hits: matching items per sampled cluster
+    :type hits: list of int
+    :param sizes: items per sampled cluster
+    :type sizes: list of int
+    :param num_clusters: number of clusters in the population
+    :type num_clusters: int
+    :returns: (rate, low, high)
+
+    """
+    n, total = len(sizes), sum(sizes)
+    if not total:
+        return 0.0, 0.0, 1.0
+
+    rate = sum(hits) / total
+    if n < 2:
+        return (rate,) + wilson_interval(sum(hits), total, z)
+
+    mean_size = total / n
+    fpc = max(0.0, 1 - n / num_clusters)
+    residuals = sum((y - rate * m) ** 2 for y, m in zip(hits, sizes)) / (n - 1)
+    margin = z * (fpc * residuals / n) ** 0.5 / mean_size
+    return rate, max(0.0, rate - margin), min(1.0, rate + margin)
+
+
+def multiple_pdf(_children):
+    """True if more than one child is a stored pdf file"""
+    pdfs = [c for c in _children if attachment_is_pdf(c) and "filename" in c["data"]]
+    return len(pdfs) > 1
+
+
+def estimate_health(_zot, num_pages=SAMPLE_PAGES, pl=None):
+    """Estimate the rates of the reports from random pages of top-level items
+
+    Suspecious items, items without pdf and empty DOI/ISBN are evaluated on
+    all sampled items (cluster ratio estimate).
+    Multiple pdfs need the children, so they are retrieved for
+    a random subsample of at most CHILDREN_SAMPLE items (Wilson interval).
+
+    :param _zot: A Zotero instance
+    :type _zot: pyzotero.zotero.Zotero
+    :param num_pages: pages of 100 items to sample
+    :type num_pages: int
+    :param pl: placeholder to print progress
+    :type pl: st.empty()
+    :returns: list of dicts (report rows)
+
+    """
+    _zot.top(limit=1)
+    num_top = total_results(_zot)
+    starts = list(range(0, num_top, PAGE_SIZE))
+    sample = sorted(random.sample(starts, min(num_pages, len(starts))))
+    pages = []
+    for i, start in enumerate(sample):
+        if pl is not None:
+            pl.info(f"Sampling page {i + 1} / {len(sample)}")
+
+        pages.append(fetch_page(_zot, start, what="top"))
+
+    checks = {
+        "Suspecious items": get_suspecious_items,
+        "Items with no pdf attachments": get_items_with_no_pdf_attachments2,
+        "Items with no doi / isbn": get_items_with_empty_doi_or_isbn,
+    }
+    sizes = [len(page) for page in pages]
+    rows = []
+    for name, select in checks.items():
+        hits = [len(select(page)) for page in pages]
+        rate, low, high = ratio_estimate(hits, sizes, len(starts))
+        rows.append(
+            {
+                "report": name,
+                "sampled": sum(sizes),
+                "found": sum(hits),
+                "rate": round(rate, 4),
+                "low": round(low, 4),
+                "high": round(high, 4),
+                "estimated items": round(rate * num_top),
+            }
+        )
+
+    parents = [
+        i for page in pages for i in page if not (is_standalone(i) or is_file(i))
+    ]
+    subsample = random.sample(parents, min(CHILDREN_SAMPLE, len(parents)))
+    hits = sum(multiple_pdf(_zot.children(i["key"])) for i in subsample)
+    rate = hits / len(subsample) if subsample else 0.0
+    low, high = wilson_interval(hits, len(subsample))
+    rows.append(
+        {
+            "report": "Items with multiple pdf",
+            "sampled": len(subsample),
+            "found": hits,
+            "rate": round(rate, 4),
+            "low": round(low, 4),
+            "high": round(high, 4),
+            "estimated items": round(rate * num_top),
+        }
+    )
+    logging.info(
+        f"Health estimate from {len(sample)} / {len(starts)} pages and {len(subsample)} children requests"
+    )
+    return rows
+
+
+SCOPES = ["Library", "Collection", "Tag", "Item type"]
+
+
+def collection_keys(_collections, value, subcollections=True):
+    """Keys of a collection given by key or name and of its subcollections
+
+    :param _collections: all collections of the library
+    :type _collections: list of dicts
+    :param value: key or name of collection
+    :type value: str
+    :param subcollections: include subcollections (recursively)
+    :type subcollections: bool
+    :returns: list of str
+
+    """
+    keys = [c["key"] for c in _collections if value in [c["key"], c["data"]["name"]]]
+    if not subcollections:
+        return keys
+
+    children = defaultdict(list)
+    for c in _collections:
+        parent = c["data"].get("parentCollection")
+        if parent:
+            children[parent].append(c["key"])
+
+    result = []
+    stack = list(keys)
+    while stack:
+        key = stack.pop()
+        if key in result:
+            continue
+
+        result.append(key)
+        stack.extend(children[key])
+
+    return result
+
+
+def retrieve_scoped_data(_zot, scope, value, subcollections=True):
+    """Retrieve top-level items of a collection, tag or item type
+    and all their children
+
+    The filters are applied by the server.
+    Children are fetched for every parent with children,
+    so they are never missing.
+
+    :param _zot: A Zotero instance
+    :type _zot: pyzotero.zotero.Zotero
+    :param scope: one of SCOPES except Library
+    :type scope: str
+    :param value: collection key or name, tag or item type
+    :type value: str
+    :param subcollections: include subcollections of a collection
+    :type subcollections: bool
+    :returns: list of dicts
+
+    """
+    msg = st.empty()
+    logging.info(f"retrieve_scoped_data. {scope}: {value}")
+    limit = 100  # determined by the API
+    try:
+        if scope == "Collection":
+            collections = _zot.everything(_zot.collections(limit=limit))
+            keys = collection_keys(collections, value, subcollections)
+            if not keys:
+                st.error(f"Collection <{value}> not found.")
+                st.stop()
+
+            parents = []
+            for key in keys:
+                parents.extend(
+                    _zot.everything(_zot.collection_items_top(key, limit=limit))
+                )
+
+        elif scope == "Tag":
+            parents = _zot.everything(_zot.top(tag=value, limit=limit))
+        else:
+            parents = _zot.everything(_zot.top(itemType=value, limit=limit))
+    except Exception as e:
+        logging.error(f"Could not retrive data with error {str(e)}")
+        st.stop()
+
+    # a parent may be in several subcollections
+    parents = list(index_items(parents).values())
+    with_children = [p for p in parents if p["meta"].get("numChildren")]
+    msg.info(f"read {len(parents)} items. Fetch children of {len(with_children)} items")
+    lib_items = list(parents)
+    my_bar = st.progress(0)
+    for i, parent in enumerate(with_children):
+        try:
+            lib_items.extend(_zot.everything(_zot.children(parent["key"], limit=limit)))
+        except Exception as e:
+            logging.error(f"Could not retrive children with error {str(e)}")
+            st.stop()
+
+        my_bar.progress((i + 1) / len(with_children))
+
+    logging.info(
+        f"read {len(parents)} items and {len(lib_items) - len(parents)} children"
+    )
+    msg.info(f"read {len(parents)} items and {len(lib_items) - len(parents)} children")
+    return lib_items
+
+
+# Local Zotero database
+# The desktop client keeps the library in zotero.sqlite. It is opened
+# read-only and mapped to the structures of the Web API. A running client
+# locks the database: close it or read a copy. Writes always go through
+# the Web API.
+ZOTERO_SQLITE = os.environ.get("ZOTEROTIDY_SQLITE", "")
+LINK_MODES = [
+    "imported_file",
+    "imported_url",
+    "linked_file",
+    "linked_url",
+    "embedded_image",
+]
+FILE_LINK_MODES = ["imported_file", "imported_url", "linked_file"]
+# dates stored as "2019-00-00 2019": SQL date and the date as entered
+MULTIPART_FIELDS = ["date", "dateDecided", "dateEnacted", "filingDate", "issueDate"]
+
+
+def api_date(value):
+    """Date of the database (2020-01-31 12:00:00) as in the API"""
+    return value.replace(" ", "T") + "Z" if value else ""
+
+
+def api_field(field, value):
+    """Value of a field of the database as in the API
+
+    Multipart dates keep the date as entered, accessDate is in UTC.
+    """
+    if not isinstance(value, str):
+        return value
+
+    if field in MULTIPART_FIELDS:
+        multipart = re.match(r"\d{4}-\d{2}-\d{2} (.*)", value, re.S)
+        return multipart.group(1) if multipart else value
+
+    if field == "accessDate":
+        return api_date(value)
+
+    return value
+
+
+def sqlite_library_id(con, library_type, library_id):
+    """libraryID of a user or group library in zotero.sqlite"""
+    if library_type.startswith("group"):
+        row = con.execute(
+            "SELECT libraryID FROM groups WHERE groupID = ?", (library_id,)
+        ).fetchone()
+    else:
+        row = con.execute(
+            "SELECT libraryID FROM libraries WHERE type = 'user'"
+        ).fetchone()
+
+    if row is None:
+        raise ValueError(f"Library {library_type} {library_id} not in database")
+
+    return row[0]
+
+
+def read_zotero_sqlite(path, library_type, library_id):
+    """Items and children of a library from a local zotero.sqlite
+
+    Items are shaped like the items of the Web API (data, meta, links),
+    most recently modified first. Trashed items are left out.
+    The database must not be in use (close the client or read a copy).
+
+    :param path: zotero.sqlite of the desktop client
+    :type path: str or Path
+    :param library_type: user or group
+    :type library_type: str
+    :param library_id: user or group ID of the Web API
+    :type library_id: int
+    :returns: (list of dicts, dict of lists, int library version)
+
+    """
+    con = sqlite3.connect(f"file:{Path(path).as_posix()}?mode=ro", uri=True)
+    try:
+        lib = sqlite_library_id(con, library_type, library_id)
+        version = con.execute(
+            "SELECT version FROM libraries WHERE libraryID = ?", (lib,)
+        ).fetchone()[0]
+        type_fields = defaultdict(list)
+        for type_name, field in con.execute(
+            """SELECT t.typeName, f.fieldName FROM itemTypeFields
+            JOIN itemTypes t USING (itemTypeID) JOIN fields f USING (fieldID)
+            ORDER BY orderIndex"""
+        ):
+            type_fields[type_name].append(field)
+
+        in_lib = "JOIN items i USING (itemID) WHERE i.libraryID = ?"
+        rows = con.execute(
+            """SELECT itemID, key, version, typeName, dateAdded, dateModified
+            FROM items JOIN itemTypes USING (itemTypeID)
+            WHERE libraryID = ? AND itemID NOT IN (SELECT itemID FROM deletedItems)
+            ORDER BY dateModified DESC""",
+            (lib,),
+        ).fetchall()
+        keys = {row[0]: row[1] for row in rows}
+        data = {}
+        for item_id, key, item_version, type_name, added, modified in rows:
+            data[item_id] = dict(
+                {"key": key, "version": item_version, "itemType": type_name},
+                **{field: "" for field in type_fields[type_name]},
+                creators=[],
+                tags=[],
+                collections=[],
+                relations={},
+                dateAdded=api_date(added),
+                dateModified=api_date(modified),
+            )
+            if type_name in FILE_TYPES:
+                del data[item_id]["creators"]
+
+        for item_id, field, value in con.execute(
+            f"""SELECT itemID, f.fieldName, v.value FROM itemData
+            JOIN fields f USING (fieldID) JOIN itemDataValues v USING (valueID)
+            {in_lib}""",
+            (lib,),
+        ):
+            if item_id in data:
+                data[item_id][field] = api_field(field, value)
+
+        for item_id, creator_type, first, last, mode in con.execute(
+            f"""SELECT itemID, ct.creatorType, c.firstName, c.lastName, c.fieldMode
+            FROM itemCreators JOIN creators c USING (creatorID)
+            JOIN creatorTypes ct USING (creatorTypeID)
+            {in_lib} ORDER BY itemID, orderIndex""",
+            (lib,),
+        ):
+            if item_id not in data:
+                continue
+
+            creator = {"creatorType": creator_type}
+            if mode == 1:
+                creator["name"] = last
+            else:
+                creator.update(firstName=first, lastName=last)
+
+            data[item_id]["creators"].append(creator)
+
+        for item_id, name, tag_type in con.execute(
+            f"""SELECT itemID, t.name, itemTags.type FROM itemTags
+            JOIN tags t USING (tagID) {in_lib}""",
+            (lib,),
+        ):
+            if item_id in data:
+                tag = {"tag": name, "type": 1} if tag_type == 1 else {"tag": name}
+                data[item_id]["tags"].append(tag)
+
+        for item_id, collection in con.execute(
+            f"""SELECT itemID, c.key FROM collectionItems
+            JOIN collections c USING (collectionID) {in_lib}""",
+            (lib,),
+        ):
+            if item_id in data:
+                data[item_id]["collections"].append(collection)
+
+        parents = {}
+        for (
+            item_id,
+            parent,
+            link_mode,
+            content_type,
+            file_path,
+            md5,
+            mtime,
+        ) in con.execute(
+            f"""SELECT itemID, parentItemID, linkMode, contentType, path,
+            storageHash, storageModTime FROM itemAttachments {in_lib}""",
+            (lib,),
+        ):
+            if item_id not in data:
+                continue
+
+            parents[item_id] = parent
+            mode = LINK_MODES[link_mode] if link_mode < len(LINK_MODES) else ""
+            attachment = {"linkMode": mode, "contentType": content_type or ""}
+            if file_path and file_path.startswith("storage:"):
+                attachment["filename"] = file_path[len("storage:") :]
+            elif file_path and mode == "linked_file":
+                attachment["path"] = file_path
+                attachment["filename"] = Path(file_path).name
+
+            if md5:
+                attachment.update(md5=md5, mtime=mtime)
+
+            data[item_id].update(attachment)
+
+        for item_id, parent, note in con.execute(
+            f"SELECT itemID, parentItemID, note FROM itemNotes {in_lib}", (lib,)
+        ):
+            if item_id in data:
+                parents[item_id] = parent
+                data[item_id]["note"] = note or ""
+
+        has_annotations = con.execute(
+            "SELECT 1 FROM sqlite_master WHERE name = 'itemAnnotations'"
+        ).fetchone()
+        if has_annotations:
+            for item_id, parent in con.execute(
+                f"SELECT itemID, parentItemID FROM itemAnnotations {in_lib}", (lib,)
+            ):
+                parents[item_id] = parent
+    finally:
+        con.close()
+
+    items = []
+    children_of = defaultdict(list)
+    for item_id, _, _, _, _, _ in rows:
+        parent = parents.get(item_id)
+        if parent in keys:
+            data[item_id]["parentItem"] = keys[parent]
+
+        _item = {
+            "key": keys[item_id],
+            "version": data[item_id]["version"],
+            "library": {"type": library_type, "id": library_id},
+            "links": {},
+            "meta": {},
+            "data": data[item_id],
+        }
+        items.append(_item)
+        if parent in data and data[item_id]["itemType"] != "annotation":
+            children_of[parent].append(_item)
+
+    # children, numChildren and best attachment of regular items as in the API
+    children = {}
+    for item_id, _item in zip(keys, items):
+        if is_file(_item):
+            continue
+
+        cs = children_of.get(item_id, [])
+        children[_item["key"]] = cs
+        _item["meta"]["numChildren"] = len(cs)
+        files = [c for c in cs if c["data"].get("linkMode") in FILE_LINK_MODES]
+        pdfs = [c for c in files if c["data"]["contentType"] == "application/pdf"]
+        if files:
+            best = (pdfs or files)[0]
+            _item["links"]["attachment"] = {
+                "attachmentType": best["data"]["contentType"]
+            }
+
+    logging.info(f"Read {len(items)} items of library {lib} from {path}")
+    return items, children, version
+
+
+def total_results(_zot):
+    """Total number of results of the last request
+
+    Read from the Total-Results header of the response.
+
+    :param _zot: A Zotero instance
+    :type _zot: pyzotero.zotero.Zotero
+    :returns: int
+
+    """
+    return int(_zot.request.headers.get("Total-Results", 0))
+
+
+def trash_count(_zot):
+    """Number of items in the trash
+
+    Only one item is downloaded, the number comes from the response header.
+
+    :param _zot: A Zotero instance
+    :type _zot: pyzotero.zotero.Zotero
+    :returns: int
+
+    """
+    _zot.trash(limit=1)
+    return total_results(_zot)
+
+
+def get_trash(_zot):
+    """Items in the trash
+
+    :param _zot: A Zotero instance
+    :type _zot: pyzotero.zotero.Zotero
+    :returns: list of dicts
+
+    """
+    limit = 100  # determined by the API
+    return _zot.everything(_zot.trash(limit=limit))
+
+
+def trash_summary(_trash):
+    """Number of trashed items by item type
+
+    :param _trash: items in the trash
+    :type _trash: list of dicts
+    :returns: list of dicts (report rows)
+
+    """
+    counts = Counter(item["data"]["itemType"] for item in _trash)
+    return [{"itemType": t, "count": n} for t, n in counts.most_common()]
+
+
+def get_time(t):
+    """Time in min sec
+
+    :param t: Run time
+    :type t: float
+    :returns: str
+
+    """
+
+    minutes = t // 60
+    seconds = t % 60
+    return f"""{minutes:.0f} min:{seconds:.0f} sec"""
+
+
+def duplicates_by_title(_items):
+    """Duplicate items by Title
+
+    Some items do not have DOI not ISBN.
+    This functions compares items by title
+
+    :todo: Similar to duplicates_by_doi.
+    :todo: Return items not titles
+    :param _items: Zotero library items
+    :type _items: list containing dicts
+
+    :returns: list of str (titles)
+
+    """
+    duplicate_items_by_title = defaultdict(list)
+    duplicates = []
+    for item in _items:
+        if is_standalone(item) or is_file(item):
+            continue
+
+        iType = item["data"]["itemType"]
+        Title = item["data"]["title"]
+        duplicate_items_by_title[iType].append(Title.capitalize())
+
+    for _type, _titles in duplicate_items_by_title.items():
+        num_duplicates_items = len(_titles) - len(set(_titles))
+        if num_duplicates_items:
+            duplicates = {x for x in _titles if _titles.count(x) > 1}
+
+    return duplicates
+
+
+def duplicates_by_doi(_items):
+    """Duplicate items by DOI/ISBN
+
+    Items are sorted by DOI/ISBN and then duplicates
+    are returned.
+
+    Similar to duplicates_by_title().
+
+    :param _items: Zotero library items
+    :type _items: list containing dicts
+    :returns: list of dicts
+
+    """
+
+    by_doi = get_items_by_doi_or_isbn(_items)
+    result = []
+    for _, items in by_doi.items():
+        if len(items) > 1:
+            for i in items:
+                result.append(i)
+
+    return result
+
+
+# @todo: separate doi from isbn
+# doi and issn for papers
+# isbn for books and book sections
+
+
+def _get_books_without_isbn(_items):
+    # item['data']['itemType']
+    # = book, bookSection
+    # item['data']['title']
+    return
+
+
+def get_items_by_isbn(_items):
+    return
+
+
+def duplicates_by_isbn(_items):
+    return
+
+
+def doi_to_item(dois):
+    """return items to a list of dois
+
+    :param dois: DOI numbers
+    :type dois: list of str
+    :returns: items with DOIS
+
+    """
+    items = []
+    for doi in dois:
+        for _item in st.session_state.zot_items:
+            if is_standalone(_item) or is_file(_item):
+                continue
+
+            if "DOI" in _item["data"]:
+                doi_item = _item["data"]["DOI"]
+                if doi_item.lower() == doi.lower():
+                    items.append(_item)
+                    continue
+
+    return items
+
+
+def get_items_by_doi(_items):
+    """Items having a DOI
+
+    :param _items: Zotero library items
+    :returns: dict of lists
+
+    """
+
+    _items_by_doi = defaultdict(list)
+    for _item in _items:
+        if is_standalone(_item) or is_file(_item):
+            continue
+
+        if "DOI" in _item["data"]:
+            doi = _item["data"]["DOI"]
+            if doi:
+                _items_by_doi[doi].append(_item)
+
+    return _items_by_doi
+
+
+def get_items_by_doi_or_isbn(_items):
+    """Items having a DOI and/or ISBN
+
+    :param _items: Zotero library items
+    :returns: dict of lists
+
+    """
+
+    _items_by_doi_isbn = defaultdict(list)
+    for _item in _items:
+        if is_standalone(_item) or is_file(_item):
+            continue
+
+        if "DOI" in _item["data"]:
+            doi = _item["data"]["DOI"]
+            if doi:
+                _items_by_doi_isbn[doi].append(_item)
+
+        elif "ISBN" in _item["data"]:
+            isbn = _item["data"]["ISBN"]
+            if isbn:
+                _items_by_doi_isbn[isbn].append(_item)
+
+    return _items_by_doi_isbn
+
+
+def get_items_with_empty_doi_or_isbn(_items):
+    """
+    Articles with no DOI. Books with no ISBN.
+
+    :param _items: Zotero library items
+    :type _items: list containing dicts
+    :return: list of dicts
+    """
+
+    empty_items = []
+    for _item in _items:
+        if is_standalone(_item) or is_file(_item):
+            continue
+
+        if is_article(_item):
+            _field = "DOI"
+
+        elif is_book(_item):
+            _field = "ISBN"
+
+        elif is_misc(_item):
+            logging.warning(f"Misc {_item['data']['itemType']}")
+            continue
+        else:
+            logging.warning(f"Type of item not known {_item['data']['itemType']}")
+            st.warning(f"Type of item not known {_item['data']['itemType']}")
+            continue
+
+        if _field in _item["data"]:
+            if not _item["data"][_field]:
+                empty_items.append(_item)
+
+    return empty_items
+
+
+def get_items_with_empty_doi_and_isbn(_items, _fields):
+    """
+    Items with no DOI and no ISBN.
+
+    :param _items: Zotero library items
+    :type _items: list containing dicts
+    :param _fields: DOI and ISBN
+    :type _fields: list of str
+    :return: list of dict
+
+    """
+    empty = []
+    for _item in _items:
+        result = []
+        if is_standalone(_item) or is_file(_item):
+            continue
+
+        for field in _fields:
+            if field in _item["data"]:
+                f = _item["data"][field]
+                if not f:
+                    result.append(False)
+                else:
+                    result.append(True)
+
+        if not any(result):
+            empty.append(_item)
+
+    return empty
+
+
+# DOI backfill
+# Articles without DOI are looked up by title, first author and year
+# in a Crossref-style service (GET /works?query.bibliographic=...).
+# Answers are cached on disk, the best match is scored locally.
+CROSSREF_URL = os.environ.get("ZOTEROTIDY_CROSSREF_URL", "https://api.crossref.org")
+CROSSREF_DIR = Path(__file__).parent.absolute() / "crossref"
+CROSSREF_WORKERS = 4  # concurrent requests
+CROSSREF_ROWS = 5  # candidates per query
+DOI_MIN_SCORE = 0.9
+DOI_MIN_TITLE = 0.9  # title similarity of accepted matches
+DOI_MIN_WORDS = 3  # shorter titles (Editorial, Introduction) are not accepted
+
+
+def normalize_title(title):
+    """Lower case words of a title without punctuation"""
+    return " ".join(re.findall(r"\w+", title.lower()))
+
+
+def item_year(_item):
+    """Year of the date of an item or None"""
+    year = re.search(r"\b(\d{4})\b", _item["data"].get("date", ""))
+    return int(year.group(1)) if year else None
+
+
+def item_author(_item):
+    """Last name of the first creator or empty string"""
+    for creator in _item["data"].get("creators", []):
+        name = creator.get("lastName") or creator.get("name", "")
+        if name:
+            return name
+
+    return ""
+
+
+def crossref_query(_item, mail=""):
+    """Query URL of an item, see CROSSREF_URL"""
+    params = {
+        "query.bibliographic": _item["data"]["title"],
+        "rows": CROSSREF_ROWS,
+        "select": "DOI,title,author,issued",
+    }
+    if item_author(_item):
+        params["query.author"] = item_author(_item)
+
+    if mail:
+        params["mailto"] = mail
+
+    return f"{CROSSREF_URL}/works?{urllib.parse.urlencode(params)}"
+
+
+def fetch_crossref(url, retries=PAGE_RETRIES):
+    """Candidates of a query, retried with backoff on errors
+
+    :param url: query from crossref_query()
+    :type url: str
+    :returns: list of dicts (Crossref works)
+
+    """
+    request = urllib.request.Request(url, headers={"User-Agent": "ZoteroTidy"})
+    for attempt in range(retries + 1):
+        try:
+            with urllib.request.urlopen(request, timeout=30) as response:
+                return json.load(response)["message"]["items"]
+        except (OSError, ValueError, KeyError) as e:
+            if attempt == retries:
+                raise
+
+            delay = backoff_delay(attempt)
+            logging.warning(f"Crossref query failed ({str(e)}), retry in {delay:.1f} s")
+            time.sleep(delay)
+
+
+def title_ratio(_item, work):
+    """Similarity of the titles of an item and a Crossref work (difflib)"""
+    title = normalize_title(_item["data"]["title"])
+    candidate = normalize_title(" ".join(work.get("title", [])))
+    return difflib.SequenceMatcher(None, title, candidate).ratio()
+
+
+def score_match(_item, work):
+    """Similarity of an item and a Crossref work between 0 and 1
+
+    Title similarity weighs 70 %, same year and same first author
+    15 % each. A missing year or author earns nothing.
+
+    :returns: float
+
+    """
+    score = 0.7 * title_ratio(_item, work)
+    year = item_year(_item)
+    issued = work.get("issued", {}).get("date-parts", [[None]])[0][0]
+    if year is not None and issued == year:
+        score += 0.15
+
+    author = item_author(_item).lower()
+    families = [a.get("family", "").lower() for a in work.get("author", [])]
+    if author and author in families[:1]:
+        score += 0.15
+
+    return score
+
+
+def accept_match(_item, work, score, min_score=DOI_MIN_SCORE):
+    """True if the DOI of a match can be written
+
+    Besides the score, the titles must be similar and not too short.
+    """
+    words = normalize_title(_item["data"]["title"]).split()
+    return (
+        score >= min_score
+        and len(words) >= DOI_MIN_WORDS
+        and title_ratio(_item, work) >= DOI_MIN_TITLE
+    )
+
+
+def load_crossref_cache():
+    """Cached Crossref answers (query URL --> works)"""
+    path = CROSSREF_DIR / "cache.json"
+    if not path.exists():
+        return {}
+
+    try:
+        with open(path, encoding="utf-8") as f:
+            return json.load(f)
+    except (OSError, ValueError) as e:
+        logging.error(f"Can not read Crossref cache {path} with error {str(e)}")
+        return {}
+
+
+def save_crossref_cache(cache):
+    """Write Crossref answers atomically"""
+    CROSSREF_DIR.mkdir(exist_ok=True)
+    path = CROSSREF_DIR / "cache.json"
+    tmp = path.with_suffix(".tmp")
+    with open(tmp, "w", encoding="utf-8") as f:
+        json.dump(cache, f)
+
+    tmp.replace(path)
+
+
+def backfill_dois(_items, pl, mail="", min_score=DOI_MIN_SCORE):
+    """Best Crossref match of the articles without DOI
+
+    At most CROSSREF_WORKERS requests run at the same time,
+    answers are cached in CROSSREF_DIR.
+
+    :param _items: Zotero library items, e.g. from get_items_with_empty_doi_or_isbn()
+    :type _items: list containing dicts
+    :param pl: placeholder to print progress
+    :type pl: st.empty()
+    :param mail: sent to Crossref for the polite pool
+    :type mail: str
+    :param min_score: accept matches from this score
+    :type min_score: float
+    :returns: list of dicts (report rows with key, title, DOI, score, accepted)
+
+    """
+    articles = [
+        i
+        for i in _items
+        if "DOI" in i["data"] and not i["data"]["DOI"] and i["data"].get("title")
+    ]
+    cache = load_crossref_cache()
+    queries = {i["key"]: crossref_query(i, mail) for i in articles}
+    todo = sorted(set(queries.values()) - set(cache))
+    logging.info(f"Backfill DOIs of {len(articles)} items, {len(todo)} queries")
+    with ThreadPoolExecutor(max_workers=CROSSREF_WORKERS) as pool:
+        futures = {pool.submit(fetch_crossref, url): url for url in todo}
+        for n, future in enumerate(as_completed(futures), 1):
+            try:
+                cache[futures[future]] = future.result()
+            except Exception as e:
+                logging.error(f"Crossref query {futures[future]} failed: {str(e)}")
+
+            pl.info(f"Crossref queries {n} / {len(todo)}")
+
+    save_crossref_cache(cache)
+    rows = []
+    for _item in articles:
+        works = cache.get(queries[_item["key"]], [])
+        if not works:
+            continue
+
+        score, work = max(
+            ((score_match(_item, w), w) for w in works), key=lambda s: s[0]
+        )
+        rows.append(
+            item_row(
+                _item,
+                DOI=work["DOI"],
+                score=round(score, 3),
+                accepted=accept_match(_item, work, score, min_score),
+            )
+        )
+
+    return rows
+
+
+def duplicate_pdf_attachments(_children):
+    """Pdf attachments of an item to delete, keeping only the first one.
+
+    :param _children: Children items of a specific item
+    :type _children: list of dicts
+    :returns: list of dicts
+
+    """
+
+    pdfs = [child for child in _children if attachment_is_pdf(child)]
+    return pdfs[1:]
+
+
+def item_title(_item):
+    """Title of an item
+
+    :param _item: Zotero library item
+    :type _item: dict
+    :returns: str
+
+    """
+
+    if is_standalone(_item):
+        ttt = f"Standalone item of type: <{_item['data']['itemType']}>"
+        if "filename" in _item["data"]:
+            ttt += f" ({_item['data']['filename']})"
+    else:
+        ttt = f"{_item['data']['title']}"
+
+    return ttt
+
+
+def item_row(_item, **extra):
+    """Row of an item in a report table
+
+    :param _item: Zotero library item
+    :type _item: dict
+    :param extra: additional columns
+    :returns: dict
+
+    """
+    row = {
+        "title": item_title(_item),
+        "itemType": _item["data"]["itemType"],
+        "dateAdded": _item["data"].get("dateAdded", ""),
+        "key": _item["key"],
+    }
+    row.update(extra)
+    return row
+
+
+def log_titles(name, _rows):
+    """Log the rows of a report at once
+
+    :param name: name of report
+    :type name: str
+    :param _rows: rows of report
+    :type _rows: list of dicts
+
+    """
+    lines = "\n".join(" | ".join(str(v) for v in row.values()) for row in _rows)
+    logging.info(f"{name} ({len(_rows)}):\n{lines}")
+
+
+def add_report(name, _rows, log_items=False):
+    """Keep the rows of a report for the results table
+
+    :param name: name of report
+    :type name: str
+    :param _rows: rows of report
+    :type _rows: list of dicts
+    :param log_items: write all rows in the log
+    :type log_items: bool
+
+    """
+    st.session_state.reports[name] = _rows
+    st.session_state.exports.pop(name, None)
+    if log_items:
+        log_titles(name, _rows)
+
+
+def sort_key(value):
+    """Type-consistent sort key of a report cell
+
+    Empty cells come last, numbers before text.
+    """
+    if value is None or value == "":
+        return (True, 0, 0, "")
+
+    if isinstance(value, (int, float)):
+        return (False, 0, value, "")
+
+    return (False, 1, 0, str(value))
+
+
+def page_rows(_rows, query, sort_by, descending, page, page_size):
+    """Filter, sort and cut a page out of the rows of a report
+
+    :param _rows: rows of report
+    :type _rows: list of dicts
+    :param query: keep only rows containing query (case insensitive)
+    :type query: str
+    :param sort_by: column to sort by
+    :type sort_by: str
+    :param descending: sort order
+    :type descending: bool
+    :param page: page number, starting at 1
+    :type page: int
+    :param page_size: rows per page
+    :type page_size: int
+    :returns: (list of dicts, int) rows of page and number of matching rows
+
+    """
+    rows = _rows
+    if query:
+        query = query.lower()
+        rows = [r for r in rows if any(query in str(v).lower() for v in r.values())]
+
+    if sort_by:
+        rows = sorted(
+            rows,
+            key=lambda r: sort_key(r.get(sort_by)),
+            reverse=descending,
+        )
+
+    start = (page - 1) * page_size
+    return rows[start : start + page_size], len(rows)
+
+
+def iter_report_jsonl(_rows):
+    """Rows of a report as JSON lines
+
+    :param _rows: rows of report
+    :type _rows: list of dicts
+    :returns: generator of str
+
+    """
+    for row in _rows:
+        yield json.dumps(row, ensure_ascii=False) + "\n"
+
+
+def iter_report_csv(_rows):
+    """Rows of a report as CSV lines, header first
+
+    :param _rows: rows of report
+    :type _rows: list of dicts
+    :returns: generator of str
+
+    """
+    if not _rows:
+        return
+
+    buffer = io.StringIO()
+    writer = csv.DictWriter(buffer, fieldnames=list(_rows[0].keys()))
+    writer.writeheader()
+    for row in _rows:
+        writer.writerow(row)
+        yield buffer.getvalue()
+        buffer.seek(0)
+        buffer.truncate()
+
+
+EXPORTS = {"jsonl": iter_report_jsonl, "csv": iter_report_csv}
+
+
+def export_report(name, _rows, fmt):
+    """Write the rows of a report to a file of the session
+
+    The rows are streamed to disk, one line at a time.
+    Files are written once per report and format, and again if the
+    cleanup of another session removed them.
+
+    :param name: name of report
+    :type name: str
+    :param _rows: rows of report
+    :type _rows: list of dicts
+    :param fmt: jsonl or csv
+    :type fmt: str
+    :returns: Path
+
+    """
+    exports = st.session_state.exports.setdefault(name, {})
+    if fmt in exports and exports[fmt].exists():
+        return exports[fmt]
+
+    slug = "".join(c if c.isalnum() else "_" for c in name).strip("_").lower()
+    path = Path(st.session_state.tmp_dir) / f"{slug}.{fmt}"
+    path.parent.mkdir(parents=True, exist_ok=True)
+    with open(path, "w", encoding="utf-8", newline="") as f:
+        f.writelines(EXPORTS[fmt](_rows))
+
+    exports[fmt] = path
+    return path
+
+
+def cleanup_tmp_files(directory, max_age=TMP_MAX_AGE):
+    """Remove temp files and directories of old sessions
+
+    Every session writes a tmp_*.log and a tmp_* directory for exports.
+
+    :param directory: directory of the temp files
+    :type directory: str or Path
+    :param max_age: remove files older than max_age seconds
+    :type max_age: float
+    :returns: number of removed files
+
+    """
+    now = time.time()
+    removed = 0
+    for path in Path(directory).glob("tmp_*"):
+        try:
+            if now - path.stat().st_mtime < max_age:
+                continue
+
+            if path.is_dir():
+                shutil.rmtree(path)
+            else:
+                path.unlink()
+        except OSError as e:
+            logging.warning(f"Can not remove {path} with error {str(e)}")
+            continue
+
+        removed += 1
+
+    if removed:
+        logging.info(f"Removed {removed} old temp files from {directory}")
+
+    return removed
+
+
+PAGE_SIZES = [25, 50, 100, 250]
+
+
+def show_report(name, _rows):
+    """Paginated, sortable and filterable table of a report
+
+    Only the visible page is sent to the front end. Streamlit keeps
+    downloads in memory, so exports are only read when requested.
+
+    :param name: name of report
+    :type name: str
+    :param _rows: rows of report
+    :type _rows: list of dicts
+
+    """
+    with st.expander(f"{name} ({len(_rows)})", expanded=False):
+        if not _rows:
+            st.write("Nothing to show.")
+            return
+
+        columns = list(_rows[0].keys())
+        c1, c2, c3, c4 = st.columns((3, 2, 1, 1))
+        query = c1.text_input("Filter", key=f"{name}_filter")
+        sort_by = c2.selectbox("Sort by", columns, key=f"{name}_sort")
+        descending = c3.checkbox("Descending", key=f"{name}_desc")
+        page_size = c4.selectbox("Rows", PAGE_SIZES, key=f"{name}_size")
+        _, num_rows = page_rows(_rows, query, None, False, 1, 0)
+        num_pages = max(1, -(-num_rows // page_size))
+        page = st.number_input(
+            f"Page (of {num_pages})",
+            min_value=1,
+            max_value=num_pages,
+            value=1,
+            key=f"{name}_page",
+        )
+        rows, _ = page_rows(_rows, query, sort_by, descending, page, page_size)
+        st.dataframe(rows)
+        for fmt, column in zip(EXPORTS, st.columns(len(EXPORTS))):
+            if not column.checkbox(f"Export {fmt.upper()}", key=f"{name}_{fmt}_export"):
+                continue
+
+            path = export_report(name, _rows, fmt)
+            with open(path, "rb") as f:
+                column.download_button(
+                    f"Download {fmt.upper()}",
+                    f,
+                    file_name=path.name,
+                    key=f"{name}_{fmt}",
+                )
+
+
+PROFILE_PHASES = ["run", "load", "children", "reports", "writes", "render"]
+PROFILE_TOP = 25  # functions in the log summary
+
+
+def profile_target():
+    """Phase to profile, from the sidebar or the ZOTEROTIDY_PROFILE variable
+
+    :returns: str, empty if profiling is off
+
+    """
+    return st.session_state.get("profile") or os.environ.get("ZOTEROTIDY_PROFILE", "")
+
+
+def start_profile(name):
+    """Start profiling a phase if it is the chosen one
+
+    :param name: phase, see PROFILE_PHASES
+    :type name: str
+    :returns: cProfile.Profile or None
+
+    """
+    if profile_target() != name:
+        return None
+
+    profiler = cProfile.Profile()
+    profiler.enable()
+    return profiler
+
+
+def stop_profile(name, profiler, top=PROFILE_TOP):
+    """Stop profiling, save the profile and log the top functions
+
+    The profile is written to the temp directory of the session
+    and added to st.session_state.profiles for download.
+
+    :param name: phase, see PROFILE_PHASES
+    :type name: str
+    :param profiler: profiler from start_profile()
+    :type profiler: cProfile.Profile or None
+    :param top: number of functions to log
+    :type top: int
+    :returns: Path of the profile or None
+
+    """
+    if profiler is None:
+        return None
+
+    profiler.disable()
+    path = Path(st.session_state.tmp_dir) / f"{name}_{datetime.now():%H%M%S}.prof"
+    profiler.dump_stats(path)
+    summary = io.StringIO()
+    stats = pstats.Stats(profiler, stream=summary)
+    stats.sort_stats("cumulative").print_stats(top)
+    logging.info(f"Profile of {name} ({path.name}):\n{summary.getvalue()}")
+    st.session_state.profiles[name] = path
+    return path
+
+
+@contextmanager
+def profile_phase(name):
+    """Profile the enclosed code if name is the chosen phase"""
+    profiler = start_profile(name)
+    try:
+        yield
+    finally:
+        stop_profile(name, profiler)
+
+
+def set_new_tag(z, n, m, d, o, mail="", snapshot=""):
+    """Prepare list of tags to be added to items
+
+    We have to add the tags to items at once.
+    Otherwise, we will have to update the library!
+
+    This function may update the session_state of some lists
+    (if session_state lists are empty)
+
+    These lists hold item keys:
+    - suspecious_items
+    - multpdf_items
+    - nopdf_items
+    - doi_dupl_items
+
+    :param z: Suspecious items
+    :type z: Bool
+    :param n: Items with no pdf
+    :type n: Bool
+    :param m: Items with multiple pdf
+    :type m: Bool
+    :param d: Duplicate items
+    :type d: Bool
+    :param o: open-access articles
+    :type o: Bool
+    :param snapshot: Unpaywall snapshot, see get_oa_ca()
+    :type snapshot: str
+    :returns: dict of lists
+
+    """
+    new_tags = defaultdict(list)
+    if z:
+        update_suspecious_state()
+        for key in st.session_state.suspecious_items:
+            new_tags[key].append("todo_catalog")
+
+    if m:
+        update_duplicate_attach_state()
+        for key in st.session_state.multpdf_items:
+            new_tags[key].append("duplicate_pdf")
+
+    if n:
+        update_without_pdf_state()
+        for key in st.session_state.nopdf_items:
+            new_tags[key].append("nopdf")
+
+    if d:
+        update_duplicate_items_state()
+        for key in st.session_state.doi_dupl_items:
+            new_tags[key].append("duplicate_item")
+
+    if o:
+        if not snapshot:
+            unpywall_credits(mail)
+
+        items_by_doi = get_items_by_doi(st.session_state.zot_items)
+        pl = st.empty()
+        with st.spinner("Initializing ..."):
+            OA_items, _ = get_oa_ca(items_by_doi, pl, snapshot)
+
+        items = doi_to_item(OA_items)
+
+        for item in items:
+            new_tags[item["data"]["key"]].append("open-access")
+
+    return new_tags
+
+
+ANALYSES = ["suspecious", "nopdf", "no_doi_isbn", "doi_dupl", "multpdf", "md5"]
+
+
+def is_analysed(name):
+    """True if the analysis results of name are in the session state"""
+    return name in st.session_state.analysed
+
+
+def update_suspecious_state():
+    """First update of suspecious_items (keys)"""
+    if not is_analysed("suspecious"):
+        force_update_suspecious_state()
+
+
+def force_update_suspecious_state():
+    """Update of suspecious_items (keys)"""
+    if st.session_state.frame is not None:
+        keys = frame_suspecious(st.session_state.frame)
+    else:
+        keys = keys_of(get_suspecious_items(st.session_state.zot_items))
+
+    st.session_state.suspecious_items = keys
+    st.session_state.analysed.add("suspecious")
+
+
+def update_no_doi_isbn_state():
+    """First update of no_doi_isbn_items (keys)"""
+    if not is_analysed("no_doi_isbn"):
+        force_update_no_doi_isbn_state()
+
+
+def force_update_no_doi_isbn_state():
+    """Update of no_doi_isbn_items (keys)"""
+    if st.session_state.frame is not None:
+        keys = frame_empty_doi_or_isbn(st.session_state.frame)
+    else:
+        keys = keys_of(get_items_with_empty_doi_or_isbn(st.session_state.zot_items))
+
+    st.session_state.no_doi_isbn_items = keys
+    st.session_state.analysed.add("no_doi_isbn")
+
+
+def standalone_keys():
+    """Keys of standalone items"""
+    if st.session_state.frame is not None:
+        return frame_standalone(st.session_state.frame)
+
+    return keys_of(get_standalone_items(st.session_state.zot_items))
+
+
+# @todo check if state variable need to be used as input for functions
+def update_duplicate_attach_state():
+    """First update of lists related to multiple pdfs
+
+    - multpdf_items (keys)
+    - pdfs (keys of pdf attachments)
+
+    """
+    if not is_analysed("multpdf"):
+        force_update_duplicate_attach_state()
+
+
+def force_update_duplicate_attach_state():
+    """Update of lists related to multiple pdfs
+
+    - multpdf_items (keys)
+    - pdfs (keys of pdf attachments)
+
+    """
+    if st.session_state.frame is not None:
+        keys, pdfs = frame_multiple_pdf(st.session_state.frame)
+    else:
+        items, pdfs = get_items_with_duplicate_pdf(
+            st.session_state.zot, st.session_state.zot_items
+        )
+        keys = keys_of(items)
+
+    st.session_state.multpdf_items = keys
+    st.session_state.pdfs = {key: pdfs[key] for key in keys}
+    st.session_state.analysed.add("multpdf")
+
+
+def update_md5_state():
+    """First update of pdf attachments grouped by md5
+
+    - pdf_md5_groups (keys)
+
+    """
+    if not is_analysed("md5"):
+        force_update_md5_state()
+
+
+def force_update_md5_state():
+    """Update of pdf attachments grouped by md5"""
+    groups = get_pdf_groups_by_md5(
+        st.session_state.zot_items, st.session_state.local_md5
+    )
+    st.session_state.pdf_md5_groups = {
+        md5: keys_of(group) for md5, group in groups.items()
+    }
+    st.session_state.analysed.add("md5")
+
+
+def md5_groups():
+    """Pdf attachments grouped by md5 from the session state
+
+    :returns: dict of lists of dicts
+
+    """
+    update_md5_state()
+    return {
+        md5: items_of(keys) for md5, keys in st.session_state.pdf_md5_groups.items()
+    }
+
+
+def duplicate_keys(groups):
+    """Keys of the groups with more than one item"""
+    return [key for keys in groups.values() if len(keys) > 1 for key in keys]
+
+
+def update_duplicate_items_state():
+    """First update of duplicate items by doi"""
+    if not is_analysed("doi_dupl"):
+        force_update_duplicate_items_state()
+
+
+def force_update_duplicate_items_state():
+    """Update of duplicate items by doi
+
+    - id_groups (DOI/ISBN --> keys)
+    - doi_dupl_items (keys)
+
+    """
+    if st.session_state.frame is not None:
+        groups = frame_identifier_groups(st.session_state.frame)
+    else:
+        by_doi = get_items_by_doi_or_isbn(st.session_state.zot_items)
+        groups = {identifier: keys_of(items) for identifier, items in by_doi.items()}
+
+    st.session_state.id_groups = groups
+    st.session_state.doi_dupl_items = duplicate_keys(groups)
+    st.session_state.analysed.add("doi_dupl")
+
+
+def update_without_pdf_state():
+    """First update of items without pdf"""
+    if not is_analysed("nopdf"):
+        force_update_without_pdf_state()
+
+
+def force_update_without_pdf_state():
+    """Update of items without pdf"""
+    if st.session_state.frame is not None:
+        keys = frame_without_pdf(st.session_state.frame)
+    else:
+        keys = keys_of(get_items_with_no_pdf_attachments2(st.session_state.zot_items))
+
+    st.session_state.nopdf_items = keys
+    st.session_state.analysed.add("nopdf")
+
+
+def parent_keys(_items):
+    """Keys of the parents of child items"""
+    return {i["data"]["parentItem"] for i in _items if "parentItem" in i["data"]}
+
+
+def cascade_deleted(_items, changed, deleted_keys):
+    """Keys of deleted items and of their children
+
+    Zotero deletes the children (and their annotations) with their parent,
+    unless they were moved to another parent.
+
+    :param _items: Zotero library items
+    :type _items: list containing dicts
+    :param changed: added or changed Zotero items by key
+    :type changed: dict
+    :param deleted_keys: keys of deleted items
+    :type deleted_keys: list of str
+    :returns: set of str
+
+    """
+    deleted = set(deleted_keys) - set(changed)
+    if not deleted:
+        return deleted
+
+    parent_of = {i["key"]: i["data"].get("parentItem") for i in _items}
+    parent_of.update((k, i["data"].get("parentItem")) for k, i in changed.items())
+    new = deleted
+    while new:
+        new = {k for k, parent in parent_of.items() if parent in new} - deleted
+        deleted |= new
+
+    return deleted
+
+
+def update_frame(frame, changed_items, touched):
+    """Frame of the library with the rows of touched items replaced
+
+    :param frame: frame of the loaded items, see items_frame()
+    :type frame: pd.DataFrame
+    :param changed_items: added or changed Zotero items
+    :type changed_items: list of dicts
+    :param touched: keys of changed and deleted items
+    :type touched: set of str
+    :returns: pd.DataFrame
+
+    """
+    kept = frame[~frame["key"].isin(touched)]
+    frame = pd.concat([items_frame(changed_items), kept], ignore_index=True)
+    for column in ["itemType", "libraryCatalog", "contentType", "linkMode"]:
+        frame[column] = frame[column].astype("category")
+
+    return frame
+
+
+def merge_delta(_items, _children, changed_items, deleted_keys):
+    """New items and children with added, changed and deleted items
+
+    Children of deleted items are deleted too.
+    The given lists and dicts are not changed.
+
+    :param _items: Zotero library items
+    :type _items: list containing dicts
+    :param _children: children of the items, see get_children()
+    :type _children: dict of lists
+    :param changed_items: added or changed Zotero items
+    :type changed_items: list of dicts
+    :param deleted_keys: keys of deleted items
+    :type deleted_keys: list of str
+    :returns: (list of dicts, dict of lists)
+
+    """
+    changed = {i["key"]: i for i in changed_items}
+    deleted = cascade_deleted(_items, changed, deleted_keys)
+    touched = set(changed) | deleted
+    old_keys = {i["key"] for i in _items}
+    old_items = [i for i in _items if i["key"] in touched]
+
+    # items: new ones first (most recently modified), changed ones in place
+    items = [i for i in changed_items if i["key"] not in old_keys]
+    items.extend(changed.get(i["key"], i) for i in _items if i["key"] not in deleted)
+    by_key = index_items(items)
+
+    # children of the parents of old and new versions of the touched items
+    children = dict(_children)
+    for parent in parent_keys(old_items) | parent_keys(changed.values()):
+        if parent not in by_key:
+            continue
+
+        cs = [c for c in children.get(parent, []) if c["key"] not in touched]
+        cs.extend(c for c in changed.values() if c["data"].get("parentItem") == parent)
+        children[parent] = cs
+
+    for key in touched:
+        if key not in by_key or is_file(by_key[key]) or is_standalone(by_key[key]):
+            children.pop(key, None)
+        else:
+            children.setdefault(key, [])
+
+    return items, children
+
+
+def fetch_delta(_zot, since, pl=None):
+    """Items changed and keys of items deleted since a library version
+
+    Only the changed items are downloaded (max 50 per request).
+    Trashed items count as deleted.
+
+    :param _zot: A Zotero instance
+    :type _zot: pyzotero.zotero.Zotero
+    :param since: library version
+    :type since: int
+    :param pl: placeholder to print messages
+    :type pl: st.empty()
+    :returns: (list of dicts, list of str)
+
+    """
+    versions = _zot.item_versions(since=since, includeTrashed=1)
+    deleted = list(_zot.deleted(since=since).get("items", []))
+    changed = []
+    for i, keys in enumerate(chunks(list(versions), WRITE_BATCH)):
+        if pl is not None:
+            pl.info(f"Retrieving changed items {i * WRITE_BATCH} / {len(versions)}")
+
+        changed.extend(
+            _zot.items(itemKey=",".join(keys), includeTrashed=1, limit=WRITE_BATCH)
+        )
+
+    deleted.extend(i["key"] for i in changed if i["data"].get("deleted"))
+    changed = [i for i in changed if not i["data"].get("deleted")]
+    return changed, deleted
+
+
+def apply_delta(changed_items, deleted_keys):
+    """Apply added, changed and deleted items to the loaded library
+
+    The items, their children and the analysis results in the session state
+    are updated. Only the touched items and the parents of touched children
+    are evaluated again:
+
+    - suspecious, no pdf and empty DOI/ISBN keys
+    - DOI/ISBN groups of the old and new identifiers of the touched items
+    - pdf attachments of the touched parents
+    - tag index entries of the old and new tags of the touched items
+
+    Children of deleted items are deleted too. md5 groups are computed
+    again on demand, the rows of the touched items in the columnar frame
+    are replaced.
+
+    The loaded items may be shared with other sessions (LIBRARY_CACHE),
+    so new containers are built instead of changing them.
+
+    :param changed_items: added or changed Zotero items
+    :type changed_items: list of dicts
+    :param deleted_keys: keys of deleted items
+    :type deleted_keys: list of str
+    :returns: set of touched keys
+
+    """
+    old_by_key = st.session_state.items_by_key
+    changed = {i["key"]: i for i in changed_items}
+    deleted = cascade_deleted(st.session_state.zot_items, changed, deleted_keys)
+    touched = set(changed) | deleted
+    old_items = [old_by_key[k] for k in touched if k in old_by_key]
+    if not touched:
+        return touched
+
+    items, children = merge_delta(
+        st.session_state.zot_items,
+        st.session_state.children,
+        changed_items,
+        deleted,
+    )
+    by_key = index_items(items)
+    parents = parent_keys(old_items) | parent_keys(changed.values())
+    st.session_state.zot_items = items
+    st.session_state.items_by_key = by_key
+    st.session_state.children = children
+
+    # analysis results
+    affected = touched | parents
+    current = [by_key[k] for k in affected if k in by_key]
+    for name, select in [
+        ("suspecious", get_suspecious_items),
+        ("nopdf", get_items_with_no_pdf_attachments2),
+        ("no_doi_isbn", get_items_with_empty_doi_or_isbn),
+    ]:
+        if is_analysed(name):
+            state = f"{name}_items"
+            keys = [k for k in st.session_state[state] if k not in affected]
+            st.session_state[state] = keys + keys_of(select(current))
+
+    if is_analysed("doi_dupl"):
+        old_ids = get_items_by_doi_or_isbn(old_items)
+        new_ids = get_items_by_doi_or_isbn(changed.values())
+        groups = dict(st.session_state.id_groups)
+        for identifier in set(old_ids) | set(new_ids):
+            keys = [k for k in groups.get(identifier, []) if k not in touched]
+            keys.extend(keys_of(new_ids.get(identifier, [])))
+            if keys:
+                groups[identifier] = keys
+            else:
+                groups.pop(identifier, None)
+
+        st.session_state.id_groups = groups
+        st.session_state.doi_dupl_items = duplicate_keys(groups)
+
+    if is_analysed("multpdf"):
+        pdfs = {k: v for k, v in st.session_state.pdfs.items() if k not in affected}
+        _, touched_pdfs = get_items_with_duplicate_pdf(st.session_state.zot, current)
+        pdfs.update((k, v) for k, v in touched_pdfs.items() if len(v) > 1)
+        st.session_state.pdfs = pdfs
+        st.session_state.multpdf_items = list(pdfs)
+
+    st.session_state.analysed.discard("md5")
+    if st.session_state.frame is not None:
+        st.session_state.frame = update_frame(
+            st.session_state.frame, changed_items, touched
+        )
+
+    index = dict(st.session_state.tag_index)
+    retagged = build_tag_index(changed.values())
+    tags = set(build_tag_index(old_items)) | set(retagged)
+    for tag in tags:
+        entry = index.get(tag)
+        keys = [k for k in entry["keys"] if k not in touched] if entry else []
+        new = retagged.get(tag)
+        if new:
+            keys.extend(new["keys"])
+
+        if not keys:
+            index.pop(tag, None)
+            continue
+
+        index[tag] = {
+            "keys": keys,
+            "type": min(entry["type"] if entry else 1, new["type"] if new else 1),
+            "colored": entry["colored"] if entry else False,
+        }
+
+    st.session_state.tag_index = index
+    logging.info(
+        f"Applied delta: {len(changed)} changed, {len(deleted)} deleted, {len(affected)} evaluated"
+    )
+    return touched
+
+
+def sync_library_delta(_zot, pl):
+    """Fetch the items changed since the loaded version and apply them
+
+    See fetch_delta() and apply_delta().
+    For scoped loads, only items already loaded and their children are applied.
+
+    :param _zot: A Zotero instance
+    :type _zot: pyzotero.zotero.Zotero
+    :param pl: placeholder to print messages
+    :type pl: st.empty()
+    :returns: number of touched items
+
+    """
+    since = st.session_state.zot_version
+    version = _zot.last_modified_version()
+    if version == since:
+        pl.info(":heavy_check_mark: Library is up to date")
+        return 0
+
+    changed, deleted = fetch_delta(_zot, since, pl)
+    if st.session_state.scoped:
+        loaded = st.session_state.items_by_key
+        changed = [
+            i
+            for i in changed
+            if i["key"] in loaded or i["data"].get("parentItem") in loaded
+        ]
+
+    touched = apply_delta(changed, deleted)
+    st.session_state.zot_version = version
+    st.session_state.num_items = _zot.count_items()
+    if st.session_state.cache_key is not None:
+        # the listener may have cached this version already
+        st.session_state.cache_key = st.session_state.cache_key[:2] + (version,)
+        entry = LIBRARY_CACHE.get(st.session_state.cache_key)
+        if entry is None:
+            entry = LIBRARY_CACHE.put(
+                st.session_state.cache_key,
+                st.session_state.zot_items,
+                st.session_state.children,
+            )
+        else:
+            st.session_state.zot_items = entry["items"]
+            st.session_state.children = entry["children"]
+
+        st.session_state.items_by_key = entry["by_key"]
+
+    pl.success(f":heavy_check_mark: Synced {len(touched)} changed items")
+    return len(touched)
+
+
+FILE_TYPES = ["note", "attachment", "annotation"]
+ARTICLE_TYPES = ["conferencePaper", "encyclopediaArticle", "journalArticle"]
+BOOK_TYPES = ["book", "bookSection"]
+
+
+def items_frame(_items):
+    """Loaded library as a frame with one row per item
+
+    Missing fields are None, empty fields are "".
+
+    :param _items: Zotero library items
+    :type _items: list containing dicts
+    :returns: pd.DataFrame
+
+    """
+    columns = {
+        "key": [],
+        "itemType": [],
+        "title": [],
+        "DOI": [],
+        "ISBN": [],
+        "libraryCatalog": [],
+        "dateAdded": [],
+        "parentItem": [],
+        "contentType": [],
+        "linkMode": [],
+        "filename": [],
+        "md5": [],
+        "size": [],
+        "attachmentType": [],
+    }
+    for _item in _items:
+        data = _item["data"]
+        columns["key"].append(_item["key"])
+        columns["itemType"].append(data["itemType"])
+        columns["title"].append(data.get("title"))
+        columns["DOI"].append(data.get("DOI"))
+        columns["ISBN"].append(data.get("ISBN"))
+        columns["libraryCatalog"].append(data.get("libraryCatalog"))
+        columns["dateAdded"].append(data.get("dateAdded"))
+        columns["parentItem"].append(data.get("parentItem"))
+        columns["contentType"].append(data.get("contentType"))
+        columns["linkMode"].append(data.get("linkMode"))
+        columns["filename"].append(data.get("filename"))
+        columns["md5"].append(data.get("md5"))
+        columns["size"].append(attachment_size(_item))
+        attachment = _item.get("links", {}).get("attachment", {})
+        columns["attachmentType"].append(attachment.get("attachmentType"))
+
+    frame = pd.DataFrame(columns)
+    for column in ["itemType", "libraryCatalog", "contentType", "linkMode"]:
+        frame[column] = frame[column].astype("category")
+
+    frame["dateAdded"] = pd.to_datetime(frame["dateAdded"], format="%Y-%m-%dT%H:%M:%SZ")
+    frame["size"] = frame["size"].astype("int64")
+    return frame
+
+
+def frame_is_file(frame):
+    return frame["itemType"].isin(FILE_TYPES)
+
+
+def frame_suspecious(frame):
+    """Keys of items with libraryCatalog==Zotero"""
+    return frame.loc[frame["libraryCatalog"] == "Zotero", "key"].tolist()
+
+
+def frame_standalone(frame):
+    """Keys of standalone items"""
+    mask = frame_is_file(frame) & frame["parentItem"].isna()
+    return frame.loc[mask, "key"].tolist()
+
+
+def frame_without_pdf(frame):
+    """Keys of items with no pdf file, see get_items_with_no_pdf_attachments2()"""
+    mask = ~frame_is_file(frame) & (frame["attachmentType"] != "application/pdf")
+    return frame.loc[mask, "key"].tolist()
+
+
+def frame_empty_doi_or_isbn(frame):
+    """Keys of articles with empty DOI and books with empty ISBN"""
+    articles = frame["itemType"].isin(ARTICLE_TYPES) & (frame["DOI"] == "")
+    books = frame["itemType"].isin(BOOK_TYPES) & (frame["ISBN"] == "")
+    return frame.loc[articles | books, "key"].tolist()
+
+
+def frame_identifiers(frame):
+    """DOI or, for items without DOI field, ISBN. See get_items_by_doi_or_isbn()"""
+    isbn = frame["ISBN"].where(frame["DOI"].isna())
+    identifier = frame["DOI"].where(frame["DOI"].notna(), isbn)
+    identifier = identifier.mask(identifier == "")
+    return identifier.where(~frame_is_file(frame))
+
+
+def frame_identifier_groups(frame):
+    """Keys of items by DOI/ISBN, see get_items_by_doi_or_isbn()
+
+    :returns: dict of lists
+
+    """
+    identifier = frame_identifiers(frame)
+    return frame["key"].groupby(identifier, sort=False).agg(list).to_dict()
+
+
+def frame_multiple_pdf(frame):
+    """Items with more than one pdf attachment and keys of their pdf files
+
+    As with dicts, only pdf files with a filename count (not linked files).
+
+    :returns: (list of str, dict of lists)
+
+    """
+    pdfs = frame[
+        (frame["itemType"] == "attachment")
+        & (frame["contentType"] == "application/pdf")
+        & frame["linkMode"].isin(["imported_file", "linked_file", "imported_url"])
+        & frame["filename"].notna()
+        & frame["parentItem"].isin(frame.loc[~frame_is_file(frame), "key"])
+    ]
+    by_parent = pdfs.groupby("parentItem", observed=True)["key"].agg(list)
+    by_parent = by_parent[by_parent.str.len() > 1]
+    return by_parent.index.tolist(), by_parent.to_dict()
+
+
+def save_frame(frame, path):
+    """Write frame as Parquet file for offline analytics
+
+    Parquet needs pyarrow (or fastparquet).
+
+    :param frame: frame from items_frame()
+    :type frame: pd.DataFrame
+    :param path: file to write
+    :type path: str or Path
+    :returns: True if written
+
+    """
+    try:
+        frame.to_parquet(path, index=False)
+    except ImportError as e:
+        st.error(f"Can not write Parquet: {e}")
+        return False
+
+    return True
+
+
+def get_tag_colors(_zot):
+    """Names of the colored tags of a library
+
+    Colors are stored in the library settings.
+
+    :param _zot: A Zotero instance
+    :type _zot: pyzotero.zotero.Zotero
+    :returns: set of str
+
+    """
+    try:
+        colors = _zot.settings().get("tagColors", {}).get("value", [])
+        return {t["name"] for t in colors}
+    except Exception as e:
+        logging.warning(f"Could not retrieve tag colors with error {str(e)}")
+        return set()
+
+
+def build_tag_index(_items, colors=()):
+    """Tags of the loaded items
+
+    type: 0 for manual tags, 1 for automatic tags
+    (automatic if all occurrences are automatic).
+
+    :param _items: Zotero library items
+    :type _items: list containing dicts
+    :param colors: names of colored tags
+    :type colors: set of str
+    :returns: dict (tag --> dict with keys, type and colored)
+
+    """
+    index = {}
+    for _item in _items:
+        for t in _item["data"].get("tags", []):
+            entry = index.setdefault(
+                t["tag"], {"keys": [], "type": 1, "colored": t["tag"] in colors}
+            )
+            entry["keys"].append(_item["key"])
+            if not t.get("type", 0):
+                entry["type"] = 0
+
+    return index
+
+
+def tag_rows(index):
+    """Report rows of the tag index, most used first"""
+    rows = [
+        {
+            "tag": tag,
+            "count": len(entry["keys"]),
+            "type": "automatic" if entry["type"] else "manual",
+            "colored": entry["colored"],
+        }
+        for tag, entry in index.items()
+    ]
+    rows.sort(key=lambda r: r["count"], reverse=True)
+    return rows
+
+
+def parse_tag_mapping(text):
+    """Renames and merges of tags, one per line
+
+    `old -> new` renames a tag,
+    `old1, old2 -> new` merges tags into a new one.
+
+    :param text: lines of mappings
+    :type text: str
+    :returns: dict (old tag --> new tag)
+
+    """
+    mapping = {}
+    for line in text.splitlines():
+        if "->" not in line:
+            continue
+
+        old, new = line.split("->", 1)
+        new = new.strip()
+        for tag in old.split(","):
+            tag = tag.strip()
+            if tag and new and tag != new:
+                mapping[tag] = new
+
+    return mapping
+
+
+def plan_tag_changes(index, mapping):
+    """Items to update to rename or merge tags
+
+    Only items carrying one of the old tags are updated,
+    each once whatever the number of renamed tags.
+
+    :param index: tag index from build_tag_index()
+    :type index: dict
+    :param mapping: old tag --> new tag
+    :type mapping: dict
+    :returns: list of dicts (items with new tags)
+
+    """
+    keys = {key for tag in mapping if tag in index for key in index[tag]["keys"]}
+    updates = []
+    for _item in items_of(sorted(keys)):
+        tags = []
+        seen = set()
+        for t in _item["data"]["tags"]:
+            name = mapping.get(t["tag"], t["tag"])
+            if name in seen:
+                continue
+
+            seen.add(name)
+            if name != t["tag"]:
+                t = {"tag": name}  # renamed tags are manual
+
+            tags.append(t)
+
+        updates.append(dict(_item, data=dict(_item["data"], tags=tags)))
+
+    return updates
+
+
+def prune_tags(index, min_count):
+    """Tags used by less than min_count items. Colored tags are kept"""
+    return [
+        tag
+        for tag, entry in index.items()
+        if len(entry["keys"]) < min_count and not entry["colored"]
+    ]
+
+
+def uptodate():
+    """Check if library is up to date
+
+    every change in Zotero-Library increments
+    the version number by one.
+    For example, trash being emptied --> +1
+    or note's content changed --> +1
+
+    :return: True if up-to-date
+    """
+
+    actual_st_version = st.session_state.zot_version
+    last_modified_version = st.session_state.zot.last_modified_version()
+
+    return actual_st_version == last_modified_version
+
+
+def items_uptodate():
+    """Check if items are outdated
+
+    If outdated, don't execute any update-functions
+
+    :todo: not used
+    :return: True if all up-to-date
+    """
+
+    zot = st.session_state.zot
+    vs = zot.item_versions()
+
+    vc = {}
+    for item in st.session_state.zot_items:
+        vc[item["key"]] = item["data"]["version"]
+
+    vs_reduced = {k: vs[k] for k, _ in vc.items()}
+    logging.info("----")
+    logging.info(f"vc: {len(vc)}, {vc}")
+    logging.info(f"vs: {len(vs)}, {vs}")
+    logging.info(f"vs_reduced: {len(vs_reduced)}, {vs_reduced}")
+    logging.info(vc == vs_reduced)
+    return vc == vs_reduced
+
+
+def init_update_delete_lists():
+    """Initialize Items to update/delete
+
+    Prepare some lists of items to be updated and deleted
+
+    Note:
+    - Duplicates without DOI not ISBN numbers are going to be ignored!
+    - Duplicates with different DOI or ISBN will be missed as well!
+      (e.g. ISBN=0968-090X and ISBN=0968090X)
+
+    :returns: (update list, delete list)
+
+    """
+    DELETE_OWN_ATTACHMENTS = False  # @todo add option to ui
+    lib_items = st.session_state.zot_items
+    by_doi = get_items_by_doi_or_isbn(lib_items)
+    delete_items = []
+    update_items = []
+    for _, items in by_doi.items():
+        if len(items) == 1:
+            continue
+
+        # sort by age. oldest first
+        items.sort(key=date_added)
+        # keep oldest item
+        keep = items[0]
+        # keep latest attachments
+        keep_cs = st.session_state.children.get(keep["key"], [])
+        duplicates_have_pdf = False
+        for item in items[-1:0:-1]:
+            # children may be shared with other sessions. Don't change them
+            cs = [
+                dict(c, data=dict(c["data"], parentItem=keep["key"]))
+                for c in st.session_state.children.get(item["key"], [])
+            ]
+            if cs:
+                for c in cs:
+                    if attachment_is_pdf(c):
+                        duplicates_have_pdf = True
+
+                update_items.extend(cs)
+                if DELETE_OWN_ATTACHMENTS and duplicates_have_pdf:
+                    delete_items.extend(keep_cs)
+
+                break  # cause, only the newest attachements are added
+
+        delete_items.extend(items[1:])
+    return update_items, delete_items
+
+
+def journal_path(_zot, kind):
+    """Path of the write journal of a library
+
+    :param _zot: A Zotero instance
+    :type _zot: pyzotero.zotero.Zotero
+    :param kind: Kind of write operation, e.g. merge or pdf
+    :type kind: str
+    :returns: Path
+
+    """
+    name = f"{kind}_{_zot.library_type}_{_zot.library_id}.json"
+    return JOURNAL_DIR / name
+
+
+def chunks(_list, size):
+    """Split a list in consecutive chunks of at most <size> elements"""
+    return [_list[i : i + size] for i in range(0, len(_list), size)]
+
+
+def item_label(_item):
+    """Short label of an item for logs: title or filename"""
+    data = _item["data"]
+    return data.get("title") or data.get("filename") or _item["key"]
+
+
+def save_journal(journal):
+    """Write journal to disk
+
+    Write first to a temporary file and then replace the journal,
+    so a run dying in the middle does not leave a broken journal behind.
+
+    :param journal: journal as created in new_journal()
+    :type journal: dict
+
+    """
+    path = Path(journal["path"])
+    path.parent.mkdir(parents=True, exist_ok=True)
+    tmp = path.with_suffix(".tmp")
+    with open(tmp, "w", encoding="utf-8") as f:
+        json.dump(journal, f)
+
+    os.replace(tmp, path)
+
+
+def load_journal(_zot, kind):
+    """Unfinished journal of a library, if any
+
+    :param _zot: A Zotero instance
+    :type _zot: pyzotero.zotero.Zotero
+    :param kind: Kind of write operation, e.g. merge or pdf
+    :type kind: str
+    :returns: dict or None
+
+    """
+    path = journal_path(_zot, kind)
+    if not path.exists():
+        return None
+
+    try:
+        with open(path, encoding="utf-8") as f:
+            return json.load(f)
+    except (OSError, ValueError) as e:
+        logging.error(f"Can not read journal {path} with error {str(e)}")
+        return None
+
+
+def discard_journal(journal):
+    """Remove journal from disk"""
+    path = Path(journal["path"])
+    if path.exists():
+        path.unlink()
+
+
+def pending_batches(journal):
+    """Batches of a journal that are not executed yet"""
+    return [batch for batch in journal["batches"] if not batch["done"]]
+
+
+def new_journal(_zot, kind, update_items, delete_items, fields=("parentItem",)):
+    """Record planned writes in a journal before executing them
+
+    Updates come first. A deletion batch records the update batches
+    it has to wait for, so we don't delete parents of items we want to keep.
+    Only the changed fields are recorded for updates.
+    Each batch is one request to the API.
+
+    :param _zot: A Zotero instance
+    :type _zot: pyzotero.zotero.Zotero
+    :param kind: Kind of write operation, e.g. merge or pdf
+    :type kind: str
+    :param update_items: items with changed fields, e.g. a new parentItem
+    :type update_items: list of dicts
+    :param delete_items: items to delete
+    :type delete_items: list of dicts
+    :param fields: changed fields of update_items, for all or per key
+    :type fields: tuple of str or dict (key --> tuple of str)
+    :returns: dict
+
+    """
+    batches = []
+    updates = [
+        dict(
+            {"key": item["key"], "version": item["data"]["version"]},
+            **{
+                field: item["data"][field]
+                for field in (
+                    fields[item["key"]] if isinstance(fields, dict) else fields
+                )
+            },
+        )
+        for item in update_items
+    ]
+    labels = [item_label(item) for item in update_items]
+    # old parents of the updated items, None if not known
+    by_key = st.session_state.items_by_key
+    parents = [
+        by_key[item["key"]]["data"].get("parentItem") if item["key"] in by_key else None
+        for item in update_items
+    ]
+    for chunk, chunk_labels, chunk_parents in zip(
+        chunks(updates, WRITE_BATCH),
+        chunks(labels, WRITE_BATCH),
+        chunks(parents, WRITE_BATCH),
+    ):
+        batches.append(
+            {
+                "op": "update",
+                "items": chunk,
+                "labels": chunk_labels,
+                "parents": chunk_parents,
+                "done": False,
+            }
+        )
+
+    old_parents = [
+        (
+            {by_key[i["key"]]["data"].get("parentItem") for i in batch["items"]}
+            if all(i["key"] in by_key for i in batch["items"])
+            else None
+        )
+        for batch in batches
+    ]
+    deletes = [
+        {"key": item["key"], "version": item["version"]} for item in delete_items
+    ]
+    labels = [item_label(item) for item in delete_items]
+    for chunk, chunk_labels in zip(
+        chunks(deletes, WRITE_BATCH), chunks(labels, WRITE_BATCH)
+    ):
+        keys = {item["key"] for item in chunk}
+        after = [
+            j
+            for j, parents in enumerate(old_parents)
+            if parents is None or parents & keys
+        ]
+        batches.append(
+            {
+                "op": "delete",
+                "items": chunk,
+                "labels": chunk_labels,
+                "after": after,
+                "done": False,
+            }
+        )
+
+    journal = {
+        "kind": kind,
+        "path": str(journal_path(_zot, kind)),
+        "created": datetime.now().strftime(DATE_FMT),
+        "version": st.session_state.zot_version,
+        "batches": batches,
+    }
+    save_journal(journal)
+    logging.info(f"Journal {journal['path']} with {len(batches)} batches")
+    return journal
+
+
+def rebase_journal(_zot, journal):
+    """Bring pending batches of a journal to the current library version
+
+    Items deleted or changed since the last checkpoint are dropped from
+    the journal: updates may send whole fields (e.g. tags) and would
+    overwrite the remote changes. The old parents of dropped updates are
+    not deleted, their children were not moved. Dropped items are planned
+    again by the next analysis.
+
+    :param _zot: A Zotero instance
+    :type _zot: pyzotero.zotero.Zotero
+    :param journal: journal as created in new_journal()
+    :type journal: dict
+
+    """
+    version = _zot.last_modified_version()
+    if version == journal["version"]:
+        return
+
+    since = journal["version"]
+    logging.info(f"Rebase journal from version {since} to {version}")
+    dropped = set(_zot.item_versions(since=since))
+    dropped |= set(_zot.deleted(since=since)["items"])
+    keep = set()
+    batches = pending_batches(journal)
+    for batch in batches:
+        if batch["op"] != "update":
+            continue
+
+        parents = batch.get("parents") or [None] * len(batch["items"])
+        keep.update(
+            parent
+            for item, parent in zip(batch["items"], parents)
+            if item["key"] in dropped and parent
+        )
+
+    for batch in batches:
+        items, labels, parents = [], [], []
+        for i, (item, label) in enumerate(zip(batch["items"], batch["labels"])):
+            if item["key"] in dropped or item["key"] in keep:
+                logging.info(f"Changed since the plan, skip {label}")
+                continue
+
+            items.append(item)
+            labels.append(label)
+            if "parents" in batch:
+                parents.append(batch["parents"][i])
+
+        batch["items"], batch["labels"] = items, labels
+        if "parents" in batch:
+            batch["parents"] = parents
+
+        batch["done"] = not items
+
+    journal["version"] = version
+    save_journal(journal)
+
+
+def batch_dependencies(journal):
+    """Batches each batch has to wait for
+
+    Deletions wait for the updates of items whose parent they delete
+    (children are reparented first). Journals without recorded
+    dependencies run deletions after all updates.
+
+    :returns: list of sets of batch indices
+
+    """
+    updates = {
+        i for i, batch in enumerate(journal["batches"]) if batch["op"] == "update"
+    }
+    deps = []
+    for batch in journal["batches"]:
+        if batch["op"] == "update":
+            deps.append(set())
+        else:
+            deps.append(set(batch.get("after", updates)))
+
+    return deps
+
+
+class RateLimiter:
+    """Spread requests of several threads to at most rate per second
+
+    A Backoff or Retry-After of the API pauses all threads.
+    """
+
+    def __init__(self, rate=WRITE_RATE):
+        self.interval = 1 / rate
+        self._next = 0.0
+        self._lock = threading.Lock()
+
+    def wait(self):
+        with self._lock:
+            now = time.monotonic()
+            delay = max(0.0, self._next - now)
+            self._next = max(now, self._next) + self.interval
+
+        time.sleep(delay)
+
+    def pause(self, seconds):
+        """No request before <seconds> from now"""
+        logging.warning(f"API asks to back off for {seconds} s")
+        with self._lock:
+            self._next = max(self._next, time.monotonic() + seconds)
+
+
+def post_updates(_zot, items, limiter, retries=PAGE_RETRIES):
+    """Send partial updates of at most WRITE_BATCH items in one request
+
+    pyzotero's update_items() ignores the objects that failed in a
+    successful response, and a Zotero instance must not be shared by
+    threads. So the request is sent directly; Backoff and Retry-After
+    pause all threads through the limiter.
+
+    :param _zot: A Zotero instance (only its library and key are used)
+    :type _zot: pyzotero.zotero.Zotero
+    :param items: partial items with key and version
+    :type items: list of dicts
+    :param limiter: limiter shared by the threads
+    :type limiter: RateLimiter
+    :returns: dict (index in items as str --> failure with key, code, message)
+
+    """
+    endpoint = getattr(_zot, "endpoint", ZOTERO_API)
+    url = f"{endpoint}/{_zot.library_type}/{_zot.library_id}/items"
+    headers = {
+        "Zotero-API-Key": _zot.api_key,
+        "Zotero-API-Version": "3",
+        "Content-Type": "application/json",
+    }
+    body = json.dumps(items).encode()
+    for attempt in range(retries + 1):
+        limiter.wait()
+        request = urllib.request.Request(url, data=body, headers=headers, method="POST")
+        try:
+            with urllib.request.urlopen(request, timeout=60) as response:
+                backoff = response.headers.get("Backoff")
+                result = json.load(response)
+        except urllib.error.HTTPError as e:
+            retry_after = e.headers.get("Retry-After")
+            if e.code in (429, 503) and retry_after and attempt < retries:
+                limiter.pause(float(retry_after))
+                continue
+
+            raise
+
+        if backoff:
+            limiter.pause(float(backoff))
+
+        return result.get("failed", {})
+
+
+def run_journal(_zot, journal, pl2):
+    """Execute pending batches of a journal
+
+    This function changes the online Zotero library!
+
+    Batches run in waves along their dependencies, see batch_dependencies().
+    Updates of a wave run concurrently (WRITE_WORKERS threads,
+    at most WRITE_RATE requests per second, see post_updates()),
+    since every item carries its own version. Deletions need the library
+    version, so they run one after the other in this thread.
+
+    An update batch with failed objects is not done: its successful items
+    are removed from it, the failed ones stay for the next run and the
+    deletions waiting for the batch are not executed.
+
+    Every executed batch is marked as done with the new library version
+    as checkpoint. If a request fails, the journal is kept on disk
+    and the run can be resumed later.
+    A complete journal is removed, unless tags are still to be deleted
+    (see run_writes()).
+    The executed batches are applied to the loaded library, see apply_writes().
+
+    :param _zot: A Zotero instance
+    :type _zot: pyzotero.zotero.Zotero
+    :param journal: journal as created in new_journal()
+    :type journal: dict
+    :param pl2: placeholder to print messages
+    :type pl2: st.empty()
+    :returns: True if the library has been changed
+
+    """
+    rebase_journal(_zot, journal)
+    batches = journal["batches"]
+    deps = batch_dependencies(journal)
+    done = {i for i, batch in enumerate(batches) if batch["done"]}
+    num_pending = len(batches) - len(done)
+    limiter = RateLimiter(WRITE_RATE)
+    updated, deleted = [], []
+    failed = False
+
+    def execute(i):
+        batch = batches[i]
+        for label in batch["labels"]:
+            logging.info(f"{batch['op']}: {label}")
+
+        if batch["op"] == "update":
+            return post_updates(_zot, batch["items"], limiter)
+
+        limiter.wait()
+        _zot.delete_item(batch["items"], last_modified=journal["version"])
+        return {}
+
+    def keep_failed(batch, failures):
+        """Remove the successful items of a batch, return an error"""
+        failed = {int(index) for index in failures}
+        updated.extend(item for n, item in enumerate(batch["items"]) if n not in failed)
+        for field in ["items", "labels", "parents"]:
+            if field in batch:
+                batch[field] = [v for n, v in enumerate(batch[field]) if n in failed]
+
+        for failure in failures.values():
+            logging.error(f"Update of {failure.get('key')} failed: {failure}")
+
+        example = next(iter(failures.values()))
+        return RuntimeError(f"{len(failed)} items failed, e.g. {example}")
+
+    def finish(i, error=None, failures=None):
+        batch = batches[i]
+        msg = f"{batch['op']} batch {i + 1} / {len(batches)}"
+        if failures:
+            error = keep_failed(batch, failures)
+
+        if error is not None:
+            logging.error(f"Could not {msg} with error {str(error)}")
+            pl2.error(
+                f""":fire: Could not {msg}. Error: {error}.
+                Run again to resume from the last checkpoint."""
+            )
+            return
+
+        batch["done"] = True
+        done.add(i)
+        pl2.info(f"{len(done) - (len(batches) - num_pending)} / {num_pending} batches")
+        logging.info(msg)
+        if batch["op"] == "update":
+            updated.extend(batch["items"])
+        else:
+            deleted.extend(item["key"] for item in batch["items"])
+
+    while not failed:
+        ready = [i for i in range(len(batches)) if i not in done and deps[i] <= done]
+        if not ready:
+            break
+
+        updates = [i for i in ready if batches[i]["op"] == "update"]
+        if updates:
+            with ThreadPoolExecutor(max_workers=WRITE_WORKERS) as pool:
+                futures = {pool.submit(execute, i): i for i in updates}
+                for future in as_completed(futures):
+                    error = future.exception()
+                    failures = None if error else future.result()
+                    failed = failed or error is not None or bool(failures)
+                    finish(futures[future], error, failures)
+
+            journal["version"] = _zot.last_modified_version()
+            save_journal(journal)
+            continue
+
+        for i in ready:
+            try:
+                execute(i)
+                journal["version"] = _zot.last_modified_version()
+            except Exception as e:
+                failed = True
+                finish(i, e)
+                break
+
+            finish(i)
+            save_journal(journal)
+
+    if len(done) == len(batches) and not journal.get("delete_tags"):
+        discard_journal(journal)
+
+    apply_writes(updated, deleted)
+    return bool(updated or deleted)
+
+
+def apply_writes(updates, deleted_keys):
+    """Apply executed writes to the loaded library, see apply_delta()
+
+    The library version is not changed, so uptodate() still asks for a sync.
+
+    :param updates: partial items sent with update_items()
+    :type updates: list of dicts
+    :param deleted_keys: keys of deleted items
+    :type deleted_keys: list of str
+
+    """
+    if not st.session_state.lib_loaded or not (updates or deleted_keys):
+        return
+
+    changed = []
+    for payload in updates:
+        item = st.session_state.items_by_key.get(payload["key"])
+        if item is None:
+            continue
+
+        fields = {k: v for k, v in payload.items() if k not in ("key", "version")}
+        changed.append(dict(item, data=dict(item["data"], **fields)))
+
+    apply_delta(changed, deleted_keys)
+
+
+def plan_pdf_deletions_by_name():
+    """Duplicate pdf attachments of items, compared by filename
+
+    If all pdf files of an item have the same name, keep one.
+
+    :returns: list of dicts (attachments to delete)
+
+    """
+    update_duplicate_attach_state()
+    delete_items = []
+    for key in st.session_state.multpdf_items:
+        files = pdf_filenames(key)
+        cs = st.session_state.children.get(key, [])
+        if len(set(files)) == 1 and len(files) > 1:
+            # some items have different pdf files, like suppl materials.
+            # Should not be deleted
+            # here attachments are all named the same
+            # -->  a sign of duplicates
+            st.info(f"Proceed deleting {files} ...")
+            logging.info(f"Proceed deleting {files} ...")
+            delete_items.extend(duplicate_pdf_attachments(cs))
+
+    return delete_items
+
+
+def plan_pdf_deletions_by_md5():
+    """Duplicate pdf attachments of items, compared by content (md5)
+
+    For every group of identical files of an item keep the oldest one,
+    whatever the filenames are.
+
+    :returns: list of dicts (attachments to delete)
+
+    """
+    within = md5_duplicates_within_items(md5_groups())
+    delete_items = []
+    for parent, groups in within.items():
+        for attachments in groups:
+            attachments = sorted(attachments, key=date_added)
+            files = [a["data"].get("filename") for a in attachments]
+            st.info(f"Proceed deleting {files[1:]} ...")
+            logging.info(f"Proceed deleting {files[1:]} (keep {files[0]}) ...")
+            delete_items.extend(attachments[1:])
+
+    return delete_items
+
+
+def plan_writes(
+    new_tags=None,
+    tag_mapping=None,
+    merge=False,
+    pdf_by=None,
+    pdf_plan=None,
+    trash=False,
+    dois=None,
+):
+    """Coalesce the writes of several operations into one plan
+
+    - Deletions of all operations are collected once per item.
+    - Reparenting (merge), renamed tags, new tags and a new DOI of an item
+      are sent in one partial update.
+    - Items about to be deleted are not updated.
+    - Tags that are deleted library-wide afterwards
+      (duplicate_item after a merge, duplicate_pdf after
+      deleting pdf files by name) are not added.
+
+    :param new_tags: tags to add, see set_new_tag()
+    :type new_tags: dict of lists
+    :param tag_mapping: old tag --> new tag
+    :type tag_mapping: dict
+    :param merge: merge duplicate items
+    :type merge: bool
+    :param pdf_by: delete duplicate pdf files by "filename" or "md5"
+    :type pdf_by: str or None
+    :param pdf_plan: attachments to delete, e.g. from plan_storage_reclaim()
+    :type pdf_plan: list of dicts
+    :param trash: empty the trash
+    :type trash: bool
+    :param dois: new DOIs, e.g. accepted in backfill_dois()
+    :type dois: dict (key --> DOI)
+    :returns: (list of updated items, dict of changed fields, list of items to delete)
+
+    """
+    new_tags = dict(new_tags or {})
+    deletes = {}
+    updates = {}
+    fields = defaultdict(list)
+
+    def update(_item, field, value):
+        key = _item["key"]
+        base = updates.get(key, _item)
+        updates[key] = dict(base, data=dict(base["data"], **{field: value}))
+        if field not in fields[key]:
+            fields[key].append(field)
+
+    if merge:
+        update_duplicate_items_state()
+        update_items, delete_items = init_update_delete_lists()
+        deletes.update((i["key"], i) for i in delete_items)
+        for _item in update_items:
+            update(_item, "parentItem", _item["data"]["parentItem"])
+
+    if pdf_by == "md5":
+        deletes.update((i["key"], i) for i in plan_pdf_deletions_by_md5())
+    elif pdf_by == "filename":
+        deletes.update((i["key"], i) for i in plan_pdf_deletions_by_name())
+
+    deletes.update((i["key"], i) for i in pdf_plan or [])
+    if trash:
+        items = get_trash(st.session_state.zot)
+        keys = {i["key"] for i in items}
+        # children go with their parents
+        deletes.update(
+            (i["key"], i) for i in items if i["data"].get("parentItem") not in keys
+        )
+
+    if tag_mapping:
+        for _item in plan_tag_changes(st.session_state.tag_index, tag_mapping):
+            update(_item, "tags", _item["data"]["tags"])
+
+    dropped = {"duplicate_item"} if merge else set()
+    if pdf_by == "filename":
+        dropped.add("duplicate_pdf")
+
+    for key, tags in new_tags.items():
+        _item = updates.get(key, st.session_state.items_by_key.get(key))
+        if _item is None or is_standalone(_item) and is_file(_item):
+            continue
+
+        item_tags = [t["tag"] for t in _item["data"]["tags"]]
+        added = [t for t in tags if t not in item_tags and t not in dropped]
+        if added:
+            tags = _item["data"]["tags"] + [{"tag": t} for t in added]
+            update(_item, "tags", tags)
+
+    for key, doi in (dois or {}).items():
+        _item = st.session_state.items_by_key.get(key)
+        if _item is not None:
+            update(_item, "DOI", doi)
+
+    for key in deletes:
+        updates.pop(key, None)
+
+    fields = {key: tuple(fields[key]) for key in updates}
+    logging.info(f"Write plan: {len(updates)} updates, {len(deletes)} deletions")
+    return list(updates.values()), fields, list(deletes.values())
+
+
+def run_writes(
+    pl2,
+    new_tags=None,
+    tag_mapping=None,
+    tag_min_count=0,
+    merge=False,
+    pdf_by=None,
+    pdf_plan=None,
+    trash=False,
+    dois=None,
+):
+    """Execute the writes of several operations in one run
+
+    This function changes the online Zotero library!
+
+    The writes are planned with plan_writes() and recorded in one journal,
+    updates first. Tags are deleted library-wide at the end in one request:
+    tags of the finished operations (duplicate_item, duplicate_pdf)
+    and pruned tags. Tags renamed or added in this run are not pruned.
+    Tags are deleted in the whole library, so they are only pruned
+    if the whole library is loaded.
+    If an unfinished journal exists, it is resumed instead.
+
+    :param pl2: placeholder to print messages
+    :type pl2: st.empty()
+    :param tag_min_count: prune tags used by less items (0: don't prune)
+    :type tag_min_count: int
+    :returns: True if the library has been changed
+
+    See plan_writes() for the other parameters.
+
+    """
+    zot = st.session_state.zot
+    tag_mapping = tag_mapping or {}
+    journal = load_journal(zot, "plan")
+    if journal is None:
+        if tag_min_count and not st.session_state.whole_library:
+            pl2.error("Tags can only be pruned if the whole library is loaded")
+            st.stop()
+
+        update_items, fields, delete_items = plan_writes(
+            new_tags, tag_mapping, merge, pdf_by, pdf_plan, trash, dois
+        )
+        done_tags = ["duplicate_item"] if merge else []
+        if pdf_by == "filename":
+            done_tags.append("duplicate_pdf")
+
+        kept = set(tag_mapping) | set(tag_mapping.values())
+        kept.update(t for tags in (new_tags or {}).values() for t in tags)
+        pruned = prune_tags(st.session_state.tag_index, tag_min_count)
+        journal = new_journal(zot, "plan", update_items, delete_items, fields=fields)
+        journal["delete_tags"] = done_tags + [t for t in pruned if t not in kept]
+        save_journal(journal)
+    else:
+        pl2.warning(":repeat: Resuming unfinished write operations ...")
+        logging.info(f"Resume journal {journal['path']}")
+
+    changed = run_journal(zot, journal, pl2)
+    if pending_batches(journal):
+        return changed
+
+    delete_tags = journal.get("delete_tags", [])
+    if delete_tags:
+        logging.info(f"Delete tags {delete_tags}")
+        pl2.info(f"Deleting {len(delete_tags)} tags ...")
+        for chunk in chunks(delete_tags, WRITE_BATCH):
+            try:
+                zot.delete_tags(*chunk)
+            except Exception as e:
+                logging.error(f"Could not delete tags {chunk} with error {str(e)}")
+                pl2.error(
+                    f""":fire: Could not delete tags. Error: {e}.
+                    Run again to resume."""
+                )
+                return changed
+
+            changed = True
+            journal["delete_tags"] = journal["delete_tags"][len(chunk) :]
+            save_journal(journal)
+
+        discard_journal(journal)
+
+    return changed
+
+
+def get_children():
+    """Return Zotero children of items
+
+    @todo: optimize the second loop
+    :param _items: Zotero items
+    :type _items: list of dict
+    :returns: list of dict
+
+    """
+    _items = st.session_state.zot_items
+    diff = defaultdict(list)
+    pk = defaultdict(list)
+    for i, item in enumerate(_items):
+        if is_standalone(item) or is_file(item):
+            continue
+
+        key = item["key"]
+        if "numChildren" not in item["meta"]:
+            item_type = item["data"]["itemType"]
+            logging.warning(f"What a type: <{item_type}>")
+            continue
+
+        if item["meta"]["numChildren"] == 0:
+            pk[key] = []
+            diff[key] = 100
+            continue
+
+        # children should be near their parents
+        # @todo maybe optimize this loop later!
+        for k, child in enumerate(_items):
+            if "parentItem" in child["data"]:
+                if child["data"]["parentItem"] == key:
+                    pk[key].append(child)
+                    diff[key] = abs(k - i)
+
+    return dict(pk)
+
+
+def get_footprint(obj, seen=None):
+    """Approximate memory used by an object and everything it contains
+
+    Objects referenced several times are counted once.
+
+    :param obj: any object, e.g. list of Zotero items
+    :param seen: ids of objects already counted
+    :type seen: set
+    :returns: int (bytes)
+
+    """
+    if seen is None:
+        seen = set()
+
+    size = 0
+    stack = [obj]
+    while stack:
+        o = stack.pop()
+        if id(o) in seen:
+            continue
+
+        seen.add(id(o))
+        size += sys.getsizeof(o)
+        if isinstance(o, dict):
+            stack.extend(o.keys())
+            stack.extend(o.values())
+        elif isinstance(o, (list, tuple, set, frozenset)):
+            stack.extend(o)
+
+    return size
+
+
+class LibraryCache:
+    """Loaded libraries shared by all sessions of the app process
+
+    Entries are keyed by (library_id, library_type, library version),
+    so a changed library is never served from the cache.
+    Sessions use the cached items read-only.
+    If the cache grows above max_bytes,
+    the least recently used libraries are evicted.
+
+    """
+
+    def __init__(self, max_bytes=CACHE_MAX_BYTES):
+        self.max_bytes = max_bytes
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self._loading = defaultdict(threading.Lock)
+
+    def get(self, key):
+        """Cached entry (dict with items and children) or None"""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                self._entries.move_to_end(key)
+
+            return entry
+
+    def put(self, key, items, children):
+        """Add a library to the cache and evict the least recently used ones
+
+        :returns: cached entry
+        """
+        entry = {
+            "items": items,
+            "children": children,
+            "by_key": index_items(items),
+        }
+        entry["size"] = get_footprint(entry)
+        if entry["size"] > self.max_bytes:
+            logging.warning(
+                f"Library {key} ({entry['size']} bytes) is too large for the cache"
+            )
+            return entry
+
+        with self._lock:
+            self._entries[key] = entry
+            self._entries.move_to_end(key)
+            while self.nbytes > self.max_bytes:
+                old_key, old = self._entries.popitem(last=False)
+                logging.info(f"Evict library {old_key} ({old['size']} bytes)")
+
+        return entry
+
+    def latest(self, prefix):
+        """Newest cached version of a library
+
+        :param prefix: (library_id, library_type)
+        :type prefix: tuple
+        :returns: (key, entry) or (None, None)
+
+        """
+        with self._lock:
+            keys = [k for k in self._entries if k[:2] == prefix]
+            if not keys:
+                return None, None
+
+            key = max(keys, key=lambda k: k[2])
+            return key, self._entries[key]
+
+    def discard(self, key):
+        """Remove a library version from the cache"""
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def loading(self, key):
+        """Lock held while a library is downloaded,
+        so concurrent sessions download it only once"""
+        with self._lock:
+            return self._loading[key[:2]]
+
+    @property
+    def nbytes(self):
+        """Size of all cached libraries"""
+        return sum(entry["size"] for entry in self._entries.values())
+
+    def shares(self, obj):
+        """True if obj is part of a cached library"""
+        with self._lock:
+            return any(
+                obj is entry[name]
+                for entry in self._entries.values()
+                for name in ["items", "children", "by_key"]
+            )
 
-        if not any(result):
-            empty.append(_item)
+    def __len__(self):
+        return len(self._entries)
 
-    return empty
 
+LIBRARY_CACHE = LibraryCache()
 
-def delete_pdf_attachments(_children, pl2):
-    """Delete pdf attachments of an item and keep only one.
 
-    This functions changes the online Zotero library!
+def session_footprint():
+    """Approximate memory used by the session state
 
-    :param _children: Children items of a specific item
-    :type _children: list of dicts
-    :param pl2: placeholder to print messages
-    :type pl2: st.empty()
-    :returns: True if an attachment has been deleted.
+    Objects shared with other sessions through the library cache
+    are reported separately, since they are not owned by the session.
+    Every object is counted once, shared objects first.
 
+    :returns: list of dicts sorted by size
     """
+    values = [
+        (name, value, LIBRARY_CACHE.shares(value))
+        for name, value in st.session_state.items()
+    ]
+    values.sort(key=lambda v: not v[2])
+    seen = set()
+    rows = []
+    for name, value, shared in values:
+        rows.append(
+            {"name": name, "bytes": get_footprint(value, seen), "shared": shared}
+        )
 
-    deleted_attachment = False
-    zot = st.session_state.zot
-    for child in _children[1:]:
-        if not attachment_is_pdf(child):
-            continue  # only for pdf files.
+    rows.sort(key=lambda r: r["bytes"], reverse=True)
+    return rows
 
-        pl2.warning(f"deleting {child['data']['filename']}")
-        logging.warning(f"deleting {child['data']['filename']}")
-        zot.delete_item(child)
-        deleted_attachment = True
 
-    return deleted_attachment
+# Streaming API
+# Zotero pushes a topicUpdated event with the new library version
+# whenever a subscribed library changes. The listener keeps the shared
+# library cache fresh in the background, so sessions loading the library
+# (or asking for a delta sync) find the new version already cached.
+STREAM_URL = os.environ.get("ZOTEROTIDY_STREAM_URL", "wss://stream.zotero.org")
+STREAM_ENABLED = os.environ.get("ZOTEROTIDY_STREAM", "") not in ("", "0")
+STREAM_RETRY = 10  # seconds before reconnecting, the server may send another
 
 
-def log_title(_item):
-    """Log title of an item
+def new_client(_zot):
+    """Own Zotero instance for another thread, same library and API key
 
-    :param _item: Zotero library item
-    :type _item: dict
-    :returns: st.code
+    A Zotero instance keeps the last request and backoff state,
+    so threads must not share one.
+
+    :param _zot: A Zotero instance
+    :type _zot: pyzotero.zotero.Zotero
+    :returns: pyzotero.zotero.Zotero
 
     """
+    library_type = _zot.library_type.rstrip("s")  # users --> user
+    return zotero.Zotero(_zot.library_id, library_type, _zot.api_key)
 
-    if is_standalone(_item):
-        ttt = f"Standalone item of type: <{_item['data']['itemType']}>"
-        if "filename" in _item["data"]:
-            ttt += f" ({_item['data']['filename']})"
-    else:
-        ttt = f"{_item['data']['title']}"
 
-    st.code(f"{ttt}")
-    logging.info(f"{ttt}")
+class LibraryListener(threading.Thread):
+    """Background thread refreshing cached libraries on streaming API events
 
+    Needs websocket-client. Refresh requests use an own Zotero instance
+    per library, never the one of a session.
 
-def set_new_tag(z, n, m, d, o, mail=""):
-    """Prepare list of tags to be added to items
+    """
 
-    We have to add the tags to items at once.
-    Otherwise, we will have to update the library!
+    def __init__(self, cache=LIBRARY_CACHE, url=STREAM_URL):
+        super().__init__(name="zotero-stream", daemon=True)
+        self.cache = cache
+        self.url = url
+        self.retry = STREAM_RETRY
+        self._topics = {}  # topic --> (zot, cache key prefix)
+        self._lock = threading.Lock()
+        self._ws = None
 
-    This function may update the session_state of some lists
-    (if session_state lists are empty)
+    @staticmethod
+    def topic(_zot):
+        """Streaming API topic of a library, e.g. /users/12345"""
+        return f"/{_zot.library_type}/{_zot.library_id}"
 
-    These lists are:
-    - suspecious_items
-    - multpdf_items
-    - nopdf_items
-    - doi_dupl_items
+    def subscribe(self, _zot, prefix):
+        """Listen to the changes of a library
 
-    :param z: Suspecious items
-    :type z: Bool
-    :param n: Items with no pdf
-    :type n: Bool
-    :param m: Items with multiple pdf
-    :type m: Bool
-    :param d: Duplicate items
-    :type d: Bool
-    :param o: open-access articles
-    :type o: Bool
-    :returns: dict of lists
+        :param _zot: A Zotero instance of the session (not used by the thread)
+        :type _zot: pyzotero.zotero.Zotero
+        :param prefix: (library_id, library_type) of the cache keys
+        :type prefix: tuple
 
-    """
-    new_tags = defaultdict(list)
-    if z:
-        update_suspecious_state()
-        zotero_items = st.session_state.suspecious_items
-        for item in zotero_items:
-            new_tags[item["data"]["key"]].append("todo_catalog")
+        """
+        topic = self.topic(_zot)
+        with self._lock:
+            if topic in self._topics:
+                return
+
+            self._topics[topic] = (new_client(_zot), prefix)
+            ws = self._ws
+
+        logging.info(f"Subscribe to {topic}")
+        if ws is not None:
+            self._send_subscriptions(ws, [topic])
+
+    def _send_subscriptions(self, ws, topics):
+        by_key = defaultdict(list)
+        with self._lock:
+            for topic in topics:
+                by_key[self._topics[topic][0].api_key].append(topic)
+
+        subscriptions = [{"apiKey": k, "topics": t} for k, t in by_key.items()]
+        ws.send(
+            json.dumps(
+                {"action": "createSubscriptions", "subscriptions": subscriptions}
+            )
+        )
 
-    if m:
-        update_duplicate_attach_state()
-        items_duplicate_attach = st.session_state.multpdf_items
-        for item in items_duplicate_attach:
-            new_tags[item["data"]["key"]].append("duplicate_pdf")
+    def run(self):
+        while True:
+            try:
+                self._listen()
+            except Exception as e:
+                logging.warning(f"Streaming API: {e}. Reconnect in {self.retry} s")
 
-    if n:
-        update_without_pdf_state()
-        items_without_pdf = st.session_state.nopdf_items
-        for item in items_without_pdf:
-            new_tags[item["data"]["key"]].append("nopdf")
+            with self._lock:
+                self._ws = None
 
-    if d:
-        update_duplicate_items_state()
-        duplicate_items = st.session_state.doi_dupl_items
+            time.sleep(self.retry)
 
-        for item in duplicate_items:
-            new_tags[item["data"]["key"]].append("duplicate_item")
+    def _listen(self):
+        ws = websocket.create_connection(self.url, timeout=60)
+        try:
+            while True:
+                try:
+                    message = ws.recv()
+                except websocket.WebSocketTimeoutException:
+                    ws.ping()
+                    continue
 
-    if o:
-        unpywall_credits(mail)
-        items_by_doi = get_items_by_doi(st.session_state.zot_items)
-        pl = st.empty()
-        with st.spinner("Initializing ..."):
-            OA_items, _ = get_oa_ca(items_by_doi, pl)
+                if not message:
+                    return
 
-        items = doi_to_item(OA_items)
+                self.handle(ws, json.loads(message))
+        finally:
+            ws.close()
+            # close() skips the socket once the server has closed first
+            ws.shutdown()
 
-        for item in items:
-            new_tags[item["data"]["key"]].append("open-access")
+    def handle(self, ws, message):
+        """React to a message of the streaming API"""
+        event = message.get("event")
+        if event == "connected":
+            self.retry = message.get("retry", STREAM_RETRY * 1000) / 1000
+            with self._lock:
+                self._ws = ws
+                topics = list(self._topics)
 
-    return new_tags
+            if topics:
+                self._send_subscriptions(ws, topics)
+        elif event == "subscriptionsCreated":
+            for error in message.get("errors", []):
+                logging.warning(f"Streaming API subscription error: {error}")
+        elif event == "topicUpdated":
+            self.refresh(message["topic"], message.get("version"))
 
+    def refresh(self, topic, version=None):
+        """Apply the changes of a library to its newest cached version
 
-def add_tag(tags_to_add, _zot, _item):
-    """Add tags to Zotero items
+        The older version is dropped from the cache,
+        sessions using it keep their own reference.
 
-    This function changes the online library
+        :returns: new cache key or None
 
-    :todo: use zot from session_state
-    :param tags_to_add: dict prepared in set_new_tag()
-    :type tags_to_add: dict of lists
-    :param _zot: A Zotero instance
-    :type _zot: pyzotero.zotero.Zotero
-    :param _item: Zotero library item
-    :type _item: dict
-    :returns: True if changes have been made
+        """
+        with self._lock:
+            if topic not in self._topics:
+                return None
 
-    """
-    logging.info(
-        f"Enter add_tag with {tags_to_add}. standalone: {is_standalone(_item)}. is_file: {is_file(_item)}"
-    )
-    if not tags_to_add or is_standalone(_item) and is_file(_item):
-        return False
+            _zot, prefix = self._topics[topic]
 
-    title = _item["data"]["title"]
-    item_tags = [t["tag"] for t in _item["data"]["tags"]]
-    new_tags = [t for t in tags_to_add if t not in item_tags]
-    logging.info(f"new tags: {new_tags}")
-    if not new_tags:
-        return False
+        with self.cache.loading(prefix):
+            key, entry = self.cache.latest(prefix)
+            if entry is None or version is not None and key[2] >= version:
+                return None
 
-    logging.info(f"add tags {new_tags} to {title}")
-    _zot.add_tags(_item, *new_tags)
-    return True
+            version = _zot.last_modified_version()
+            changed, deleted = fetch_delta(_zot, key[2])
+            items, children = merge_delta(
+                entry["items"], entry["children"], changed, deleted
+            )
+            new_key = prefix + (version,)
+            self.cache.put(new_key, items, children)
+            self.cache.discard(key)
 
+        logging.info(
+            f"Refreshed {topic} to version {version}: {len(changed)} changed, {len(deleted)} deleted"
+        )
+        return new_key
 
-def update_suspecious_state():
-    """update suspecious_items"""
-    if not st.session_state.suspecious_items:
-        items = get_suspecious_items(st.session_state.zot_items)
-        st.session_state.suspecious_items = items
 
+_LISTENER = None
+_LISTENER_LOCK = threading.Lock()
 
-# @todo check if state variable need to be used as input for functions
-def update_duplicate_attach_state():
-    """First update of lists related to multiple pdfs
 
-    - multpdf_items
-    - pdfs
-    - init_multpdf_items
+def library_listener():
+    """The listener of the app process, started on first use
+
+    :returns: LibraryListener or None if websocket-client is missing
 
     """
-    if not st.session_state.init_multpdf_items:
-        items, pdfs = get_items_with_duplicate_pdf(
-            st.session_state.zot, st.session_state.zot_items
-        )
+    global _LISTENER
+    if websocket is None:
+        logging.warning("Streaming API needs websocket-client")
+        return None
+
+    with _LISTENER_LOCK:
+        if _LISTENER is None:
+            _LISTENER = LibraryListener()
+            _LISTENER.start()
+
+        return _LISTENER
+
+
+# Full-text fingerprints
+# Items without DOI/ISBN and with different titles (preprint vs. published,
+# translated titles) are compared by the text Zotero extracted from their
+# attachments. The text of every attachment is reduced to a MinHash signature
+# of its word shingles. Signatures are kept on disk and updated incrementally
+# with the fulltext?since= endpoint.
+SHINGLE_SIZE = 5  # words
+NUM_PERM = 64  # length of signature
+LSH_BANDS = 16  # NUM_PERM / LSH_BANDS rows per band
+FULLTEXT_THRESHOLD = 0.8  # estimated Jaccard similarity
+FULLTEXT_FORMAT = 2  # signatures of other formats are computed again
+MINHASH_CHUNK = 4096  # shingles hashed at once
+_MERSENNE = (1 << 61) - 1
+_rng = random.Random(42)  # fixed seed: signatures are stored on disk
+_PERMUTATIONS = [
+    (_rng.randrange(1, _MERSENNE), _rng.randrange(0, _MERSENNE))
+    for _ in range(NUM_PERM)
+]
+_PERM_A = np.array([a for a, _ in _PERMUTATIONS], dtype=np.uint64)
+_PERM_B = np.array([b for _, b in _PERMUTATIONS], dtype=np.uint64)
+
+
+def shingles(text, size=SHINGLE_SIZE):
+    """Hashes of the word shingles of a text
+
+    :param text: extracted text of an attachment
+    :type text: str
+    :param size: number of words per shingle
+    :type size: int
+    :returns: set of int
 
-        st.session_state.multpdf_items = items
-        st.session_state.pdfs = pdfs
-        st.session_state.init_multpdf_items = True
+    """
+    words = re.findall(r"\w+", text.lower())
+    if len(words) < size:
+        return {zlib.crc32(" ".join(words).encode())} if words else set()
 
+    return {
+        zlib.crc32(" ".join(words[i : i + size]).encode())
+        for i in range(len(words) - size + 1)
+    }
 
-def force_update_duplicate_attach_state():
-    """Update of lists related to multiple pdfsrelated to multiple pdfs
 
-    - multpdf_items
-    - pdfs
-    - init_multpdf_items
+def minhash(_shingles):
+    """MinHash signature of a set of shingles
+
+    The permutations are computed with numpy on chunks of shingles
+    (a * s + b wraps around at 2**64 before the modulo).
+
+    :param _shingles: hashes of shingles
+    :type _shingles: set of int
+    :returns: list of int
 
     """
-    items, pdfs = get_items_with_duplicate_pdf(
-        st.session_state.zot, st.session_state.zot_items
-    )
+    if not _shingles:
+        return []
 
-    st.session_state.multpdf_items = items
-    st.session_state.pdfs = pdfs
-    st.session_state.init_multpdf_items = True
+    values = np.fromiter(_shingles, dtype=np.uint64, count=len(_shingles))
+    signature = np.full(NUM_PERM, np.iinfo(np.uint64).max, dtype=np.uint64)
+    for start in range(0, len(values), MINHASH_CHUNK):
+        chunk = values[start : start + MINHASH_CHUNK]
+        hashes = (np.outer(chunk, _PERM_A) + _PERM_B) % np.uint64(_MERSENNE)
+        np.minimum(signature, hashes.min(axis=0), out=signature)
 
+    return signature.tolist()
 
-def update_duplicate_items_state():
-    """First update of duplicate items by doi"""
-    if not st.session_state.init_doi_dupl_items:
-        duplicates = duplicates_by_doi(st.session_state.zot_items)
-        st.session_state.doi_dupl_items = duplicates
-        st.session_state.init_doi_dupl_items = True
 
+def signature_similarity(sig1, sig2):
+    """Estimated Jaccard similarity of two signatures"""
+    if not sig1 or not sig2:
+        return 0.0
 
-def force_update_duplicate_items_state():
-    """First update of duplicate items by doi"""
+    return sum(x == y for x, y in zip(sig1, sig2)) / len(sig1)
 
-    duplicates = duplicates_by_doi(st.session_state.zot_items)
-    st.session_state.doi_dupl_items = duplicates
-    st.session_state.init_doi_dupl_items = True
 
+def lsh_candidates(signatures, bands=LSH_BANDS):
+    """Pairs of keys with at least one identical band of their signatures
 
-def update_without_pdf_state():
-    """First update of items without pdf"""
-    if not st.session_state.nopdf_items:
-        items = get_items_with_no_pdf_attachments2(st.session_state.zot_items)
+    :param signatures: signatures by key
+    :type signatures: dict of lists
+    :param bands: number of bands
+    :type bands: int
+    :returns: set of tuples
 
-        st.session_state.nopdf_items = items
+    """
+    rows = NUM_PERM // bands
+    candidates = set()
+    for band in range(bands):
+        buckets = defaultdict(list)
+        for key, sig in signatures.items():
+            if sig:
+                buckets[tuple(sig[band * rows : (band + 1) * rows])].append(key)
 
+        for keys in buckets.values():
+            for i, key1 in enumerate(keys):
+                for key2 in keys[i + 1 :]:
+                    candidates.add(tuple(sorted((key1, key2))))
 
-def uptodate():
-    """Check if library is up to date
+    return candidates
 
-    every change in Zotero-Library increments
-    the version number by one.
-    For example, trash being emptied --> +1
-    or note's content changed --> +1
 
-    :return: True if up-to-date
+def fulltext_index_path(_zot):
+    """Path of the full-text fingerprint index of a library"""
+    return FULLTEXT_DIR / f"{_zot.library_type}_{_zot.library_id}.json"
+
+
+def load_fulltext_index(_zot):
+    """Full-text fingerprint index of a library, empty if not yet built
+
+    :param _zot: A Zotero instance
+    :type _zot: pyzotero.zotero.Zotero
+    :returns: dict with version and signatures by attachment key
+
     """
+    path = fulltext_index_path(_zot)
+    if path.exists():
+        try:
+            with open(path, encoding="utf-8") as f:
+                index = json.load(f)
 
-    actual_st_version = st.session_state.zot_version
-    last_modified_version = st.session_state.zot.last_modified_version()
+            if index.get("format") == FULLTEXT_FORMAT:
+                return index
 
-    return actual_st_version == last_modified_version
+            logging.info(f"Index {path} has an old format, rebuild it")
+        except (OSError, ValueError) as e:
+            logging.error(f"Can not read index {path} with error {str(e)}")
 
+    return {"version": 0, "format": FULLTEXT_FORMAT, "signatures": {}}
 
-def items_uptodate():
-    """Check if items are outdated
 
-    If outdated, don't execute any update-functions
+def save_fulltext_index(_zot, index):
+    """Write full-text fingerprint index to disk"""
+    path = fulltext_index_path(_zot)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    tmp = path.with_suffix(".tmp")
+    with open(tmp, "w", encoding="utf-8") as f:
+        json.dump(index, f)
 
-    :todo: not used
-    :return: True if all up-to-date
-    """
+    os.replace(tmp, path)
 
-    zot = st.session_state.zot
-    vs = zot.item_versions()
 
-    vc = {}
-    for item in st.session_state.zot_items:
-        vc[item["key"]] = item["data"]["version"]
+def update_fulltext_index(_zot, pl):
+    """Fetch the text of attachments changed since the last update
 
-    vs_reduced = {k: vs[k] for k, _ in vc.items()}
-    logging.info("----")
-    logging.info(f"vc: {len(vc)}, {vc}")
-    logging.info(f"vs: {len(vs)}, {vs}")
-    logging.info(f"vs_reduced: {len(vs_reduced)}, {vs_reduced}")
-    logging.info(vc == vs_reduced)
-    return vc == vs_reduced
+    Only new or changed full-texts are downloaded, oldest first.
+    Signatures of deleted attachments are removed.
+    The stored version only covers the full-texts processed so far:
+    after an error, the remaining ones are fetched next time.
 
+    :param _zot: A Zotero instance
+    :type _zot: pyzotero.zotero.Zotero
+    :param pl: placeholder to print messages
+    :type pl: st.empty()
+    :returns: dict (updated index)
 
-def update_tags(
-    pl2, update_tags_z, update_tags_n, update_tags_m, update_tags_d, update_tags_o, mail
-):
     """
-    A wrapper function  of add_tag()
+    index = load_fulltext_index(_zot)
+    since = index["version"]
+    try:
+        new = _zot.new_fulltext(since=since)
+        deleted = _zot.deleted(since=since)["items"] if since else []
+    except Exception as e:
+        pl.error(f"Could not fetch full-text versions with error {str(e)}")
+        logging.error(f"Could not fetch full-text versions with error {str(e)}")
+        return index
 
-    :param pl2: placeholder to print messages
-    :type pl2: st.empty()
-    :param update_tags_z: Suspecious items
-    :type update_tags_z: Bool
-    :param update_tags_n: Items with no pdf
-    :type update_tags_n: Bool
-    :param update_tags_m: Items with multiple pdf
-    :type update_tags_m: Bool
-    :param update_tags_d: Duplicte items
-    :type update_tags_d: Bool
-    :param update_tags_o: Open-access articles
-    :type update_tags_: Bool
-    :param mail: mail necessary to fetch open-access articles
-
-    """
-    new_tags = set_new_tag(
-        update_tags_z, update_tags_n, update_tags_m, update_tags_d, update_tags_o, mail
-    )
-    changed = []
-    msg = st.empty()
+    for key in deleted:
+        index["signatures"].pop(key, None)
 
-    if not new_tags:
-        pl2.info(":heavy_check_mark: Tags of the library are not changed.")
-    else:
-        pl2.warning(":red_circle: Updating tags ...")
-        my_bar = st.progress(0)
-        retrieved_items = len(st.session_state.zot_items)
-        for i, item in enumerate(st.session_state.zot_items):
-            msg.info(f"process {i} / {retrieved_items}")
-            logging.info(f"process {i} / {retrieved_items}")
-            progress_by = (i + 1) / retrieved_items
-            my_bar.progress(progress_by)
-            ch = add_tag(
-                new_tags[item["data"]["key"]],
-                st.session_state.zot,
-                item,
-            )
-            changed.append(ch)
+    logging.info(f"Full-text: {len(new)} new since version {since}")
+    my_bar = st.progress(0)
+    ordered = sorted(new.items(), key=lambda kv: kv[1])
+    for i, (key, version) in enumerate(ordered):
+        pl.info(f"Full-text {i + 1} / {len(new)}")
+        try:
+            content = _zot.fulltext_item(key).get("content", "")
+        except Exception as e:
+            # keep the old version, so it is fetched again next time
+            logging.error(f"Could not fetch full-text of {key} with error {str(e)}")
+            save_fulltext_index(_zot, index)
+            return index
 
-        if any(changed):
-            pl2.warning(
-                """:warning: Library updated.
-            You may want to sync!"""
-            )
-        else:
-            pl2.info(":heavy_check_mark: Tags of the library are not changed.")
+        index["signatures"][key] = minhash(shingles(content))
+        # other full-texts may have the same version
+        index["version"] = max(index["version"], version - 1)
+        my_bar.progress((i + 1) / len(new))
+        if (i + 1) % 100 == 0:
+            save_fulltext_index(_zot, index)
 
+    if ordered:
+        index["version"] = max(index["version"], ordered[-1][1])
 
-def init_update_delete_lists():
-    """Initialize Items to update/delete
+    save_fulltext_index(_zot, index)
+    return index
 
-    Prepare some lists of items to be updated and deleted
 
-    Note:
-    - Duplicates without DOI not ISBN numbers are going to be ignored!
-    - Duplicates with different DOI or ISBN will be missed as well!
-      (e.g. ISBN=0968-090X and ISBN=0968090X)
+def fulltext_duplicates(index, threshold=FULLTEXT_THRESHOLD):
+    """Pairs of items whose attachments share most of their text
 
-    :returns: (update list, delete list)
+    :param index: full-text fingerprint index
+    :type index: dict
+    :param threshold: min. estimated Jaccard similarity
+    :type threshold: float
+    :returns: list of dicts (report rows)
 
     """
-    DELETE_OWN_ATTACHMENTS = False  # @todo add option to ui
-    lib_items = st.session_state.zot_items
-    by_doi = get_items_by_doi_or_isbn(lib_items)
-    delete_items = []
-    update_items = []
-    for _, items in by_doi.items():
-        if len(items) == 1:
+    by_key = st.session_state.items_by_key
+    signatures = index["signatures"]
+    rows = []
+    for key1, key2 in lsh_candidates(signatures):
+        similarity = signature_similarity(signatures[key1], signatures[key2])
+        if similarity < threshold:
             continue
 
-        # sort by age. oldest first
-        items.sort(key=date_added)
-        # keep oldest item
-        keep = items[0]
-        # keep latest attachments
-        keep_cs = st.session_state.children[keep["key"]]
-        duplicates_have_pdf = False
-        for item in items[-1:0:-1]:
-            cs = st.session_state.children[item["key"]]
-            if cs:
-                for c in cs:
-                    c["data"]["parentItem"] = keep["key"]
-                    if attachment_is_pdf(c):
-                        duplicates_have_pdf = True
-
-                update_items.extend(cs)
-                if DELETE_OWN_ATTACHMENTS and duplicates_have_pdf:
-                    delete_items.extend(keep_cs)
-
-                break  # cause, only the newest attachements are added
+        parents = []
+        for key in [key1, key2]:
+            attachment = by_key.get(key)
+            parent = attachment["data"].get("parentItem", key) if attachment else key
+            parents.append(parent)
 
-        delete_items.extend(items[1:])
-    return update_items, delete_items
+        if parents[0] == parents[1]:
+            continue
 
+        titles = [item_title(by_key[p]) if p in by_key else "" for p in parents]
+        rows.append(
+            {
+                "similarity": round(similarity, 2),
+                "title": titles[0],
+                "other title": titles[1],
+                "key": parents[0],
+                "other key": parents[1],
+            }
+        )
 
-def delete_duplicate_items(pl2):
-    """Delete duplicate items
+    rows.sort(key=lambda r: r["similarity"], reverse=True)
+    return rows
 
-    Uses the update and delete lists
-    calculated in init_update_delete_lists()
 
-    if deleted, remove the tag "duplicate_item"
+# Offline Unpaywall
+# A snapshot of the Unpaywall database (gzipped JSONL, one record per DOI)
+# is reduced once to a sqlite table DOI --> is_oa in OA_INDEX_DIR.
+UNPAYWALL_SNAPSHOT = os.environ.get("ZOTEROTIDY_UNPAYWALL", "")
+OA_INDEX_DIR = Path(__file__).parent.absolute() / "unpaywall"
+OA_INDEX_BATCH = 10000  # rows per insert
 
-    :param pl2: placeholder to print messages
-    :type pl2: st.empty()
 
-    :returns: True if items have been deleted and updated
+def oa_index_path(snapshot):
+    """Path of the index of a snapshot, e.g. oa.jsonl.gz --> oa.jsonl_<hash>.sqlite
 
+    The data directory of the snapshot may be read-only,
+    indexes are kept in OA_INDEX_DIR.
     """
-    update_duplicate_items_state()
-    zot = st.session_state.zot
-    deleted_or_updated = False
-    update_items, delete_items = init_update_delete_lists()
+    snapshot = Path(snapshot).absolute()
+    digest = hashlib.md5(str(snapshot).encode()).hexdigest()[:8]
+    return OA_INDEX_DIR / f"{snapshot.with_suffix('').name}_{digest}.sqlite"
 
-    if update_items:
-        st.code("Deleting duplicate items ...")
 
-    # update first, so we don't delete parents of items we want to keep
-    for update_item in update_items:
-        log_title(update_item)
-        zot.update_item(update_item)
-        deleted_or_updated = True
+def snapshot_stamp(snapshot):
+    """Size and modification time of a snapshot, to detect a new one"""
+    stat = Path(snapshot).stat()
+    return f"{stat.st_size}:{int(stat.st_mtime)}"
 
-    if delete_items:
-        st.code("Deleting from library ...")
-        logging.info("Deleting from library ...")
 
-    #  now delete: DANGER AREA!
-    for delete_item in delete_items:
-        log_title(delete_item)
-        zot.delete_item(delete_item)
-        deleted_or_updated = True
+def build_oa_index(snapshot, pl=None):
+    """Build the DOI --> is_oa index of an Unpaywall snapshot
 
-    # remove tag
+    The snapshot is read once as a stream.
+    The index is written to a temporary file first,
+    so an interrupted build does not leave a broken index.
 
-    if not deleted_or_updated:
-        pl2.info(":heavy_check_mark: Library has no duplicates!")
-        logging.info(":heavy_check_mark: Library has no duplicates!")
-    else:
-        zot.delete_tags("duplicate_item")
+    :param snapshot: gzipped JSONL snapshot
+    :type snapshot: str or Path
+    :param pl: placeholder to print progress
+    :type pl: st.empty()
+    :returns: Path of the index
 
-    force_update_duplicate_items_state()
+    """
+    path = oa_index_path(snapshot)
+    path.parent.mkdir(exist_ok=True)
+    tmp = path.with_suffix(".tmp")
+    tmp.unlink(missing_ok=True)
+    logging.info(f"Build Unpaywall index {path} from {snapshot}")
+    con = sqlite3.connect(tmp)
+    try:
+        con.execute("PRAGMA journal_mode = OFF")
+        con.execute("PRAGMA synchronous = OFF")
+        con.execute("CREATE TABLE meta (stamp TEXT)")
+        con.execute(
+            "CREATE TABLE oa (doi TEXT PRIMARY KEY, is_oa INTEGER) WITHOUT ROWID"
+        )
+        rows = []
+        num_lines = 0
+        with gzip.open(snapshot, "rt", encoding="utf-8") as f:
+            for num_lines, line in enumerate(f, 1):
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    continue
 
-    return deleted_or_updated
+                if record.get("doi"):
+                    rows.append((record["doi"].lower(), int(bool(record.get("is_oa")))))
 
+                if len(rows) >= OA_INDEX_BATCH:
+                    con.executemany("INSERT OR REPLACE INTO oa VALUES (?, ?)", rows)
+                    rows = []
+                    if pl is not None and num_lines % (100 * OA_INDEX_BATCH) == 0:
+                        pl.info(f"Indexed {num_lines} DOIs of the Unpaywall snapshot")
 
-def delete_duplicate_pdf(pl2):
-    """Delete duplicate pdf files
+        con.executemany("INSERT OR REPLACE INTO oa VALUES (?, ?)", rows)
+        con.execute("INSERT INTO meta VALUES (?)", (snapshot_stamp(snapshot),))
+        con.commit()
+    finally:
+        con.close()
 
-    This function is slow since it iterates over the children of the items
-    (network traffic)
+    tmp.replace(path)
+    logging.info(f"Indexed {num_lines} records of {snapshot}")
+    return path
 
-    If an item has several pdf files with the same name,
-    then delete them and keep one. In that case, delete the tag (duplicate_pdf)
-    If an item has several pdf files with different names,
-    then don't delete anything.
 
-    :param pl2: placeholder to print messages
-    :type pl2: st.empty()
-    :returns: True if items have been deleted
+def oa_index(snapshot, pl=None):
+    """Up-to-date index of a snapshot, built if missing or outdated
 
-    """
-    pl2.info("check list of items with duplicate pdfs")
-    update_duplicate_attach_state()
-    deleted_attachment = False
-    items_duplicate_attach = st.session_state.multpdf_items
-    pdf_attachments = st.session_state.pdfs
-    zot = st.session_state.zot
-    for item in items_duplicate_attach:
-        files = pdf_attachments[item["key"]]
-        cs = st.session_state.children[item["key"]]
-        if len(set(files)) == 1 and len(files) > 1:
-            # some items have different pdf files, like suppl materials.
-            # Should not be deleted
-            # here attachments are all named the same
-            # -->  a sign of duplicates
-            st.info(f"Proceed deleting {files} ...")
-            logging.info(f"Proceed deleting {files} ...")
-            deleted_attachment = delete_pdf_attachments(cs, pl2)
+    :returns: Path of the index
 
-        if deleted_attachment:
-            zot.delete_tags("duplicate_pdf")
-            force_update_duplicate_attach_state()
+    """
+    path = oa_index_path(snapshot)
+    if path.exists():
+        con = sqlite3.connect(f"file:{path}?mode=ro", uri=True)
+        try:
+            stamp = con.execute("SELECT stamp FROM meta").fetchone()
+        except sqlite3.Error:
+            stamp = None
+        finally:
+            con.close()
 
-    return deleted_attachment
+        if stamp and stamp[0] == snapshot_stamp(snapshot):
+            return path
 
+    return build_oa_index(snapshot, pl)
 
-def get_children():
-    """Return Zotero children of items
 
-    @todo: optimize the second loop
-    :param _items: Zotero items
-    :type _items: list of dict
-    :returns: list of dict
+def lookup_oa(path, dois):
+    """OA status of DOIs in an index
 
-    """
-    _items = st.session_state.zot_items
-    diff = defaultdict(list)
-    pk = defaultdict(list)
-    for i, item in enumerate(_items):
-        if is_standalone(item) or is_file(item):
-            continue
+    DOIs are compared case-insensitively. Unknown DOIs are left out.
 
-        key = item["key"]
-        if "numChildren" not in item["meta"]:
-            item_type = item["data"]["itemType"]
-            logging.warning(f"What a type: <{item_type}>")
-            continue
+    :param path: index from oa_index()
+    :type path: Path
+    :param dois: DOIs
+    :type dois: list of str
+    :returns: dict (doi --> bool)
 
-        if item["meta"]["numChildren"] == 0:
-            pk[key] = []
-            diff[key] = 100
-            continue
+    """
+    by_lower = defaultdict(list)
+    for doi in dois:
+        by_lower[doi.lower()].append(doi)
 
-        # children should be near their parents
-        # @todo maybe optimize this loop later!
-        for k, child in enumerate(_items):
-            if "parentItem" in child["data"]:
-                if child["data"]["parentItem"] == key:
-                    pk[key].append(child)
-                    diff[key] = abs(k - i)
+    status = {}
+    con = sqlite3.connect(f"file:{path}?mode=ro", uri=True)
+    try:
+        for chunk in chunks(list(by_lower), 500):
+            marks = ",".join("?" * len(chunk))
+            query = f"SELECT doi, is_oa FROM oa WHERE doi IN ({marks})"
+            for doi, is_oa in con.execute(query, chunk):
+                for original in by_lower[doi]:
+                    status[original] = bool(is_oa)
+    finally:
+        con.close()
 
-    return pk
+    return status
 
 
 # https://support.unpaywall.org/support/solutions/articles/44001900286
@@ -1151,13 +5247,40 @@ def get_children():
 # We used to include DataCite DOIs, but we don't anymore.
 # In practice we added very little value because almost everything
 # with a DataCite DOI is OA.
-def get_oa_ca(_dois, pl2):
+def get_oa_ca(_dois, pl2, snapshot=""):
+    """Open-access and closed-access DOIs
+
+    With a snapshot, the local Unpaywall index is used (no network),
+    otherwise the Unpaywall API.
+
+    :param _dois: items by DOI
+    :type _dois: dict
+    :param pl2: placeholder to print messages
+    :type pl2: st.empty()
+    :param snapshot: gzipped JSONL snapshot of Unpaywall
+    :type snapshot: str
+    :returns: (list of str, list of str)
+
+    """
     dois = list(_dois.keys())
+    if snapshot:
+        try:
+            status = lookup_oa(oa_index(snapshot, pl2), dois)
+        except (OSError, EOFError, sqlite3.Error) as e:
+            pl2.error(f"Can not read Unpaywall snapshot {snapshot}: {str(e)}")
+            logging.error(f"Can not read Unpaywall snapshot {snapshot}: {str(e)}")
+            st.stop()
+
+        oa_dois = [doi for doi, is_oa in status.items() if is_oa]
+        ca_dois = [doi for doi, is_oa in status.items() if not is_oa]
+        return oa_dois, ca_dois
+
     try:
         articles = Unpywall.doi(dois=dois, errors="ignore", progress=True)
     except Exception as e:
         pl2.error(f"Connection error to Unpaywall {str(e)}")
         logging.info(str(e))
+        st.stop()
 
     oa_dois = list(articles["doi"][articles["is_oa"]])
     ca_dois = list(articles["doi"][~articles["is_oa"]])